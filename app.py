@@ -1,68 +1,152 @@
-# Flask app for local testing
-import os
-import json
-from flask import Flask, request, jsonify
-from service.handler import (
-    upload_url_handler,
-    confirm_upload_handler,
-    list_images_handler,
-    get_image_handler,
-    delete_image_handler
-)
-
-app = Flask(__name__)
-
-def create_event(payload=None, query_params=None, path_params=None):
-    """Create Lambda event from Flask request"""
-    event = {}
-    if payload:
-        event['body'] = json.dumps(payload)
-    if query_params:
-        event['queryStringParameters'] = query_params
-    if path_params:
-        event['pathParameters'] = path_params
-    return event
-
-@app.route('/upload-url', methods=['POST'])
-def upload_url():
-    """Request presigned URL for image upload"""
-    event = create_event(payload=request.get_json())
-    res = upload_url_handler(event, None)
-    return (res['body'], res['statusCode'], {'Content-Type': 'application/json'})
-
-@app.route('/confirm-upload', methods=['POST'])
-def confirm_upload():
-    """Confirm image upload completion"""
-    event = create_event(payload=request.get_json())
-    res = confirm_upload_handler(event, None)
-    return (res['body'], res['statusCode'], {'Content-Type': 'application/json'})
-
-@app.route('/images', methods=['GET'])
-def list_images():
-    """List images with filters"""
-    event = create_event(query_params=request.args.to_dict())
-    res = list_images_handler(event, None)
-    return (res['body'], res['statusCode'], {'Content-Type': 'application/json'})
-
-@app.route('/images/<user_id>/<image_id>', methods=['GET'])
-def get_image(user_id, image_id):
-    """Get single image details"""
-    event = create_event(path_params={'user_id': user_id, 'image_id': image_id})
-    res = get_image_handler(event, None)
-    return (res['body'], res['statusCode'], {'Content-Type': 'application/json'})
-
-@app.route('/images/<user_id>/<image_id>', methods=['DELETE'])
-def delete_image(user_id, image_id):
-    """Delete image"""
-    event = create_event(path_params={'user_id': user_id, 'image_id': image_id})
-    res = delete_image_handler(event, None)
-    return (res['body'], res['statusCode'], {'Content-Type': 'application/json'})
-
-@app.route('/health', methods=['GET'])
-def health():
-    """Health check endpoint"""
-    return jsonify({'status': 'healthy', 'service': 'instagram-image-service'})
-
-if __name__ == '__main__':
-    port = int(os.environ.get('PORT', 3000))
-    app.run(host='0.0.0.0', port=port, debug=True)
+# Flask app for local testing
+import os
+import json
+import base64
+from flask import Flask, request, jsonify
+from service.metrics import REGISTRY
+from service.clients import prewarm
+from service.s3_client import presign_cache_stats
+from service.dynamo_client import metadata_cache_stats
+from service.handler import (
+    upload_url_handler,
+    batch_upload_url_handler,
+    confirm_upload_handler,
+    batch_confirm_upload_handler,
+    multipart_upload_handler,
+    multipart_part_urls_handler,
+    complete_multipart_handler,
+    list_images_handler,
+    get_image_handler,
+    delete_image_handler,
+    bulk_delete_images_handler,
+    user_stats_handler,
+    encode_response
+)
+
+app = Flask(__name__)
+
+def create_event(payload=None, query_params=None, path_params=None):
+    """Create Lambda event from Flask request"""
+    event = {}
+    if payload:
+        event['body'] = json.dumps(payload)
+    if query_params:
+        event['queryStringParameters'] = query_params
+    if path_params:
+        event['pathParameters'] = path_params
+    event['headers'] = dict(request.headers)
+    return event
+
+def flask_response(event, res):
+    """Flask response from a Lambda response, gzip encoded when the client accepts it"""
+    res = encode_response(event, res)
+    body = base64.b64decode(res['body']) if res.get('isBase64Encoded') else res['body']
+    return (body, res['statusCode'], res.get('headers') or {})
+
+@app.route('/upload-url', methods=['POST'])
+def upload_url():
+    """Request presigned URL for image upload"""
+    event = create_event(payload=request.get_json())
+    res = upload_url_handler(event, None)
+    return flask_response(event, res)
+
+@app.route('/upload-urls', methods=['POST'])
+def upload_urls():
+    """Request presigned URLs for a batch of image uploads"""
+    event = create_event(payload=request.get_json())
+    res = batch_upload_url_handler(event, None)
+    return flask_response(event, res)
+
+@app.route('/confirm-upload', methods=['POST'])
+def confirm_upload():
+    """Confirm image upload completion"""
+    event = create_event(payload=request.get_json())
+    res = confirm_upload_handler(event, None)
+    return flask_response(event, res)
+
+@app.route('/confirm-uploads', methods=['POST'])
+def confirm_uploads():
+    """Confirm a batch of image uploads"""
+    event = create_event(payload=request.get_json())
+    res = batch_confirm_upload_handler(event, None)
+    return flask_response(event, res)
+
+@app.route('/multipart-upload', methods=['POST'])
+def multipart_upload():
+    """Start a multipart upload for a large image"""
+    event = create_event(payload=request.get_json())
+    res = multipart_upload_handler(event, None)
+    return flask_response(event, res)
+
+@app.route('/multipart-upload/parts', methods=['POST'])
+def multipart_part_urls():
+    """Presign fresh part URLs to resume a multipart upload"""
+    event = create_event(payload=request.get_json())
+    res = multipart_part_urls_handler(event, None)
+    return flask_response(event, res)
+
+@app.route('/multipart-upload/complete', methods=['POST'])
+def complete_multipart():
+    """Complete a multipart upload"""
+    event = create_event(payload=request.get_json())
+    res = complete_multipart_handler(event, None)
+    return flask_response(event, res)
+
+@app.route('/images', methods=['GET'])
+def list_images():
+    """List images with filters, paginated by limit and next_token"""
+    event = create_event(query_params=request.args.to_dict())
+    res = list_images_handler(event, None)
+    return flask_response(event, res)
+
+@app.route('/images/<user_id>/<image_id>', methods=['GET'])
+def get_image(user_id, image_id):
+    """Get single image details"""
+    event = create_event(path_params={'user_id': user_id, 'image_id': image_id})
+    res = get_image_handler(event, None)
+    return flask_response(event, res)
+
+@app.route('/images/<user_id>/<image_id>', methods=['DELETE'])
+def delete_image(user_id, image_id):
+    """Delete image"""
+    event = create_event(path_params={'user_id': user_id, 'image_id': image_id})
+    res = delete_image_handler(event, None)
+    return flask_response(event, res)
+
+@app.route('/images/bulk-delete', methods=['POST'])
+def bulk_delete_images():
+    """Delete many images, or all images of a user"""
+    event = create_event(payload=request.get_json())
+    res = bulk_delete_images_handler(event, None)
+    return flask_response(event, res)
+
+@app.route('/users/<user_id>/stats', methods=['GET'])
+def user_stats(user_id):
+    """Image count and total bytes of a user"""
+    event = create_event(path_params={'user_id': user_id})
+    res = user_stats_handler(event, None)
+    return flask_response(event, res)
+
+@app.route('/health', methods=['GET'])
+def health():
+    """Health check endpoint"""
+    return jsonify({'status': 'healthy', 'service': 'instagram-image-service'})
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """In-process cache counters"""
+    return jsonify({
+        'presign_cache': presign_cache_stats(),
+        'metadata_cache': metadata_cache_stats()
+    })
+
+@app.route('/metrics/prometheus', methods=['GET'])
+def prometheus_metrics():
+    """Handler and AWS call latency totals of sampled invocations, in Prometheus text format"""
+    return (REGISTRY.prometheus(), 200, {'Content-Type': 'text/plain; version=0.0.4'})
+
+if __name__ == '__main__':
+    # Build the shared clients before serving, so no request pays for them
+    prewarm()
+    port = int(os.environ.get('PORT', 3000))
+    app.run(host='0.0.0.0', port=port, debug=True)
@@ -0,0 +1,103 @@
+# ASGI app for the local/container server, serving the same routes as app.py
+import os
+import base64
+import asyncio
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route
+
+from service.clients import prewarm
+from service.metrics import REGISTRY
+from service.s3_client import presign_cache_stats
+from service.dynamo_client import metadata_cache_stats
+from service.handler import ROUTES, encode_response
+
+# Handlers are synchronous boto3 code: they run on a bounded pool so the event
+# loop never blocks, sized like the botocore connection pool by default
+MAX_WORKERS = int(os.environ.get('ASGI_MAX_WORKERS', os.environ.get('AWS_MAX_POOL_CONNECTIONS', '50')))
+EXECUTOR = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='handler')
+
+async def run_in_executor(func, *args):
+    """Run a blocking call on the handler pool"""
+    return await asyncio.get_running_loop().run_in_executor(EXECUTOR, func, *args)
+
+async def create_event(request, resource):
+    """Create Lambda event from an ASGI request"""
+    event = {
+        'httpMethod': request.method,
+        'resource': resource,
+        'path': request.url.path,
+        'headers': dict(request.headers)
+    }
+    body = await request.body()
+    if body:
+        event['body'] = body.decode()
+    if request.query_params:
+        event['queryStringParameters'] = dict(request.query_params)
+    if request.path_params:
+        event['pathParameters'] = dict(request.path_params)
+    return event
+
+def handler_endpoint(resource):
+    """Endpoint that runs the handler of a resource for the request method"""
+    async def endpoint(request):
+        # Starlette routes HEAD to every GET route: run the GET handler and drop its body
+        method = 'GET' if request.method == 'HEAD' else request.method
+        handler = ROUTES.get((method, resource))
+        if handler is None:
+            return JSONResponse({'error': f'Method {request.method} not allowed on {resource}'}, status_code=405)
+        event = await create_event(request, resource)
+        res = encode_response(event, await run_in_executor(handler, event, None))
+        body = base64.b64decode(res['body']) if res.get('isBase64Encoded') else res['body']
+        response = Response(body, status_code=res['statusCode'], headers=res.get('headers'))
+        if request.method == 'HEAD':
+            # Content-Length stays that of the GET body
+            response.body = b''
+        return response
+    return endpoint
+
+async def health(request):
+    """Health check endpoint"""
+    return JSONResponse({'status': 'healthy', 'service': 'instagram-image-service'})
+
+async def metrics(request):
+    """In-process cache counters"""
+    return JSONResponse({
+        'presign_cache': presign_cache_stats(),
+        'metadata_cache': metadata_cache_stats()
+    })
+
+async def prometheus_metrics(request):
+    """Handler and AWS call latency totals of sampled invocations, in Prometheus text format"""
+    return PlainTextResponse(REGISTRY.prometheus(), headers={'Content-Type': 'text/plain; version=0.0.4'})
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    """Build the shared clients before serving, so no request pays for them"""
+    await run_in_executor(prewarm)
+    yield
+
+def build_routes():
+    """One route per handler resource, plus health and metrics"""
+    methods = {}
+    for method, resource in ROUTES:
+        methods.setdefault(resource, []).append(method)
+    routes = [
+        Route('/health', health, methods=['GET']),
+        Route('/metrics', metrics, methods=['GET']),
+        Route('/metrics/prometheus', prometheus_metrics, methods=['GET'])
+    ]
+    for resource, allowed in methods.items():
+        routes.append(Route(resource, handler_endpoint(resource), methods=allowed))
+    return routes
+
+app = Starlette(routes=build_routes(), lifespan=lifespan)
+
+if __name__ == '__main__':
+    import uvicorn
+    
+    port = int(os.environ.get('PORT', 3000))
+    uvicorn.run(app, host='0.0.0.0', port=port, log_level='warning')
@@ -0,0 +1,96 @@
+# Cold-start benchmark: import time and first-invocation latency per handler
+#
+# Every measurement runs in a fresh interpreter talking to a local moto
+# server, so nothing is warm: not the imports, not the clients, not the
+# botocore model loaders.
+#
+#   python benchmarks/bench_cold_start.py [--runs 5] [--output cold_start.json]
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.common import start_moto_server, service_env, create_resources, BUCKET, TABLE
+
+CHILD = '''
+import sys, json, time
+t0 = time.perf_counter()
+import service.handler as handler
+t1 = time.perf_counter()
+boto3_loaded = 'boto3' in sys.modules
+res = getattr(handler, sys.argv[1])(json.loads(sys.argv[2]), None)
+t2 = time.perf_counter()
+print(json.dumps({
+    'import_ms': (t1 - t0) * 1000,
+    'first_call_ms': (t2 - t1) * 1000,
+    'status': res.get('statusCode'),
+    'boto3_at_import': boto3_loaded
+}))
+'''
+
+def handler_events():
+    """One representative event per HTTP handler"""
+    return {
+        'upload_url_handler': {'body': json.dumps(
+            {'user_id': 'bench', 'filename': 'a.jpg', 'content_type': 'image/jpeg'})},
+        'list_images_handler': {'queryStringParameters': {'user_id': 'bench', 'limit': '50'}},
+        'get_image_handler': {'pathParameters': {'user_id': 'bench', 'image_id': 'img-0'}},
+        'confirm_upload_handler': {'body': json.dumps({'user_id': 'bench', 'image_id': 'img-1'})},
+        'delete_image_handler': {'pathParameters': {'user_id': 'bench', 'image_id': 'missing'}}
+    }
+
+def seed(s3, ddb):
+    """A user with a few uploaded images"""
+    table = ddb.Table(TABLE)
+    for i in range(50):
+        key = f'bench/img-{i}.jpg'
+        s3.put_object(Bucket=BUCKET, Key=key, Body=b'x' * 1024)
+        table.put_item(Item={
+            'user_id': 'bench', 'image_id': f'img-{i}', 's3_key': key, 'status': 'uploaded',
+            'created_at': f'2024-01-01T00:00:{i:02d}Z', 'tags': []
+        })
+
+def measure(name, event, env):
+    """Run one handler once in a fresh interpreter"""
+    out = subprocess.run(
+        [sys.executable, '-c', CHILD, name, json.dumps(event)],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True
+    )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+    
+    server, endpoint_url = start_moto_server()
+    try:
+        seed(*create_resources(endpoint_url))
+        env = service_env(endpoint_url)
+        results = {}
+        for name, event in handler_events().items():
+            runs = [measure(name, event, env) for _ in range(args.runs)]
+            results[name] = {
+                'import_ms': statistics.median(r['import_ms'] for r in runs),
+                'first_call_ms': statistics.median(r['first_call_ms'] for r in runs),
+                'status': runs[-1]['status'],
+                'boto3_at_import': any(r['boto3_at_import'] for r in runs)
+            }
+    finally:
+        server.terminate()
+    
+    print(f'{"handler":28s} {"import ms":>10s} {"first call ms":>14s} {"status":>7s}')
+    for name, r in results.items():
+        print(f'{name:28s} {r["import_ms"]:10.1f} {r["first_call_ms"]:14.1f} {r["status"]:7d}')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'runs': args.runs, 'handlers': results}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
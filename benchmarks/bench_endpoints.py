@@ -0,0 +1,333 @@
+# Endpoint benchmark: every handler, called directly and through app.py, against moto server
+#
+# Seeds a moto server with users holding 10, 1k and 50k images (varied tags,
+# dates and statuses), then drives each endpoint sequentially:
+#
+#   direct  events go straight to service.handler (via dispatch, or the S3
+#           event handler for upload notifications)
+#   flask   requests go through app.py with Flask's test client
+#
+# Every scenario reports p50/p95/p99 latency, requests/sec, non-2xx
+# responses and the peak memory allocated by a single request. Results are
+# written as JSON so two commits can be compared with --baseline.
+#
+#   python benchmarks/bench_endpoints.py [--sizes 10,1000,50000] [--iterations 30]
+#       [--modes direct,flask] [--only list] [--output endpoints.json] [--baseline old.json]
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import resource
+import subprocess
+import tracemalloc
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.common import start_moto_server, service_env, create_resources, percentile, BUCKET, TABLE
+
+# Scenarios without an HTTP route, only run in direct mode
+DIRECT_ONLY = {'s3_event'}
+
+TAGS = ['beach', 'sunset', 'family', 'food', 'travel', 'pets', 'city', 'nature', 'party', 'work']
+SEED_CHUNK = 500
+
+def user_for(size):
+    """User id of the seeded user with size images"""
+    return f'user_{size}'
+
+def seed_user(size, rng):
+    """Write size images with realistic metadata for one user"""
+    from service.dynamo_client import batch_put_image_metadata
+    
+    user_id = user_for(size)
+    start = datetime(2024, 1, 1)
+    items = []
+    for i in range(size):
+        image_id = f'img-{i:06d}'
+        items.append({
+            'user_id': user_id,
+            'image_id': image_id,
+            'filename': f'IMG_{i:06d}.jpg',
+            'content_type': 'image/jpeg',
+            's3_key': f'{user_id}/{image_id}.jpg',
+            'status': 'uploaded' if rng.random() < 0.9 else 'pending',
+            'created_at': (start + timedelta(minutes=i * 10)).isoformat() + 'Z',
+            'caption': rng.choice(['', 'Sunset at the beach', 'Family dinner', 'Weekend hike']),
+            'tags': rng.sample(TAGS, rng.choice([0, 1, 1, 2, 3])),
+            'file_size': rng.randint(200_000, 8_000_000)
+        })
+    chunks = [items[i:i + SEED_CHUNK] for i in range(0, len(items), SEED_CHUNK)]
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        failed = sum(len(f) for f in pool.map(lambda chunk: batch_put_image_metadata(TABLE, chunk), chunks))
+    if failed:
+        raise RuntimeError(f'{failed} images of {user_id} could not be seeded')
+
+def request(method, path, query=None, body=None):
+    """A request both modes can send"""
+    return {'method': method, 'path': path, 'query': query, 'body': body}
+
+def pending_images(s3, count, user_id='bench_writer', with_object=True):
+    """Create pending uploads through the handler, optionally with their file in S3"""
+    from service.handler import batch_upload_url_handler
+    
+    ids = []
+    for start in range(0, count, 100):
+        files = [{'filename': 'a.jpg', 'content_type': 'image/jpeg', 'tags': ['beach']}
+                 for _ in range(min(100, count - start))]
+        res = batch_upload_url_handler({'body': json.dumps({'user_id': user_id, 'files': files})}, None)
+        ids.extend(u['image_id'] for u in json.loads(res['body'])['uploads'])
+    if with_object:
+        for image_id in ids:
+            s3.put_object(Bucket=BUCKET, Key=f'{user_id}/{image_id}.jpg', Body=b'x' * 2048)
+    return user_id, ids
+
+def scenarios(sizes, s3):
+    """Name -> setup(n) returning n requests, run in this order"""
+    big = max(sizes)
+    
+    def upload_url(n):
+        body = {'user_id': 'bench_writer', 'filename': 'a.jpg', 'content_type': 'image/jpeg', 'tags': ['beach']}
+        return [request('POST', '/upload-url', body=body) for _ in range(n)]
+    
+    def upload_urls(n):
+        files = [{'filename': f'{i}.jpg', 'content_type': 'image/jpeg'} for i in range(20)]
+        return [request('POST', '/upload-urls', body={'user_id': 'bench_writer', 'files': files}) for _ in range(n)]
+    
+    def confirm_upload(n):
+        user_id, ids = pending_images(s3, n)
+        return [request('POST', '/confirm-upload', body={'user_id': user_id, 'image_id': i}) for i in ids]
+    
+    def confirm_uploads(n):
+        user_id, ids = pending_images(s3, n * 10)
+        return [request('POST', '/confirm-uploads', body={'user_id': user_id, 'image_ids': ids[i:i + 10]})
+                for i in range(0, len(ids), 10)]
+    
+    def multipart_upload(n):
+        body = {'user_id': 'bench_writer', 'filename': 'raw.jpg', 'content_type': 'image/jpeg', 'part_count': 8}
+        return [request('POST', '/multipart-upload', body=body) for _ in range(n)]
+    
+    def multipart_parts(n):
+        from service.handler import multipart_upload_handler
+        
+        body = {'user_id': 'bench_writer', 'filename': 'raw.jpg', 'content_type': 'image/jpeg', 'part_count': 8}
+        image_id = json.loads(multipart_upload_handler({'body': json.dumps(body)}, None)['body'])['image_id']
+        parts = {'user_id': 'bench_writer', 'image_id': image_id, 'part_numbers': [5, 6, 7, 8]}
+        return [request('POST', '/multipart-upload/parts', body=parts) for _ in range(n)]
+    
+    def complete_multipart(n):
+        from service.handler import multipart_upload_handler
+        from service.dynamo_client import get_image_metadata
+        
+        requests = []
+        for _ in range(n):
+            body = {'user_id': 'bench_writer', 'filename': 'raw.jpg', 'content_type': 'image/jpeg', 'part_count': 1}
+            image_id = json.loads(multipart_upload_handler({'body': json.dumps(body)}, None)['body'])['image_id']
+            item = get_image_metadata(TABLE, 'bench_writer', image_id)
+            etag = s3.upload_part(Bucket=BUCKET, Key=item['s3_key'], UploadId=item['upload_id'],
+                                  PartNumber=1, Body=b'x' * 4096)['ETag']
+            parts = [{'part_number': 1, 'etag': etag}]
+            requests.append(request('POST', '/multipart-upload/complete',
+                                    body={'user_id': 'bench_writer', 'image_id': image_id, 'parts': parts}))
+        return requests
+    
+    def get_image(n):
+        rng = random.Random(1)
+        return [request('GET', f'/images/{user_for(big)}/img-{rng.randrange(big):06d}') for _ in range(n)]
+    
+    def delete_image(n):
+        user_id, ids = pending_images(s3, n)
+        return [request('DELETE', f'/images/{user_id}/{i}') for i in ids]
+    
+    def bulk_delete(n):
+        user_id, ids = pending_images(s3, n * 50)
+        return [request('POST', '/images/bulk-delete', body={'user_id': user_id, 'image_ids': ids[i:i + 50]})
+                for i in range(0, len(ids), 50)]
+    
+    def s3_event(n):
+        user_id, ids = pending_images(s3, n)
+        return [{'s3_event': {'Records': [{
+            'eventSource': 'aws:s3',
+            'eventName': 'ObjectCreated:Put',
+            's3': {'bucket': {'name': BUCKET}, 'object': {'key': f'{user_id}/{i}.jpg', 'size': 2048}}
+        }]}} for i in ids]
+    
+    result = {
+        'upload_url': upload_url,
+        'upload_urls_20': upload_urls,
+        'confirm_upload': confirm_upload,
+        'confirm_uploads_10': confirm_uploads,
+        'multipart_upload': multipart_upload,
+        'multipart_parts': multipart_parts,
+        'complete_multipart': complete_multipart,
+        'get_image': get_image,
+        'delete_image': delete_image,
+        'bulk_delete_50': bulk_delete,
+        's3_event': s3_event
+    }
+    for size in sizes:
+        user_id = user_for(size)
+        listings = {
+            f'list_{size}': {'user_id': user_id, 'limit': '100'},
+            f'list_{size}_tag': {'user_id': user_id, 'tag': 'beach', 'limit': '100'},
+            f'list_{size}_desc_range': {'user_id': user_id, 'order': 'desc', 'limit': '100',
+                                        'start_date': '2024-01-02T00:00:00Z'},
+            f'list_{size}_fields': {'user_id': user_id, 'fields': 'image_id,created_at', 'limit': '1000'},
+            f'count_{size}': {'user_id': user_id, 'count_only': 'true'}
+        }
+        for name, query in listings.items():
+            result[name] = lambda n, query=query: [request('GET', '/images', query=query) for _ in range(n)]
+        # One GetItem on the stats row, against count_{size} which reads the whole partition
+        result[f'stats_{size}'] = lambda n, user_id=user_id: [request('GET', f'/users/{user_id}/stats')
+                                                             for _ in range(n)]
+    return result
+
+def send_direct(req):
+    """Call the handler in-process, returns the status code"""
+    from service.handler import dispatch, s3_event_handler
+    
+    if 's3_event' in req:
+        res = s3_event_handler(req['s3_event'], None)
+        return 200 if res['updated'] else 404
+    event = {'httpMethod': req['method'], 'path': req['path'], 'queryStringParameters': req['query']}
+    if req['body'] is not None:
+        event['body'] = json.dumps(req['body'])
+    return dispatch(event, None)['statusCode']
+
+def flask_sender():
+    """Send requests through app.py with Flask's test client"""
+    from app import app
+    
+    client = app.test_client()
+    
+    def send(req):
+        res = client.open(req['path'], method=req['method'], query_string=req['query'], json=req['body'])
+        return res.status_code
+    return send
+
+def reset_caches():
+    """Start every scenario with cold in-process caches"""
+    from service import dynamo_client, s3_client
+    
+    dynamo_client.reset_metadata_cache()
+    s3_client.DOWNLOAD_URL_CACHE.clear()
+
+def run_scenario(send, requests, memory_samples):
+    """Send the requests one after another and summarize them"""
+    reset_caches()
+    latencies = []
+    errors = 0
+    started = time.perf_counter()
+    for req in requests[memory_samples:]:
+        start = time.perf_counter()
+        status = send(req)
+        latencies.append((time.perf_counter() - start) * 1000)
+        if status >= 300:
+            errors += 1
+    elapsed = time.perf_counter() - started
+    
+    # Peak memory of single requests, measured apart since tracing slows everything down
+    peak = 0
+    for req in requests[:memory_samples]:
+        tracemalloc.start()
+        send(req)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'peak_kb': round(peak / 1024, 1)
+    }
+
+def git_commit():
+    """Current commit of the tree being benchmarked, None outside git"""
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                             capture_output=True, text=True, check=True)
+        return out.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline_path):
+    """Print the change of p50/p95 against a previous results file"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)['results']
+    print(f'\nchange against {baseline_path}:')
+    for mode, scenarios in results.items():
+        for name, r in scenarios.items():
+            old = baseline.get(mode, {}).get(name)
+            if not old or not old['p50_ms'] or not old['p95_ms']:
+                continue
+            p50 = (r['p50_ms'] / old['p50_ms'] - 1) * 100
+            p95 = (r['p95_ms'] / old['p95_ms'] - 1) * 100
+            print(f'{mode:7s} {name:28s} p50 {p50:+7.1f}%  p95 {p95:+7.1f}%')
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark every endpoint against moto server')
+    parser.add_argument('--sizes', default='10,1000,50000', help='images per seeded user')
+    parser.add_argument('--iterations', type=int, default=30, help='timed requests per scenario')
+    parser.add_argument('--memory-samples', type=int, default=3, help='extra requests traced for peak memory')
+    parser.add_argument('--modes', default='direct,flask')
+    parser.add_argument('--only', help='run only scenarios whose name contains this')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--baseline', help='compare with a previous --output file')
+    args = parser.parse_args()
+    sizes = [int(s) for s in args.sizes.split(',')]
+    
+    server, endpoint_url = start_moto_server()
+    try:
+        os.environ.update(service_env(endpoint_url))
+        s3, _ = create_resources(endpoint_url)
+        started = time.perf_counter()
+        rng = random.Random(42)
+        for size in sizes:
+            seed_user(size, rng)
+        print(f'seeded {sum(sizes)} images in {time.perf_counter() - started:.1f}s')
+        
+        senders = {'direct': send_direct}
+        if 'flask' in args.modes:
+            senders['flask'] = flask_sender()
+        results = {}
+        for mode in args.modes.split(','):
+            results[mode] = {}
+            for name, setup in scenarios(sizes, s3).items():
+                if (args.only and args.only not in name) or (mode != 'direct' and name in DIRECT_ONLY):
+                    continue
+                summary = run_scenario(senders[mode], setup(args.iterations + args.memory_samples),
+                                       args.memory_samples)
+                results[mode][name] = summary
+                print(f'{mode:7s} {name:28s} p50 {summary["p50_ms"]:8.2f}  p95 {summary["p95_ms"]:8.2f}  '
+                      f'p99 {summary["p99_ms"]:8.2f} ms  {summary["rps"]:8.1f} rps  '
+                      f'{summary["peak_kb"]:8.1f} KB  errors {summary["errors"]}')
+    finally:
+        server.terminate()
+    
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': datetime.utcnow().isoformat() + 'Z',
+            'python': platform.python_version(),
+            'sizes': sizes,
+            'iterations': args.iterations,
+            'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        },
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        compare(results, args.baseline)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+# Throughput benchmark: the resize stage of the derivative pipeline
+#
+# Renders the configured sizes of synthetic camera-sized JPEGs. The naive
+# case decodes every original at full resolution and resizes each size from
+# it; service.derivatives.resize decodes at a reduced JPEG scale and chains
+# the sizes. Both are run serially and on process pools of growing size.
+#
+#   python benchmarks/bench_resize.py [--images 48] [--width 4032] [--height 3024] [--workers 1,2,4]
+import io
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageFilter
+
+from service.derivatives import resize, DERIVATIVE_SIZES, DERIVATIVE_QUALITY
+
+def make_jpeg(width, height, seed):
+    """A noisy, blurred JPEG that compresses like a photo"""
+    noise = Image.effect_noise((width // 8, height // 8), 64 + seed % 32).convert('RGB')
+    image = noise.resize((width, height), Image.BILINEAR).filter(ImageFilter.GaussianBlur(2))
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=90)
+    return buffer.getvalue()
+
+def resize_naive(data, sizes, quality=DERIVATIVE_QUALITY):
+    """Full decode, then every size resized from the original"""
+    renditions = {}
+    with Image.open(io.BytesIO(data)) as original:
+        original = original.convert('RGB')
+        for name, edge in sizes.items():
+            image = original.copy()
+            image.thumbnail((edge, edge), Image.LANCZOS, reducing_gap=None)
+            buffer = io.BytesIO()
+            image.save(buffer, 'JPEG', quality=quality, optimize=True)
+            renditions[name] = (buffer.getvalue(), image.width, image.height)
+    return renditions
+
+def run(func, originals, workers):
+    """Render every original, returns elapsed seconds"""
+    start = time.perf_counter()
+    if workers == 0:
+        for data in originals:
+            func(data, DERIVATIVE_SIZES)
+    else:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            # Start the workers before timing, like the long-lived pool in the service
+            list(pool.map(abs, range(workers)))
+            start = time.perf_counter()
+            list(pool.map(func, originals, [DERIVATIVE_SIZES] * len(originals)))
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--images', type=int, default=48)
+    parser.add_argument('--width', type=int, default=4032)
+    parser.add_argument('--height', type=int, default=3024)
+    parser.add_argument('--workers', default='1,2,4', help='process pool sizes to try')
+    args = parser.parse_args()
+    
+    originals = [make_jpeg(args.width, args.height, i) for i in range(args.images)]
+    megapixels = args.width * args.height / 1e6
+    print(f'{args.images} x {args.width}x{args.height} JPEG ({sum(map(len, originals)) / len(originals) / 1024:.0f} KB avg), '
+          f'sizes {DERIVATIVE_SIZES}, {os.cpu_count()} CPUs')
+    
+    baseline = None
+    for workers in [0] + [int(w) for w in args.workers.split(',')]:
+        for name, func in (('naive', resize_naive), ('resize', resize)):
+            elapsed = run(func, originals, workers)
+            rate = args.images / elapsed
+            baseline = baseline or rate
+            mode = 'serial' if workers == 0 else f'{workers} processes'
+            print(f'{name:7s} {mode:12s} {rate:8.1f} images/s  {rate * megapixels:8.1f} MP/s  {rate / baseline:5.1f}x')
+
+if __name__ == '__main__':
+    main()
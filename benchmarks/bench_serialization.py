@@ -0,0 +1,69 @@
+# Micro-benchmark: response serialization of a large image listing
+#
+# Compares the old path (recursive convert_decimals copy + json.dumps) with
+# service.serialization.dumps on each available backend.
+#
+#   python benchmarks/bench_serialization.py [--items 1000] [--repeat 50]
+import os
+import sys
+import json
+import argparse
+import timeit
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from service import serialization
+
+def convert_decimals(obj):
+    """The previous handler.convert_decimals, kept here as the baseline"""
+    if isinstance(obj, Decimal):
+        return int(obj) if obj % 1 == 0 else float(obj)
+    elif isinstance(obj, dict):
+        return {k: convert_decimals(v) for k, v in obj.items()}
+    elif isinstance(obj, list):
+        return [convert_decimals(item) for item in obj]
+    else:
+        return obj
+
+def make_listing(count):
+    """A GET /images body shaped like DynamoDB resource output"""
+    images = [
+        {
+            'user_id': 'john',
+            'image_id': f'5f1c2a9e-0000-4000-8000-{i:012d}',
+            'filename': f'IMG_{i:05d}.jpg',
+            'content_type': 'image/jpeg',
+            's3_key': f'john/5f1c2a9e-0000-4000-8000-{i:012d}.jpg',
+            'status': 'uploaded',
+            'created_at': '2024-01-01T12:00:00.000000Z',
+            'caption': 'Sunset at the beach',
+            'tags': ['vacation', 'beach'],
+            'file_size': Decimal(1024000 + i),
+            'download_url': 'http://localhost:4566/instagram-images-local/john/x.jpg?X-Amz-Signature=' + 'a' * 64
+        }
+        for i in range(count)
+    ]
+    return {'count': count, 'images': images, 'next_token': None}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--items', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+    
+    body = make_listing(args.items)
+    cases = {'convert_decimals + json.dumps': lambda: json.dumps(convert_decimals(body))}
+    cases['serialization.dumps (json)'] = lambda: serialization.dumps(body, 'json')
+    if serialization.orjson:
+        cases['serialization.dumps (orjson)'] = lambda: serialization.dumps(body, 'orjson')
+    
+    baseline = None
+    print(f'{args.items} items, best of 5 x {args.repeat} runs')
+    for name, case in cases.items():
+        best = min(timeit.repeat(case, number=args.repeat, repeat=5)) / args.repeat
+        baseline = baseline or best
+        print(f'{name:32s} {best * 1000:8.3f} ms  {baseline / best:5.1f}x')
+
+if __name__ == '__main__':
+    main()
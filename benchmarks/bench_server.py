@@ -0,0 +1,149 @@
+# Load benchmark of the local servers: Flask (app.py) against ASGI (asgi.py)
+#
+# Both servers run as subprocesses against the same local moto server and
+# are driven by a closed-loop load generator: --concurrency workers, each on
+# its own keep-alive connection, sending a mix of list, get and upload-url
+# requests for --duration seconds.
+#
+#   python benchmarks/bench_server.py [--concurrency 32] [--duration 10] [--output server.json]
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import subprocess
+import http.client
+import threading
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.common import (
+    start_moto_server, service_env, create_resources, free_port, wait_for_http, percentile, TABLE
+)
+
+# How each server mode is started, with {port} filled in
+SERVERS = {
+    'flask': [sys.executable, '-c', 'from app import app; app.run(host="127.0.0.1", port={port}, threaded=True)'],
+    'asgi': [sys.executable, '-m', 'uvicorn', 'asgi:app', '--host', '127.0.0.1', '--port', '{port}',
+             '--log-level', 'warning']
+}
+
+USER_ID = 'bench'
+
+def seed(s3, ddb, count):
+    """A user with count uploaded images"""
+    with ddb.Table(TABLE).batch_writer() as batch:
+        for i in range(count):
+            key = f'{USER_ID}/img-{i}.jpg'
+            batch.put_item(Item={
+                'user_id': USER_ID, 'image_id': f'img-{i}', 's3_key': key, 'status': 'uploaded',
+                'created_at': f'2024-01-01T00:{i // 60 % 60:02d}:{i % 60:02d}Z', 'tags': []
+            })
+
+def request_mix(images):
+    """Pick the next request as (name, method, path, body)"""
+    roll = random.random()
+    if roll < 0.5:
+        return 'list', 'GET', f'/images?user_id={USER_ID}&limit=50', None
+    if roll < 0.8:
+        return 'get', 'GET', f'/images/{USER_ID}/img-{random.randrange(images)}', None
+    body = json.dumps({'user_id': USER_ID, 'filename': 'a.jpg', 'content_type': 'image/jpeg'})
+    return 'upload_url', 'POST', '/upload-url', body
+
+def worker(port, images, deadline, results, lock):
+    """Send requests on one keep-alive connection until the deadline"""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    samples = []
+    errors = 0
+    while time.monotonic() < deadline:
+        name, method, path, body = request_mix(images)
+        start = time.perf_counter()
+        try:
+            conn.request(method, path, body=body, headers={'Content-Type': 'application/json'})
+            res = conn.getresponse()
+            res.read()
+            if res.status >= 500:
+                errors += 1
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+            continue
+        samples.append((name, (time.perf_counter() - start) * 1000))
+    conn.close()
+    with lock:
+        results['samples'].extend(samples)
+        results['errors'] += errors
+
+def run_load(port, images, concurrency, duration):
+    """Drive the server with concurrency workers, returns the latency summary"""
+    results = {'samples': [], 'errors': 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+    threads = [
+        threading.Thread(target=worker, args=(port, images, deadline, results, lock))
+        for _ in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    latencies = [ms for _, ms in results['samples']]
+    summary = {
+        'requests': len(latencies),
+        'errors': results['errors'],
+        'rps': len(latencies) / duration,
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'by_route': {}
+    }
+    for name in sorted({name for name, _ in results['samples']}):
+        route = [ms for n, ms in results['samples'] if n == name]
+        summary['by_route'][name] = {'requests': len(route), 'p50_ms': percentile(route, 50),
+                                     'p95_ms': percentile(route, 95)}
+    return summary
+
+def bench_server(mode, env, args):
+    """Start one server mode, warm it up and load it"""
+    port = free_port()
+    cmd = [part.format(port=port) for part in SERVERS[mode]]
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_http(f'http://127.0.0.1:{port}/health')
+        run_load(port, args.images, args.concurrency, 1)
+        return run_load(port, args.images, args.concurrency, args.duration)
+    finally:
+        proc.terminate()
+        proc.wait()
+
+def main():
+    parser = argparse.ArgumentParser(description='Flask vs ASGI load benchmark against moto server')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--images', type=int, default=500)
+    parser.add_argument('--modes', default='flask,asgi')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+    
+    server, endpoint_url = start_moto_server()
+    try:
+        seed(*create_resources(endpoint_url), args.images)
+        env = service_env(endpoint_url)
+        results = {mode: bench_server(mode, env, args) for mode in args.modes.split(',')}
+    finally:
+        server.terminate()
+    
+    print(f'{"mode":8s} {"rps":>8s} {"p50 ms":>8s} {"p95 ms":>8s} {"p99 ms":>8s} {"errors":>7s}')
+    for mode, r in results.items():
+        print(f'{mode:8s} {r["rps"]:8.1f} {r["p50_ms"]:8.1f} {r["p95_ms"]:8.1f} {r["p99_ms"]:8.1f} {r["errors"]:7d}')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'concurrency': args.concurrency, 'duration': args.duration,
+                       'images': args.images, 'modes': results}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
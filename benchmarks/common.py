@@ -0,0 +1,125 @@
+# Shared setup for benchmarks: a moto server with the service's bucket and tables
+import os
+import sys
+import time
+import socket
+import subprocess
+import urllib.request
+
+TABLE = 'Images'
+BUCKET = 'instagram-images-local'
+
+def free_port():
+    """An unused local TCP port"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_moto_server():
+    """Start moto server in its own process, so it does not share a GIL with
+    the benchmark; returns (process, endpoint_url)"""
+    port = free_port()
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'moto.server', '-H', '127.0.0.1', '-p', str(port)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    endpoint_url = f'http://127.0.0.1:{port}'
+    try:
+        wait_for_http(f'{endpoint_url}/moto-api/')
+    except RuntimeError:
+        proc.terminate()
+        raise
+    return proc, endpoint_url
+
+def wait_for_http(url, timeout=30):
+    """Poll url until it answers, RuntimeError after timeout seconds"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'{url} did not come up within {timeout}s')
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    rank = max(1, -(-len(ordered) * pct // 100))
+    return ordered[int(rank) - 1]
+
+def service_env(endpoint_url):
+    """Environment for a service process talking to the moto server"""
+    env = dict(os.environ)
+    env.update({
+        'AWS_ENDPOINT_URL': endpoint_url,
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        'AWS_ACCESS_KEY_ID': 'test',
+        'AWS_SECRET_ACCESS_KEY': 'test',
+        'S3_BUCKET': BUCKET,
+        'DDB_TABLE': TABLE,
+        # The request bodies are not images, and rendering is benchmarked by bench_resize.py
+        'DERIVATIVES_MODE': 'off'
+    })
+    return env
+
+def _create_keyed_table(ddb, table_name, hash_key):
+    """Create a table keyed on hash_key/image_id with the created_at index, as deploy.sh does"""
+    ddb.create_table(
+        TableName=table_name,
+        AttributeDefinitions=[
+            {'AttributeName': hash_key, 'AttributeType': 'S'},
+            {'AttributeName': 'image_id', 'AttributeType': 'S'},
+            {'AttributeName': 'created_at', 'AttributeType': 'S'}
+        ],
+        KeySchema=[
+            {'AttributeName': hash_key, 'KeyType': 'HASH'},
+            {'AttributeName': 'image_id', 'KeyType': 'RANGE'}
+        ],
+        LocalSecondaryIndexes=[{
+            'IndexName': 'created_at-index',
+            'KeySchema': [
+                {'AttributeName': hash_key, 'KeyType': 'HASH'},
+                {'AttributeName': 'created_at', 'KeyType': 'RANGE'}
+            ],
+            'Projection': {'ProjectionType': 'ALL'}
+        }],
+        BillingMode='PAY_PER_REQUEST'
+    )
+
+def _create_content_table(ddb, table_name):
+    """Create the content hash index table, keyed on user_id/sha256"""
+    ddb.create_table(
+        TableName=table_name,
+        AttributeDefinitions=[
+            {'AttributeName': 'user_id', 'AttributeType': 'S'},
+            {'AttributeName': 'sha256', 'AttributeType': 'S'}
+        ],
+        KeySchema=[
+            {'AttributeName': 'user_id', 'KeyType': 'HASH'},
+            {'AttributeName': 'sha256', 'KeyType': 'RANGE'}
+        ],
+        BillingMode='PAY_PER_REQUEST'
+    )
+
+def create_resources(endpoint_url):
+    """Create the bucket and tables on the moto server, returns (s3 client, dynamodb resource)"""
+    import boto3
+    
+    kwargs = {'endpoint_url': endpoint_url, 'region_name': 'us-east-1',
+              'aws_access_key_id': 'test', 'aws_secret_access_key': 'test'}
+    s3 = boto3.client('s3', **kwargs)
+    ddb = boto3.resource('dynamodb', **kwargs)
+    s3.create_bucket(Bucket=BUCKET)
+    _create_keyed_table(ddb, TABLE, 'user_id')
+    _create_keyed_table(ddb, f'{TABLE}-tags', 'user_tag')
+    _create_content_table(ddb, f'{TABLE}-content')
+    ddb.create_table(
+        TableName=f'{TABLE}-stats',
+        AttributeDefinitions=[{'AttributeName': 'user_id', 'AttributeType': 'S'}],
+        KeySchema=[{'AttributeName': 'user_id', 'KeyType': 'HASH'}],
+        BillingMode='PAY_PER_REQUEST'
+    )
+    return s3, ddb
@@ -4,8 +4,19 @@
 AWS="aws --endpoint-url=http://localhost:4566"
 BUCKET=instagram-images-local
 TABLE=Images
+TAG_TABLE=Images-tags
+CONTENT_TABLE=Images-content
+STATS_TABLE=Images-stats
 LAMBDA_NAME=instagram-image-service-lambda
+EVENTS_LAMBDA_NAME=instagram-image-events-lambda
+REAPER_LAMBDA_NAME=instagram-image-reaper-lambda
+STATS_LAMBDA_NAME=instagram-image-stats-lambda
 ROLE_NAME=lambda-basic-execution
+# Lambda freezes after returning, so renditions are made by the S3 event Lambda; it has no
+# /dev/shm for a process pool, so it resizes in-process, holding the original (up to
+# DERIVATIVE_MAX_BYTES) and its decoded pixels in memory
+LAMBDA_ENV='Variables={DERIVATIVES_MODE=event,DERIVATIVE_WORKERS=0,DERIVATIVE_MAX_BYTES=20971520}'
+EVENTS_LAMBDA_MEMORY=1536
 
 echo "Deploying Instagram Image Service to LocalStack..."
 
@@ -15,49 +26,150 @@ $AWS s3api create-bucket --bucket $BUCKET || true
 
 echo "Creating DynamoDB table..."
 $AWS dynamodb create-table --table-name $TABLE \
-  --attribute-definitions AttributeName=user_id,AttributeType=S AttributeName=image_id,AttributeType=S \
+  --attribute-definitions AttributeName=user_id,AttributeType=S AttributeName=image_id,AttributeType=S AttributeName=created_at,AttributeType=S \
   --key-schema AttributeName=user_id,KeyType=HASH AttributeName=image_id,KeyType=RANGE \
+  --local-secondary-indexes 'IndexName=created_at-index,KeySchema=[{AttributeName=user_id,KeyType=HASH},{AttributeName=created_at,KeyType=RANGE}],Projection={ProjectionType=ALL}' \
   --provisioned-throughput ReadCapacityUnits=5,WriteCapacityUnits=5 || true
 
-# 2) Package lambda
+echo "Creating DynamoDB tag index table..."
+$AWS dynamodb create-table --table-name $TAG_TABLE \
+  --attribute-definitions AttributeName=user_tag,AttributeType=S AttributeName=image_id,AttributeType=S AttributeName=created_at,AttributeType=S \
+  --key-schema AttributeName=user_tag,KeyType=HASH AttributeName=image_id,KeyType=RANGE \
+  --local-secondary-indexes 'IndexName=created_at-index,KeySchema=[{AttributeName=user_tag,KeyType=HASH},{AttributeName=created_at,KeyType=RANGE}],Projection={ProjectionType=ALL}' \
+  --provisioned-throughput ReadCapacityUnits=5,WriteCapacityUnits=5 || true
+
+echo "Creating DynamoDB content hash index table..."
+$AWS dynamodb create-table --table-name $CONTENT_TABLE \
+  --attribute-definitions AttributeName=user_id,AttributeType=S AttributeName=sha256,AttributeType=S \
+  --key-schema AttributeName=user_id,KeyType=HASH AttributeName=sha256,KeyType=RANGE \
+  --provisioned-throughput ReadCapacityUnits=5,WriteCapacityUnits=5 || true
+
+echo "Creating DynamoDB per-user stats table..."
+$AWS dynamodb create-table --table-name $STATS_TABLE \
+  --attribute-definitions AttributeName=user_id,AttributeType=S \
+  --key-schema AttributeName=user_id,KeyType=HASH \
+  --provisioned-throughput ReadCapacityUnits=5,WriteCapacityUnits=5 || true
+
+echo "Enabling TTL on pending uploads..."
+$AWS dynamodb update-time-to-live --table-name $TABLE --time-to-live-specification Enabled=true,AttributeName=expires_at || true
+$AWS dynamodb update-time-to-live --table-name $TAG_TABLE --time-to-live-specification Enabled=true,AttributeName=expires_at || true
+
+# 2) Package lambda with Pillow for the derivative renditions (boto3 ships with the runtime);
+# pip picks the newest Pillow wheel built for the Lambda runtime and architecture
 echo "Packaging Lambda function..."
-rm -f /tmp/handler.zip
-zip -r /tmp/handler.zip service -x "*/__pycache__/*"
+BUILD_DIR=/tmp/handler-build
+rm -rf $BUILD_DIR /tmp/handler.zip
+pip install --quiet --target $BUILD_DIR --platform manylinux2014_x86_64 --implementation cp --python-version 3.8 --only-binary=:all: Pillow
+cp -r service $BUILD_DIR/
+(cd $BUILD_DIR && zip -qr /tmp/handler.zip . -x "*/__pycache__/*")
 
 # 3) Create IAM role
 echo "Creating IAM role..."
 $AWS iam create-role --role-name $ROLE_NAME --assume-role-policy-document '{"Version": "2012-10-17","Statement": [{"Action": "sts:AssumeRole","Principal": {"Service": "lambda.amazonaws.com"},"Effect": "Allow","Sid": ""}]}' || true
 
-# 4) Create or update lambda
+# 4) Create or update lambda; every API route goes through the dispatch router
 echo "Creating/updating Lambda function..."
 if $AWS lambda list-functions | grep -q $LAMBDA_NAME; then
   $AWS lambda update-function-code --function-name $LAMBDA_NAME --zip-file fileb:///tmp/handler.zip
+  $AWS lambda update-function-configuration --function-name $LAMBDA_NAME --handler service.handler.dispatch --environment "$LAMBDA_ENV"
+else
+  $AWS lambda create-function --function-name $LAMBDA_NAME --runtime python3.8 --handler service.handler.dispatch --environment "$LAMBDA_ENV" --zip-file fileb:///tmp/handler.zip --role arn:aws:iam::000000000000:role/$ROLE_NAME
+fi
+
+# 4b) Create or update the S3 event lambda that confirms uploads
+echo "Creating/updating S3 event Lambda function..."
+if $AWS lambda list-functions | grep -q $EVENTS_LAMBDA_NAME; then
+  $AWS lambda update-function-code --function-name $EVENTS_LAMBDA_NAME --zip-file fileb:///tmp/handler.zip
+  $AWS lambda update-function-configuration --function-name $EVENTS_LAMBDA_NAME --timeout 60 --memory-size $EVENTS_LAMBDA_MEMORY --environment "$LAMBDA_ENV"
 else
-  $AWS lambda create-function --function-name $LAMBDA_NAME --runtime python3.8 --handler service.handler.upload_url_handler --zip-file fileb:///tmp/handler.zip --role arn:aws:iam::000000000000:role/$ROLE_NAME
+  $AWS lambda create-function --function-name $EVENTS_LAMBDA_NAME --runtime python3.8 --handler service.handler.s3_event_handler --timeout 60 --memory-size $EVENTS_LAMBDA_MEMORY --environment "$LAMBDA_ENV" --zip-file fileb:///tmp/handler.zip --role arn:aws:iam::000000000000:role/$ROLE_NAME
 fi
 
+echo "Subscribing S3 event Lambda to ObjectCreated notifications..."
+$AWS lambda add-permission --function-name $EVENTS_LAMBDA_NAME --statement-id s3-$EVENTS_LAMBDA_NAME --action lambda:InvokeFunction --principal s3.amazonaws.com --source-arn arn:aws:s3:::$BUCKET || true
+$AWS s3api put-bucket-notification-configuration --bucket $BUCKET --notification-configuration '{"LambdaFunctionConfigurations": [{"LambdaFunctionArn": "arn:aws:lambda:us-east-1:000000000000:function:'$EVENTS_LAMBDA_NAME'", "Events": ["s3:ObjectCreated:*"]}]}'
+
+# 4c) Create or update the hourly reaper of abandoned uploads
+echo "Creating/updating reaper Lambda function..."
+if $AWS lambda list-functions | grep -q $REAPER_LAMBDA_NAME; then
+  $AWS lambda update-function-code --function-name $REAPER_LAMBDA_NAME --zip-file fileb:///tmp/handler.zip
+else
+  $AWS lambda create-function --function-name $REAPER_LAMBDA_NAME --runtime python3.8 --handler service.reaper.reaper_handler --timeout 900 --zip-file fileb:///tmp/handler.zip --role arn:aws:iam::000000000000:role/$ROLE_NAME
+fi
+
+echo "Scheduling the reaper..."
+$AWS events put-rule --name $REAPER_LAMBDA_NAME-schedule --schedule-expression 'rate(1 hour)'
+$AWS lambda add-permission --function-name $REAPER_LAMBDA_NAME --statement-id events-$REAPER_LAMBDA_NAME --action lambda:InvokeFunction --principal events.amazonaws.com || true
+$AWS events put-targets --rule $REAPER_LAMBDA_NAME-schedule --targets "Id=1,Arn=arn:aws:lambda:us-east-1:000000000000:function:$REAPER_LAMBDA_NAME"
+
+# 4d) Create or update the daily reconciliation of per-user stats
+echo "Creating/updating stats reconciliation Lambda function..."
+if $AWS lambda list-functions | grep -q $STATS_LAMBDA_NAME; then
+  $AWS lambda update-function-code --function-name $STATS_LAMBDA_NAME --zip-file fileb:///tmp/handler.zip
+else
+  $AWS lambda create-function --function-name $STATS_LAMBDA_NAME --runtime python3.8 --handler service.stats.reconcile_handler --timeout 900 --zip-file fileb:///tmp/handler.zip --role arn:aws:iam::000000000000:role/$ROLE_NAME
+fi
+
+echo "Scheduling the stats reconciliation..."
+$AWS events put-rule --name $STATS_LAMBDA_NAME-schedule --schedule-expression 'rate(1 day)'
+$AWS lambda add-permission --function-name $STATS_LAMBDA_NAME --statement-id events-$STATS_LAMBDA_NAME --action lambda:InvokeFunction --principal events.amazonaws.com || true
+$AWS events put-targets --rule $STATS_LAMBDA_NAME-schedule --targets "Id=1,Arn=arn:aws:lambda:us-east-1:000000000000:function:$STATS_LAMBDA_NAME"
+
 # 5) Create API Gateway REST API
 echo "Creating API Gateway..."
-API_ID=$($AWS apigateway create-rest-api --name "instagram-api" --query 'id' --output text)
+API_ID=$($AWS apigateway create-rest-api --name "instagram-api" --binary-media-types '*/*' --query 'id' --output text)
 ROOT_ID=$($AWS apigateway get-resources --rest-api-id $API_ID --query 'items[0].id' --output text)
 
 # Create resources and methods
 echo "Setting up API routes..."
+LAMBDA_URI="arn:aws:apigateway:us-east-1:lambda:path/2015-03-31/functions/arn:aws:lambda:us-east-1:000000000000:function:$LAMBDA_NAME/invocations"
+
+# Create a resource under a parent and print its id
+add_resource() {
+  $AWS apigateway create-resource --rest-api-id $API_ID --parent-id $1 --path-part "$2" --query 'id' --output text
+}
+
+# Proxy a method on a resource to the Lambda
+add_method() {
+  $AWS apigateway put-method --rest-api-id $API_ID --resource-id $1 --http-method $2 --authorization-type NONE
+  $AWS apigateway put-integration --rest-api-id $API_ID --resource-id $1 --http-method $2 --type AWS_PROXY --integration-http-method POST --uri "$LAMBDA_URI"
+}
+
+# /upload-url, /upload-urls, /confirm-upload, /confirm-uploads -> POST -> Lambda
+UPLOAD_RES=$(add_resource $ROOT_ID upload-url)
+add_method $UPLOAD_RES POST
+UPLOADS_RES=$(add_resource $ROOT_ID upload-urls)
+add_method $UPLOADS_RES POST
+CONFIRM_RES=$(add_resource $ROOT_ID confirm-upload)
+add_method $CONFIRM_RES POST
+CONFIRMS_RES=$(add_resource $ROOT_ID confirm-uploads)
+add_method $CONFIRMS_RES POST
+
+# /multipart-upload, /multipart-upload/parts, /multipart-upload/complete -> POST -> Lambda
+MULTIPART_RES=$(add_resource $ROOT_ID multipart-upload)
+add_method $MULTIPART_RES POST
+PARTS_RES=$(add_resource $MULTIPART_RES parts)
+add_method $PARTS_RES POST
+COMPLETE_RES=$(add_resource $MULTIPART_RES complete)
+add_method $COMPLETE_RES POST
 
-# /upload-url -> POST -> Lambda
-UPLOAD_RES=$($AWS apigateway create-resource --rest-api-id $API_ID --parent-id $ROOT_ID --path-part upload-url --query 'id' --output text)
-$AWS apigateway put-method --rest-api-id $API_ID --resource-id $UPLOAD_RES --http-method POST --authorization-type NONE
-$AWS apigateway put-integration --rest-api-id $API_ID --resource-id $UPLOAD_RES --http-method POST --type AWS_PROXY --integration-http-method POST --uri "arn:aws:apigateway:us-east-1:lambda:path/2015-03-31/functions/arn:aws:lambda:us-east-1:000000000000:function:$LAMBDA_NAME/invocations"
+# /images -> GET, /images/bulk-delete -> POST -> Lambda
+IMAGES_RES=$(add_resource $ROOT_ID images)
+add_method $IMAGES_RES GET
+BULK_DELETE_RES=$(add_resource $IMAGES_RES bulk-delete)
+add_method $BULK_DELETE_RES POST
 
-# /confirm-upload -> POST -> Lambda
-CONFIRM_RES=$($AWS apigateway create-resource --rest-api-id $API_ID --parent-id $ROOT_ID --path-part confirm-upload --query 'id' --output text)
-$AWS apigateway put-method --rest-api-id $API_ID --resource-id $CONFIRM_RES --http-method POST --authorization-type NONE
-$AWS apigateway put-integration --rest-api-id $API_ID --resource-id $CONFIRM_RES --http-method POST --type AWS_PROXY --integration-http-method POST --uri "arn:aws:apigateway:us-east-1:lambda:path/2015-03-31/functions/arn:aws:lambda:us-east-1:000000000000:function:$LAMBDA_NAME/invocations"
+# /images/{user_id}/{image_id} -> GET, DELETE -> Lambda
+USER_RES=$(add_resource $IMAGES_RES '{user_id}')
+IMAGE_RES=$(add_resource $USER_RES '{image_id}')
+add_method $IMAGE_RES GET
+add_method $IMAGE_RES DELETE
 
-# /images -> GET -> Lambda
-IMAGES_RES=$($AWS apigateway create-resource --rest-api-id $API_ID --parent-id $ROOT_ID --path-part images --query 'id' --output text)
-$AWS apigateway put-method --rest-api-id $API_ID --resource-id $IMAGES_RES --http-method GET --authorization-type NONE
-$AWS apigateway put-integration --rest-api-id $API_ID --resource-id $IMAGES_RES --http-method GET --type AWS_PROXY --integration-http-method POST --uri "arn:aws:apigateway:us-east-1:lambda:path/2015-03-31/functions/arn:aws:lambda:us-east-1:000000000000:function:$LAMBDA_NAME/invocations"
+# /users/{user_id}/stats -> GET -> Lambda
+USERS_RES=$(add_resource $ROOT_ID users)
+STATS_USER_RES=$(add_resource $USERS_RES '{user_id}')
+STATS_RES=$(add_resource $STATS_USER_RES stats)
+add_method $STATS_RES GET
 
 # Give permission to API Gateway to invoke Lambda
 echo "Setting up Lambda permissions..."
@@ -71,7 +183,14 @@ echo "Deployment complete!"
 echo "API Gateway URL: http://localhost:4566/restapis/$API_ID/dev/_user_request_"
 echo "Available endpoints:"
 echo "   POST /upload-url"
+echo "   POST /upload-urls"
 echo "   POST /confirm-upload"
+echo "   POST /confirm-uploads"
+echo "   POST /multipart-upload"
+echo "   POST /multipart-upload/parts"
+echo "   POST /multipart-upload/complete"
 echo "   GET /images"
+echo "   POST /images/bulk-delete"
 echo "   GET /images/{user_id}/{image_id}"
 echo "   DELETE /images/{user_id}/{image_id}"
+echo "   GET /users/{user_id}/stats"
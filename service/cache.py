@@ -0,0 +1,111 @@
+# Caches for hot image metadata
+import abc
+import time
+import threading
+from collections import OrderedDict
+
+class MetadataCache(abc.ABC):
+    """Interface of a metadata cache
+    
+    Keys are strings and values are JSON-like dicts, so a Redis (or local
+    Redis stand-in) backed cache can implement the same four methods.
+    """
+    
+    @abc.abstractmethod
+    def get(self, key):
+        """Return the cached value, or None on a miss"""
+    
+    @abc.abstractmethod
+    def set(self, key, value):
+        """Cache a value"""
+    
+    @abc.abstractmethod
+    def delete(self, key):
+        """Drop a cached value"""
+    
+    @abc.abstractmethod
+    def clear(self):
+        """Drop every cached value"""
+
+class LRUTTLCache(MetadataCache):
+    """Thread-safe in-process LRU cache whose entries expire after ttl seconds"""
+    
+    def __init__(self, max_size=10000, ttl=10):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+    
+    def set(self, key, value):
+        if self.max_size <= 0 or self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+    
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+    
+    def __len__(self):
+        return len(self._entries)
+
+class _Call:
+    """A load in flight that other callers can wait on"""
+    
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class RequestCoalescer:
+    """Run one load per key at a time; concurrent callers for the same key share its result"""
+    
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+    
+    def run(self, key, load):
+        """Return load(), or the result of the load already running for key"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.coalesced += 1
+        
+        if not leader:
+            call.done.wait()
+            if call.error:
+                raise call.error
+            return call.result
+        
+        try:
+            call.result = load()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
@@ -0,0 +1,91 @@
+# Shared, lazily created boto3 clients
+#
+# Clients are built on first use from one shared session, with connection
+# pool, timeout, keep-alive and retry settings taken from the environment:
+#
+#   AWS_MAX_POOL_CONNECTIONS  connections per client pool (default 50)
+#   AWS_CONNECT_TIMEOUT       seconds (default 2)
+#   AWS_READ_TIMEOUT          seconds (default 10)
+#   AWS_TCP_KEEPALIVE         true/false (default true)
+#   AWS_RETRY_MODE            standard/adaptive/legacy (default adaptive)
+#   AWS_MAX_ATTEMPTS          attempts including the first call (default 5)
+import os
+import threading
+
+from . import metrics
+
+_lock = threading.Lock()
+_session = None
+_clients = {}
+_resources = {}
+
+def client_config():
+    """botocore Config built from the environment"""
+    from botocore.config import Config
+    
+    return Config(
+        max_pool_connections=int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', '50')),
+        connect_timeout=float(os.environ.get('AWS_CONNECT_TIMEOUT', '2')),
+        read_timeout=float(os.environ.get('AWS_READ_TIMEOUT', '10')),
+        tcp_keepalive=os.environ.get('AWS_TCP_KEEPALIVE', 'true').lower() == 'true',
+        retries={
+            'mode': os.environ.get('AWS_RETRY_MODE', 'adaptive'),
+            'total_max_attempts': int(os.environ.get('AWS_MAX_ATTEMPTS', '5'))
+        }
+    )
+
+def _get_session():
+    """The shared boto3 session, callers must hold _lock"""
+    global _session
+    if _session is None:
+        import boto3
+        
+        _session = boto3.session.Session()
+    return _session
+
+def get_client(service_name):
+    """Shared low-level client for a service, created on first use"""
+    client = _clients.get(service_name)
+    if client is None:
+        with _lock:
+            client = _clients.get(service_name)
+            if client is None:
+                client = _get_session().client(
+                    service_name,
+                    endpoint_url=os.environ.get('AWS_ENDPOINT_URL'),
+                    config=client_config()
+                )
+                metrics.attach(client)
+                _clients[service_name] = client
+    return client
+
+def get_resource(service_name):
+    """Shared resource for a service, created on first use"""
+    resource = _resources.get(service_name)
+    if resource is None:
+        with _lock:
+            resource = _resources.get(service_name)
+            if resource is None:
+                resource = _get_session().resource(
+                    service_name,
+                    endpoint_url=os.environ.get('AWS_ENDPOINT_URL'),
+                    config=client_config()
+                )
+                metrics.attach(resource.meta.client)
+                _resources[service_name] = resource
+    return resource
+
+def prewarm():
+    """Create the clients the service uses ahead of the first request"""
+    get_client('s3')
+    get_resource('dynamodb')
+    # The write paths use a plain client: the resource's client transforms parameters on every call
+    get_client('dynamodb')
+
+def reset_clients():
+    """Forget every client so the next use builds new ones, e.g. after changing the environment"""
+    global _session
+    with _lock:
+        _clients.clear()
+        _resources.clear()
+        _session = None
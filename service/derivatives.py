@@ -0,0 +1,148 @@
+# Derivative pipeline: thumbnail and preview renditions of uploaded images
+#
+# Once an image is uploaded its original is fetched from S3, resized to each
+# configured size on a process pool (Pillow is CPU bound and holds the GIL)
+# and the results are stored under derived/<size>/<user_id>/<image_id>.jpg.
+# Their keys and dimensions are recorded on the image item as derivatives.
+#
+#   DERIVATIVE_SIZES     name:max edge pairs (default thumbnail:200,preview:1080, empty disables)
+#   DERIVATIVE_QUALITY   JPEG quality of the renditions (default 85)
+#   DERIVATIVE_WORKERS   resize processes (default one per CPU, 0 resizes in the calling thread)
+#   DERIVATIVE_MAX_BYTES originals larger than this are not rendered (default 20 MB), as they
+#                        are read and decoded in memory
+#   DERIVATIVES_MODE     confirm: queue after the API confirms an upload (default)
+#                        event:   render synchronously in the S3 event Lambda
+#                        off:     never render
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .s3_client import get_file, put_file, check_file_exists, delete_s3_objects
+from .dynamo_client import set_image_derivatives, set_content_derivatives
+
+S3_BUCKET = os.environ.get('S3_BUCKET', 'instagram-images-local')
+DDB_TABLE = os.environ.get('DDB_TABLE', 'Images')
+
+def parse_sizes(value):
+    """Parse DERIVATIVE_SIZES into {name: max edge in pixels}"""
+    sizes = {}
+    for entry in value.split(','):
+        if entry.strip():
+            name, edge = entry.split(':')
+            sizes[name.strip()] = int(edge)
+    return sizes
+
+DERIVATIVE_SIZES = parse_sizes(os.environ.get('DERIVATIVE_SIZES', 'thumbnail:200,preview:1080'))
+DERIVATIVE_QUALITY = int(os.environ.get('DERIVATIVE_QUALITY', '85'))
+DERIVATIVE_WORKERS = int(os.environ.get('DERIVATIVE_WORKERS', str(os.cpu_count() or 1)))
+DERIVATIVE_MAX_BYTES = int(os.environ.get('DERIVATIVE_MAX_BYTES', str(20 * 1024 * 1024)))
+DERIVATIVES_MODE = os.environ.get('DERIVATIVES_MODE', 'confirm')
+
+# Renditions are JPEG whatever the original format
+DERIVATIVE_CONTENT_TYPE = 'image/jpeg'
+
+# Threads that fetch originals and store renditions; the resizing itself runs on _resize_pool
+_DERIVATIVE_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix='derivatives')
+_resize_pool = None
+_pool_lock = threading.Lock()
+
+def derived_key(s3_key, name):
+    """S3 key of one rendition of an original, outside the user_id/image_id.ext layout"""
+    return f"derived/{name}/{s3_key.rsplit('.', 1)[0]}.jpg"
+
+def derived_keys(item):
+    """Every rendition key an image may have, recorded or configured"""
+    keys = {d['s3_key'] for d in (item.get('derivatives') or {}).values()}
+    keys.update(derived_key(item['s3_key'], name) for name in DERIVATIVE_SIZES)
+    return sorted(keys)
+
+def resize(data, sizes, quality=DERIVATIVE_QUALITY):
+    """Render an encoded image at each size as JPEG, returns {name: (bytes, width, height)}
+    
+    Runs in a worker process. JPEGs are decoded at the smallest DCT scale
+    that still covers the largest size, and each size is reduced from the
+    next larger rendition rather than from the original.
+    """
+    from PIL import Image, ImageOps
+    
+    largest = max(sizes.values())
+    with Image.open(io.BytesIO(data)) as original:
+        original.draft('RGB', (largest, largest))
+        image = ImageOps.exif_transpose(original)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    
+    renditions = {}
+    for name, edge in sorted(sizes.items(), key=lambda size: -size[1]):
+        image.thumbnail((edge, edge), Image.LANCZOS)
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=quality, optimize=True)
+        renditions[name] = (buffer.getvalue(), image.width, image.height)
+    return renditions
+
+def _pool():
+    """The shared resize process pool, started on first use"""
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    
+    global _resize_pool
+    with _pool_lock:
+        if _resize_pool is None:
+            # spawn, not fork: the parent holds boto3 connection pools and threads
+            _resize_pool = ProcessPoolExecutor(
+                max_workers=DERIVATIVE_WORKERS,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return _resize_pool
+
+def render(data, sizes=None):
+    """Resize on the process pool, or in this thread when DERIVATIVE_WORKERS is 0"""
+    sizes = sizes or DERIVATIVE_SIZES
+    if DERIVATIVE_WORKERS <= 0:
+        return resize(data, sizes, DERIVATIVE_QUALITY)
+    return _pool().submit(resize, data, sizes, DERIVATIVE_QUALITY).result()
+
+def generate_derivatives(item):
+    """Render, store and record the renditions of an uploaded image, returns them or None if skipped"""
+    if not DERIVATIVE_SIZES or not item.get('content_type', '').startswith('image/'):
+        return None
+    if int(item.get('file_size') or 0) > DERIVATIVE_MAX_BYTES:
+        print(f"Skipping derivatives of {item['image_id']}: {item['file_size']} bytes is over DERIVATIVE_MAX_BYTES")
+        return None
+    
+    renditions = render(get_file(S3_BUCKET, item['s3_key']))
+    derivatives = {}
+    for name, (body, width, height) in renditions.items():
+        key = derived_key(item['s3_key'], name)
+        put_file(S3_BUCKET, key, body, DERIVATIVE_CONTENT_TYPE)
+        derivatives[name] = {'s3_key': key, 'width': width, 'height': height, 'file_size': len(body)}
+    
+    if set_image_derivatives(DDB_TABLE, item['user_id'], item['image_id'], derivatives) is None:
+        # Deleted while rendering: drop the renditions unless another image still shares the original
+        if not check_file_exists(S3_BUCKET, item['s3_key']):
+            delete_s3_objects(S3_BUCKET, [d['s3_key'] for d in derivatives.values()])
+        return None
+    if item.get('sha256'):
+        set_content_derivatives(DDB_TABLE, item['user_id'], item['sha256'], item['s3_key'], derivatives)
+    return derivatives
+
+def _generate_logged(item):
+    """generate_derivatives for background use, failures are logged"""
+    try:
+        return generate_derivatives(item)
+    except Exception as e:
+        print(f"Failed to generate derivatives of {item['image_id']}: {str(e)}")
+        return None
+
+def schedule_derivatives(item):
+    """Queue rendering of a just confirmed image when DERIVATIVES_MODE is confirm"""
+    if DERIVATIVES_MODE != 'confirm':
+        return None
+    return _DERIVATIVE_EXECUTOR.submit(_generate_logged, item)
+
+def generate_on_event(item):
+    """Render an image confirmed by an S3 event when DERIVATIVES_MODE is event"""
+    if DERIVATIVES_MODE != 'event':
+        return None
+    return _generate_logged(item)
@@ -1,47 +1,730 @@
-# DynamoDB client for metadata operations
-import os
-import boto3
-from boto3.dynamodb.conditions import Key
-from botocore.exceptions import ClientError
-
-DDB = boto3.resource('dynamodb', endpoint_url=os.environ.get('AWS_ENDPOINT_URL'))
-
-def put_image_metadata(table_name, item):
-    """Store image metadata in DynamoDB"""
-    table = DDB.Table(table_name)
-    table.put_item(Item=item)
-
-def get_images(table_name, user_id):
-    """Get all images for a user"""
-    table = DDB.Table(table_name)
-    resp = table.query(KeyConditionExpression=Key('user_id').eq(user_id))
-    return resp.get('Items', [])
-
-def get_image_metadata(table_name, user_id, image_id):
-    """Get specific image metadata"""
-    table = DDB.Table(table_name)
-    resp = table.get_item(Key={'user_id': user_id, 'image_id': image_id})
-    return resp.get('Item')
-
-def update_image_status(table_name, user_id, image_id, status, file_size=None):
-    """Update image status and file size"""
-    table = DDB.Table(table_name)
-    update_expression = "SET #status = :status"
-    expression_values = {':status': status}
-    expression_names = {'#status': 'status'}
-    
-    if file_size:
-        update_expression += ", file_size = :file_size"
-        expression_values[':file_size'] = file_size
-    
-    table.update_item(
-        Key={'user_id': user_id, 'image_id': image_id},
-        UpdateExpression=update_expression,
-        ExpressionAttributeValues=expression_values,
-        ExpressionAttributeNames=expression_names
-    )
-
-def delete_image_metadata(table_name, user_id, image_id):
-    """Delete image metadata from DynamoDB"""
-    table = DDB.Table(table_name)
-    table.delete_item(Key={'user_id': user_id, 'image_id': image_id})
+# DynamoDB client for metadata operations
+import os
+import copy
+import time
+import random
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+
+from .cache import LRUTTLCache, RequestCoalescer
+from .clients import get_client, get_resource
+
+# boto3 itself is only imported on first use, see clients.py: importing this
+# module must stay cheap for Lambda cold starts.
+
+def _ddb():
+    """Shared DynamoDB resource, used for reads"""
+    return get_resource('dynamodb')
+
+def _ddb_client():
+    """Shared low-level DynamoDB client, used on the write paths so they skip the resource model"""
+    return get_client('dynamodb')
+
+def _serialize(item):
+    """Convert a Python item to DynamoDB attribute values"""
+    from boto3.dynamodb.types import TypeSerializer
+    
+    serializer = TypeSerializer()
+    return {k: serializer.serialize(v) for k, v in item.items()}
+
+def _deserialize(item):
+    """Convert DynamoDB attribute values back to a Python item"""
+    from boto3.dynamodb.types import TypeDeserializer
+    
+    deserializer = TypeDeserializer()
+    return {k: deserializer.deserialize(v) for k, v in item.items()}
+
+# Primary key attributes of the images table
+KEY_ATTRIBUTES = ('user_id', 'image_id')
+
+# BatchWriteItem limits and retry policy for unprocessed items
+BATCH_WRITE_SIZE = 25
+BATCH_WRITE_ATTEMPTS = 6
+BATCH_BACKOFF_SECONDS = 0.05
+
+# BatchGetItem accepts at most 100 keys per call
+BATCH_GET_SIZE = 100
+
+# Read-through cache for get_image_metadata; METADATA_CACHE_TTL=0 disables it
+METADATA_CACHE = LRUTTLCache(
+    max_size=int(os.environ.get('METADATA_CACHE_SIZE', '10000')),
+    ttl=float(os.environ.get('METADATA_CACHE_TTL', '10'))
+)
+_METADATA_LOADS = RequestCoalescer()
+_metadata_stats = {'hits': 0, 'misses': 0}
+_metadata_lock = threading.Lock()
+# Write generation of each image with a load in flight; _METADATA_LOADS runs one load per key at a time
+_load_generations = {}
+
+# Threads that fetch the next query page while the caller consumes the current one
+_PAGE_PREFETCH = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('DDB_PREFETCH_WORKERS', '8')),
+    thread_name_prefix='ddb-prefetch'
+)
+
+# DynamoDB TTL attribute of pending images, removed once an image leaves pending
+TTL_ATTRIBUTE = 'expires_at'
+
+# Bytes an uploaded image contributes to its user's stats, present once it has been counted
+COUNTED_ATTRIBUTE = 'counted_bytes'
+
+# Local secondary index on created_at, present on both the images and tag tables
+CREATED_AT_INDEX = 'created_at-index'
+
+def tag_table_name(table_name):
+    """Name of the tag index table that belongs to an images table"""
+    return os.environ.get('DDB_TAG_TABLE') or f'{table_name}-tags'
+
+def content_table_name(table_name):
+    """Name of the content-hash index table that belongs to an images table"""
+    return os.environ.get('DDB_CONTENT_TABLE') or f'{table_name}-content'
+
+def stats_table_name(table_name):
+    """Name of the per-user stats table that belongs to an images table"""
+    return os.environ.get('DDB_STATS_TABLE') or f'{table_name}-stats'
+
+def tag_key(user_id, tag):
+    """Partition key of the tag index rows for one user and tag"""
+    return f'{user_id}#{tag}'
+
+def _put_tag_rows(table_name, item, tags):
+    """Write a copy of item into the tag index under each tag"""
+    requests = [
+        (tag_table_name(table_name), {'PutRequest': {'Item': {**item, 'user_tag': tag_key(item['user_id'], tag)}}})
+        for tag in set(tags or [])
+    ]
+    if batch_write(requests):
+        raise RuntimeError('Failed to update the tag index')
+
+def _delete_tag_rows(table_name, user_id, image_id, tags):
+    """Remove an image from the tag index under each tag"""
+    requests = [
+        (tag_table_name(table_name), {'DeleteRequest': {'Key': {'user_tag': tag_key(user_id, tag), 'image_id': image_id}}})
+        for tag in set(tags or [])
+    ]
+    if batch_write(requests):
+        raise RuntimeError('Failed to update the tag index')
+
+def put_image_metadata(table_name, item):
+    """Store image metadata in DynamoDB and index it by tag"""
+    resp = _ddb_client().put_item(TableName=table_name, Item=_serialize(item), ReturnValues='ALL_OLD')
+    _invalidate_metadata(table_name, item['user_id'], item['image_id'])
+    tags = set(item.get('tags') or [])
+    old_tags = set(_deserialize(resp.get('Attributes', {})).get('tags') or [])
+    _delete_tag_rows(table_name, item['user_id'], item['image_id'], old_tags - tags)
+    _put_tag_rows(table_name, item, tags)
+
+def _start_key(start_key, user_id, tag, index_name):
+    """Translate an item_key into the ExclusiveStartKey of the table or index queried"""
+    if tag:
+        key = {'user_tag': tag_key(user_id, tag), 'image_id': start_key['image_id']}
+    else:
+        key = {'user_id': user_id, 'image_id': start_key['image_id']}
+    if index_name:
+        key['created_at'] = start_key['created_at']
+    return key
+
+def _serialize_request(request):
+    """Serialize a PutRequest/DeleteRequest for the low-level client"""
+    if 'PutRequest' in request:
+        return {'PutRequest': {'Item': _serialize(request['PutRequest']['Item'])}}
+    return {'DeleteRequest': {'Key': _serialize(request['DeleteRequest']['Key'])}}
+
+def _deserialize_request(request):
+    """Inverse of _serialize_request"""
+    if 'PutRequest' in request:
+        return {'PutRequest': {'Item': _deserialize(request['PutRequest']['Item'])}}
+    return {'DeleteRequest': {'Key': _deserialize(request['DeleteRequest']['Key'])}}
+
+def batch_write(requests):
+    """Run (table_name, request) pairs through BatchWriteItem in chunks of 25
+    
+    Unprocessed items are retried with exponential backoff and jitter. The
+    pairs that are still unprocessed after the last attempt are returned.
+    """
+    client = _ddb_client()
+    failed = []
+    for start in range(0, len(requests), BATCH_WRITE_SIZE):
+        request_items = {}
+        for table_name, request in requests[start:start + BATCH_WRITE_SIZE]:
+            request_items.setdefault(table_name, []).append(_serialize_request(request))
+        for attempt in range(BATCH_WRITE_ATTEMPTS):
+            if attempt:
+                time.sleep(random.uniform(0, BATCH_BACKOFF_SECONDS * 2 ** attempt))
+            resp = client.batch_write_item(RequestItems=request_items)
+            request_items = resp.get('UnprocessedItems') or {}
+            if not request_items:
+                break
+        for table_name, table_requests in request_items.items():
+            failed.extend((table_name, _deserialize_request(request)) for request in table_requests)
+    return failed
+
+def batch_put_image_metadata(table_name, items):
+    """Store many new images and their tag index rows, returns image_ids that were not stored
+    
+    An image is failed only if its main row was not written. One whose main
+    row was written but a tag row was not is deleted again, so it is either
+    fully indexed or reported; if that delete fails too, the image stays
+    (missing from some tag listings) and is not reported, since its row is
+    live. The tag rows that were written for a failed image are removed.
+    """
+    requests = []
+    for item in items:
+        requests.append((table_name, {'PutRequest': {'Item': item}}))
+        for tag in set(item.get('tags') or []):
+            tag_row = {**item, 'user_tag': tag_key(item['user_id'], tag)}
+            requests.append((tag_table_name(table_name), {'PutRequest': {'Item': tag_row}}))
+    failed = batch_write(requests)
+    
+    unstored = {request['PutRequest']['Item']['image_id'] for name, request in failed if name == table_name}
+    unindexed = {request['PutRequest']['Item']['image_id'] for name, request in failed if name != table_name}
+    rollback = [
+        (table_name, {'DeleteRequest': {'Key': {'user_id': item['user_id'], 'image_id': item['image_id']}}})
+        for item in items if item['image_id'] in unindexed - unstored
+    ]
+    kept = {request['DeleteRequest']['Key']['image_id'] for _, request in batch_write(rollback)}
+    failed_ids = (unstored | unindexed) - kept
+    batch_write([
+        (tag_table_name(table_name),
+         {'DeleteRequest': {'Key': {'user_tag': tag_key(item['user_id'], tag), 'image_id': item['image_id']}}})
+        for item in items if item['image_id'] in failed_ids
+        for tag in set(item.get('tags') or [])
+    ])
+    
+    for item in items:
+        _invalidate_metadata(table_name, item['user_id'], item['image_id'])
+    return [item['image_id'] for item in items if item['image_id'] in failed_ids]
+
+def _images_query(table_name, user_id, tag=None, start_date=None, end_date=None, descending=False):
+    """Build the table, query arguments and index name for a listing of a user's images"""
+    from boto3.dynamodb.conditions import Key
+    
+    if tag:
+        table = _ddb().Table(tag_table_name(table_name))
+        key_condition = Key('user_tag').eq(tag_key(user_id, tag))
+    else:
+        table = _ddb().Table(table_name)
+        key_condition = Key('user_id').eq(user_id)
+    query_args = {}
+    
+    index_name = None
+    if start_date or end_date or descending:
+        index_name = CREATED_AT_INDEX
+        query_args['IndexName'] = index_name
+        query_args['ScanIndexForward'] = not descending
+        if start_date and end_date:
+            key_condition &= Key('created_at').between(start_date, end_date)
+        elif start_date:
+            key_condition &= Key('created_at').gte(start_date)
+        elif end_date:
+            key_condition &= Key('created_at').lte(end_date)
+    
+    query_args['KeyConditionExpression'] = key_condition
+    return table, query_args, index_name
+
+def _query_pages(table, query_args, start_key=None, wanted=None):
+    """Yield query responses page by page, following LastEvaluatedKey
+    
+    With wanted, a page holding fewer than wanted items in total means the
+    next page is needed too: it is fetched in the background, only for the
+    missing items, while the caller consumes the current one.
+    """
+    def fetch(key, limit=None):
+        args = dict(query_args)
+        if key:
+            args['ExclusiveStartKey'] = key
+        if limit:
+            args['Limit'] = limit
+        return table.query(**args)
+    
+    resp = fetch(start_key)
+    seen = 0
+    while True:
+        seen += resp.get('Count', 0)
+        start_key = resp.get('LastEvaluatedKey')
+        pending = None
+        if start_key and wanted and seen < wanted:
+            pending = _PAGE_PREFETCH.submit(contextvars.copy_context().run, fetch, start_key, wanted - seen)
+        yield resp
+        if not start_key:
+            return
+        resp = pending.result() if pending else fetch(start_key)
+
+def get_images(table_name, user_id, tag=None, start_date=None, end_date=None,
+               descending=False, start_key=None, page_size=None, fields=None):
+    """Lazily yield a user's images, following LastEvaluatedKey page by page
+    
+    With a tag only the tag index rows for that tag are read. A created_at
+    range or descending order is answered from the created_at index, so only
+    the images inside the range are read. start_key is an item_key. fields
+    limits the attributes read; the item_key attributes are always included.
+    page_size is the query Limit; a first page cut short by DynamoDB's 1 MB
+    response cap has the rest of it prefetched in the background.
+    """
+    table, query_args, index_name = _images_query(
+        table_name, user_id, tag, start_date, end_date, descending)
+    if page_size:
+        query_args['Limit'] = page_size
+    if fields:
+        names = dict.fromkeys([*KEY_ATTRIBUTES, 'created_at', *fields])
+        placeholders = {f'#f{i}': name for i, name in enumerate(names)}
+        query_args['ProjectionExpression'] = ', '.join(placeholders)
+        query_args['ExpressionAttributeNames'] = placeholders
+    if start_key:
+        start_key = _start_key(start_key, user_id, tag, index_name)
+    for resp in _query_pages(table, query_args, start_key, wanted=page_size):
+        for item in resp.get('Items', []):
+            item.pop('user_tag', None)
+            yield item
+
+def count_images(table_name, user_id, tag=None, start_date=None, end_date=None):
+    """Count a user's images with Select=COUNT, without reading any items back"""
+    table, query_args, _ = _images_query(table_name, user_id, tag, start_date, end_date)
+    query_args['Select'] = 'COUNT'
+    return sum(resp['Count'] for resp in _query_pages(table, query_args))
+
+def item_key(item):
+    """Build the key get_images needs as start_key to resume right after item"""
+    key = {attr: item[attr] for attr in KEY_ATTRIBUTES}
+    if 'created_at' in item:
+        key['created_at'] = item['created_at']
+    return key
+
+def set_metadata_cache(cache):
+    """Replace the metadata cache, e.g. with a Redis backed MetadataCache"""
+    global METADATA_CACHE
+    METADATA_CACHE = cache
+
+def metadata_cache_stats():
+    """Hit, miss and coalesced-load counters of the metadata cache"""
+    with _metadata_lock:
+        stats = dict(_metadata_stats)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+    stats['coalesced'] = _METADATA_LOADS.coalesced
+    return stats
+
+def reset_metadata_cache():
+    """Empty the metadata cache and reset its counters"""
+    METADATA_CACHE.clear()
+    with _metadata_lock:
+        _metadata_stats.update(hits=0, misses=0)
+    _METADATA_LOADS.coalesced = 0
+
+def _metadata_cache_key(table_name, user_id, image_id):
+    return f'{table_name}/{user_id}/{image_id}'
+
+def _invalidate_metadata(table_name, user_id, image_id):
+    """Drop an image from the metadata cache after a write
+    
+    Bumping the image's write generation stops a load of it that was already
+    in flight from caching what it read before the write.
+    """
+    key = _metadata_cache_key(table_name, user_id, image_id)
+    with _metadata_lock:
+        if key in _load_generations:
+            _load_generations[key] += 1
+    METADATA_CACHE.delete(key)
+
+def _load_image_metadata(table_name, user_id, image_id):
+    """Read an image from DynamoDB and cache it unless it was written meanwhile"""
+    key = _metadata_cache_key(table_name, user_id, image_id)
+    with _metadata_lock:
+        _load_generations[key] = 0
+    try:
+        table = _ddb().Table(table_name)
+        resp = table.get_item(Key={'user_id': user_id, 'image_id': image_id})
+        item = resp.get('Item')
+    finally:
+        with _metadata_lock:
+            generation = _load_generations.pop(key)
+    if item is not None and generation == 0:
+        METADATA_CACHE.set(key, item)
+    return item
+
+def get_image_metadata(table_name, user_id, image_id):
+    """Get specific image metadata, served from the metadata cache when possible
+    
+    Concurrent misses on the same image share a single GetItem. Callers get
+    their own copy of the item and are free to modify it.
+    """
+    key = _metadata_cache_key(table_name, user_id, image_id)
+    item = METADATA_CACHE.get(key)
+    with _metadata_lock:
+        _metadata_stats['hits' if item is not None else 'misses'] += 1
+    if item is None:
+        item = _METADATA_LOADS.run(key, lambda: _load_image_metadata(table_name, user_id, image_id))
+    return copy.deepcopy(item)
+
+def update_image_status(table_name, user_id, image_id, status, file_size=None):
+    """Update image status and file size, returns the updated item or None if it does not exist
+    
+    The update is conditional on the image existing, so a late upload event
+    cannot resurrect an image that was deleted. Images leaving pending lose
+    their TTL so DynamoDB never expires them. The first update to uploaded
+    also sets counted_bytes, and only the call that set it adds the image
+    to the user's stats, so retried confirmations count it once.
+    """
+    table = _ddb().Table(table_name)
+    update_expression = "SET #status = :status"
+    expression_values = {':status': status}
+    expression_names = {'#status': 'status'}
+    
+    if file_size:
+        update_expression += ", file_size = :file_size"
+        expression_values[':file_size'] = file_size
+    if status == 'uploaded':
+        update_expression += f", {COUNTED_ATTRIBUTE} = if_not_exists({COUNTED_ATTRIBUTE}, :counted)"
+        expression_values[':counted'] = file_size or 0
+    if status != 'pending':
+        update_expression += f" REMOVE {TTL_ATTRIBUTE}"
+    
+    try:
+        resp = table.update_item(
+            Key={'user_id': user_id, 'image_id': image_id},
+            UpdateExpression=update_expression,
+            ConditionExpression='attribute_exists(image_id)',
+            ExpressionAttributeValues=expression_values,
+            ExpressionAttributeNames=expression_names,
+            ReturnValues='ALL_OLD'
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return None
+        raise
+    finally:
+        _invalidate_metadata(table_name, user_id, image_id)
+    
+    # Apply the update to the old image instead of asking for ALL_NEW, which would hide whether it was counted
+    item = resp['Attributes']
+    first_count = status == 'uploaded' and COUNTED_ATTRIBUTE not in item
+    item['status'] = status
+    if file_size:
+        item['file_size'] = file_size
+    if status == 'uploaded':
+        item.setdefault(COUNTED_ATTRIBUTE, file_size or 0)
+    if status != 'pending':
+        item.pop(TTL_ATTRIBUTE, None)
+    if first_count:
+        add_user_stats(table_name, user_id, 1, item[COUNTED_ATTRIBUTE])
+    _put_tag_rows(table_name, item, item.get('tags'))
+    return item
+
+def set_image_derivatives(table_name, user_id, image_id, derivatives):
+    """Record the renditions of an image, returns the updated item or None if it does not exist"""
+    table = _ddb().Table(table_name)
+    try:
+        resp = table.update_item(
+            Key={'user_id': user_id, 'image_id': image_id},
+            UpdateExpression='SET derivatives = :derivatives',
+            ConditionExpression='attribute_exists(image_id)',
+            ExpressionAttributeValues={':derivatives': derivatives},
+            ReturnValues='ALL_NEW'
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return None
+        raise
+    finally:
+        _invalidate_metadata(table_name, user_id, image_id)
+    item = resp['Attributes']
+    _put_tag_rows(table_name, item, item.get('tags'))
+    return item
+
+def delete_image_metadata(table_name, user_id, image_id):
+    """Delete image metadata from DynamoDB and the tag index, returns the deleted item or None
+    
+    Only the call that actually removed the item sees its old attributes,
+    so a retried delete never subtracts twice.
+    """
+    table = _ddb().Table(table_name)
+    resp = table.delete_item(Key={'user_id': user_id, 'image_id': image_id}, ReturnValues='ALL_OLD')
+    _invalidate_metadata(table_name, user_id, image_id)
+    old_item = resp.get('Attributes', {})
+    if COUNTED_ATTRIBUTE in old_item:
+        add_user_stats(table_name, user_id, -1, -old_item[COUNTED_ATTRIBUTE])
+    _delete_tag_rows(table_name, user_id, image_id, old_item.get('tags'))
+    return old_item or None
+
+def batch_get_image_metadata(table_name, user_id, image_ids):
+    """Fetch many images of a user with BatchGetItem, missing images are left out"""
+    client = _ddb().meta.client
+    image_ids = list(dict.fromkeys(image_ids))
+    items = []
+    for start in range(0, len(image_ids), BATCH_GET_SIZE):
+        keys = [{'user_id': user_id, 'image_id': image_id}
+                for image_id in image_ids[start:start + BATCH_GET_SIZE]]
+        request_items = {table_name: {'Keys': keys}}
+        for attempt in range(BATCH_WRITE_ATTEMPTS):
+            if attempt:
+                time.sleep(random.uniform(0, BATCH_BACKOFF_SECONDS * 2 ** attempt))
+            resp = client.batch_get_item(RequestItems=request_items)
+            items.extend(resp.get('Responses', {}).get(table_name, []))
+            request_items = resp.get('UnprocessedKeys') or {}
+            if not request_items:
+                break
+        else:
+            raise RuntimeError(f'BatchGetItem left {len(request_items[table_name]["Keys"])} keys unprocessed')
+    return items
+
+def batch_delete_image_metadata(table_name, items):
+    """Delete many images and their tag index rows, returns image_ids that failed
+    
+    BatchWriteItem returns no old items, so the user's stats are reduced by
+    the counted_bytes of the items passed in. Two concurrent deletes of the
+    same image can both subtract it; the stats reconciliation in stats.py corrects that.
+    """
+    requests = []
+    for item in items:
+        key = {'user_id': item['user_id'], 'image_id': item['image_id']}
+        requests.append((table_name, {'DeleteRequest': {'Key': key}}))
+        for tag in set(item.get('tags') or []):
+            tag_row_key = {'user_tag': tag_key(item['user_id'], tag), 'image_id': item['image_id']}
+            requests.append((tag_table_name(table_name), {'DeleteRequest': {'Key': tag_row_key}}))
+    failed = batch_write(requests)
+    for item in items:
+        _invalidate_metadata(table_name, item['user_id'], item['image_id'])
+    failed_ids = list(dict.fromkeys(request['DeleteRequest']['Key']['image_id'] for _, request in failed))
+    
+    removed = {}
+    for item in items:
+        if COUNTED_ATTRIBUTE in item and item['image_id'] not in failed_ids:
+            totals = removed.setdefault(item['user_id'], [0, 0])
+            totals[0] -= 1
+            totals[1] -= item[COUNTED_ATTRIBUTE]
+    for user_id, (images, total_bytes) in removed.items():
+        add_user_stats(table_name, user_id, images, total_bytes)
+    return failed_ids
+
+def add_user_stats(table_name, user_id, images, total_bytes):
+    """Atomically add to a user's image count and total bytes, returns False if the update failed
+    
+    Called after the image write that decides whether to count, so a
+    failure here cannot be retried without counting twice. It is logged
+    and left to the stats reconciliation in stats.py.
+    """
+    try:
+        _ddb_client().update_item(
+            TableName=stats_table_name(table_name),
+            Key=_serialize({'user_id': user_id}),
+            UpdateExpression='ADD image_count :images, total_bytes :bytes',
+            ExpressionAttributeValues=_serialize({':images': images, ':bytes': total_bytes})
+        )
+    except Exception as e:
+        print(f"Failed to update stats of {user_id}: {str(e)}")
+        return False
+    return True
+
+def get_user_stats(table_name, user_id):
+    """Image count and total bytes of a user's uploaded images, zero for users without any"""
+    resp = _ddb().Table(stats_table_name(table_name)).get_item(Key={'user_id': user_id})
+    item = resp.get('Item', {})
+    return {
+        'user_id': user_id,
+        'image_count': item.get('image_count', 0),
+        'total_bytes': item.get('total_bytes', 0)
+    }
+
+def scan_stale_pending(table_name, created_before, segment=0, total_segments=1):
+    """Yield (scanned count, items) pages of pending images created before a timestamp
+    
+    Reads one segment of a parallel Scan, so total_segments workers can
+    cover the table together. Only the attributes needed to reap an
+    abandoned upload are returned.
+    """
+    from boto3.dynamodb.conditions import Attr
+    
+    table = _ddb().Table(table_name)
+    names = ('user_id', 'image_id', 's3_key', 'status', 'created_at', 'tags', 'upload_id')
+    placeholders = {f'#f{i}': name for i, name in enumerate(names)}
+    scan_args = {
+        'FilterExpression': Attr('status').eq('pending') & Attr('created_at').lt(created_before),
+        'ProjectionExpression': ', '.join(placeholders),
+        'ExpressionAttributeNames': placeholders,
+        'Segment': segment,
+        'TotalSegments': total_segments
+    }
+    while True:
+        resp = table.scan(**scan_args)
+        yield resp.get('ScannedCount', 0), resp.get('Items', [])
+        if 'LastEvaluatedKey' not in resp:
+            return
+        scan_args['ExclusiveStartKey'] = resp['LastEvaluatedKey']
+
+def acquire_content(table_name, user_id, sha256, image_id):
+    """Add image_id to the references of a user's uploaded content, returns its row or None if unknown
+    
+    References are a string set: adding or removing the same image twice is
+    a no-op, so retried requests cannot skew the count.
+    """
+    table = _ddb().Table(content_table_name(table_name))
+    try:
+        resp = table.update_item(
+            Key={'user_id': user_id, 'sha256': sha256},
+            UpdateExpression='ADD refs :ref',
+            ConditionExpression='attribute_exists(refs)',
+            ExpressionAttributeValues={':ref': {image_id}},
+            ReturnValues='ALL_NEW'
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return None
+        raise
+    return resp['Attributes']
+
+def register_content(table_name, user_id, sha256, s3_key, image_id, file_size=None):
+    """Index an uploaded image by its content hash, returns False if the user already has that content"""
+    table = _ddb().Table(content_table_name(table_name))
+    item = {'user_id': user_id, 'sha256': sha256, 's3_key': s3_key, 'refs': {image_id}}
+    if file_size:
+        item['file_size'] = file_size
+    try:
+        table.put_item(Item=item, ConditionExpression='attribute_not_exists(sha256)')
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
+    return True
+
+def set_content_derivatives(table_name, user_id, sha256, s3_key, derivatives):
+    """Record the renditions of indexed content so images deduplicated later share them"""
+    table = _ddb().Table(content_table_name(table_name))
+    try:
+        table.update_item(
+            Key={'user_id': user_id, 'sha256': sha256},
+            UpdateExpression='SET derivatives = :derivatives',
+            ConditionExpression='s3_key = :s3_key',
+            ExpressionAttributeValues={':derivatives': derivatives, ':s3_key': s3_key}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
+    return True
+
+def release_content(table_name, user_id, sha256, s3_key, image_id):
+    """Drop an image's reference to its content, returns True if no image references s3_key any more
+    
+    An image whose content was never indexed owns its object outright. The
+    last reference removes the index row, conditional on no image having
+    acquired the content meanwhile.
+    """
+    table = _ddb().Table(content_table_name(table_name))
+    key = {'user_id': user_id, 'sha256': sha256}
+    try:
+        resp = table.update_item(
+            Key=key,
+            UpdateExpression='DELETE refs :ref',
+            ConditionExpression='s3_key = :s3_key',
+            ExpressionAttributeValues={':ref': {image_id}, ':s3_key': s3_key},
+            ReturnValues='ALL_NEW'
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return True
+        raise
+    if resp['Attributes'].get('refs'):
+        return False
+    try:
+        table.delete_item(Key=key, ConditionExpression='attribute_not_exists(refs)')
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
+    return True
+
+def scan_uploaded(table_name, segment=0, total_segments=1):
+    """Yield pages of uploaded images with the attributes that make up the user stats"""
+    from boto3.dynamodb.conditions import Attr
+    
+    table = _ddb().Table(table_name)
+    names = ('user_id', 'image_id', 'file_size', COUNTED_ATTRIBUTE)
+    placeholders = {f'#f{i}': name for i, name in enumerate(names)}
+    scan_args = {
+        'FilterExpression': Attr('status').eq('uploaded'),
+        'ProjectionExpression': ', '.join(placeholders),
+        'ExpressionAttributeNames': placeholders,
+        'Segment': segment,
+        'TotalSegments': total_segments
+    }
+    while True:
+        resp = table.scan(**scan_args)
+        yield resp.get('Items', [])
+        if 'LastEvaluatedKey' not in resp:
+            return
+        scan_args['ExclusiveStartKey'] = resp['LastEvaluatedKey']
+
+def set_counted_bytes(table_name, user_id, image_id, counted):
+    """Record what an uploaded image contributes to its user's stats, returns False if it is gone"""
+    table = _ddb().Table(table_name)
+    try:
+        table.update_item(
+            Key={'user_id': user_id, 'image_id': image_id},
+            UpdateExpression=f'SET {COUNTED_ATTRIBUTE} = :counted',
+            ConditionExpression='attribute_exists(image_id)',
+            ExpressionAttributeValues={':counted': counted}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
+    finally:
+        _invalidate_metadata(table_name, user_id, image_id)
+    return True
+
+def scan_user_stats(table_name):
+    """Yield every stats row"""
+    table = _ddb().Table(stats_table_name(table_name))
+    scan_args = {}
+    while True:
+        resp = table.scan(**scan_args)
+        yield from resp.get('Items', [])
+        if 'LastEvaluatedKey' not in resp:
+            return
+        scan_args['ExclusiveStartKey'] = resp['LastEvaluatedKey']
+
+def replace_user_stats(table_name, row, expected=None):
+    """Overwrite a stats row if it still holds the expected one, returns False if it changed
+    
+    expected is the row as read before, None if there was none. An ADD that
+    landed since then makes the condition fail instead of being overwritten.
+    """
+    table = _ddb().Table(stats_table_name(table_name))
+    if expected is None:
+        condition = 'attribute_not_exists(user_id)'
+        values = {}
+    else:
+        condition = 'image_count = :old_count AND total_bytes = :old_bytes'
+        values = {':old_count': expected.get('image_count', 0), ':old_bytes': expected.get('total_bytes', 0)}
+    try:
+        table.update_item(
+            Key={'user_id': row['user_id']},
+            UpdateExpression='SET image_count = :count, total_bytes = :bytes, reconciled_at = :at',
+            ConditionExpression=condition,
+            ExpressionAttributeValues={
+                ':count': row['image_count'], ':bytes': row['total_bytes'], ':at': row['reconciled_at'], **values
+            }
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
+    return True
+
+def backfill_tag_index(table_name):
+    """Rebuild the tag index from every existing image, returns rows written"""
+    table = _ddb().Table(table_name)
+    written = 0
+    scan_args = {}
+    with _ddb().Table(tag_table_name(table_name)).batch_writer() as batch:
+        while True:
+            resp = table.scan(**scan_args)
+            for item in resp.get('Items', []):
+                for tag in set(item.get('tags') or []):
+                    batch.put_item(Item={**item, 'user_tag': tag_key(item['user_id'], tag)})
+                    written += 1
+            if 'LastEvaluatedKey' not in resp:
+                return written
+            scan_args['ExclusiveStartKey'] = resp['LastEvaluatedKey']
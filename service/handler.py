@@ -1,257 +1,1075 @@
-# Lambda handlers for Instagram Image Service
-import os
-import json
-from datetime import datetime
-from decimal import Decimal
-
-from .s3_client import (
-    generate_presigned_upload_url, 
-    generate_presigned_download_url,
-    check_file_exists,
-    get_file_metadata,
-    delete_s3_object
-)
-from .dynamo_client import (
-    put_image_metadata,
-    get_images,
-    get_image_metadata,
-    update_image_status,
-    delete_image_metadata
-)
-
-S3_BUCKET = os.environ.get('S3_BUCKET', 'instagram-images-local')
-DDB_TABLE = os.environ.get('DDB_TABLE', 'Images')
-
-def convert_decimals(obj):
-    """Convert Decimal objects to regular numbers for JSON serialization"""
-    if isinstance(obj, Decimal):
-        return int(obj) if obj % 1 == 0 else float(obj)
-    elif isinstance(obj, dict):
-        return {k: convert_decimals(v) for k, v in obj.items()}
-    elif isinstance(obj, list):
-        return [convert_decimals(item) for item in obj]
-    else:
-        return obj
-
-def response(status_code, body):
-    """Create Lambda response"""
-    return {
-        'statusCode': status_code,
-        'headers': {'Content-Type': 'application/json'},
-        'body': json.dumps(body)
-    }
-
-def upload_url_handler(event, context):
-    """Generate presigned URL for image upload"""
-    try:
-        body = json.loads(event.get('body', '{}'))
-        
-        # Validate required fields
-        required_fields = ['user_id', 'filename', 'content_type']
-        for field in required_fields:
-            if field not in body:
-                return response(400, {'error': f'Missing required field: {field}'})
-        
-        user_id = body['user_id']
-        filename = body['filename']
-        content_type = body['content_type']
-        
-        # Generate unique image ID
-        image_id = str(uuid.uuid4())
-        
-        # Create S3 key
-        file_extension = filename.split('.')[-1] if '.' in filename else 'jpg'
-        s3_key = f"{user_id}/{image_id}.{file_extension}"
-        
-        # Generate presigned URL
-        upload_url = generate_presigned_upload_url(
-            bucket=S3_BUCKET,
-            key=s3_key,
-            content_type=content_type,
-            expires_in=300
-        )
-        
-        # Store pending metadata in DynamoDB
-        item = {
-            'user_id': user_id,
-            'image_id': image_id,
-            'filename': filename,
-            'content_type': content_type,
-            's3_key': s3_key,
-            'status': 'pending',
-            'created_at': datetime.utcnow().isoformat() + 'Z',
-            'caption': body.get('caption', ''),
-            'tags': body.get('tags', [])
-        }
-        put_image_metadata(DDB_TABLE, item)
-        
-        return response(200, {
-            'image_id': image_id,
-            'upload_url': upload_url,
-            'expires_in': 300
-        })
-        
-    except Exception as e:
-        return response(500, {'error': f'Upload URL generation failed: {str(e)}'})
-
-def confirm_upload_handler(event, context):
-    """Confirm image upload completion"""
-    try:
-        body = json.loads(event.get('body', '{}'))
-        
-        if 'image_id' not in body:
-            return response(400, {'error': 'Missing required field: image_id'})
-        
-        image_id = body['image_id']
-        user_id = body.get('user_id')  # Optional, can be extracted from metadata
-        
-        # Get image metadata
-        if user_id:
-            image_metadata = get_image_metadata(DDB_TABLE, user_id, image_id)
-        else:
-            # If user_id not provided, we need to find it
-            # This is a limitation of the current design - we'll require user_id
-            return response(400, {'error': 'user_id is required'})
-        
-        if not image_metadata:
-            return response(404, {'error': 'Image not found'})
-        
-        # Check if file exists in S3
-        if not check_file_exists(S3_BUCKET, image_metadata['s3_key']):
-            return response(400, {'error': 'File not found in S3'})
-        
-        # Get file metadata from S3
-        file_metadata = get_file_metadata(S3_BUCKET, image_metadata['s3_key'])
-        
-        # Update DynamoDB with uploaded status and file size
-        update_image_status(
-            table_name=DDB_TABLE,
-            user_id=user_id,
-            image_id=image_id,
-            status='uploaded',
-            file_size=file_metadata['file_size']
-        )
-        
-        return response(200, {
-            'status': 'success',
-            'image_id': image_id,
-            'file_size': file_metadata['file_size']
-        })
-        
-    except Exception as e:
-        return response(500, {'error': f'Upload confirmation failed: {str(e)}'})
-
-def list_images_handler(event, context):
-    """List images with filters"""
-    try:
-        query_params = event.get('queryStringParameters') or {}
-        user_id = query_params.get('user_id')
-        tag = query_params.get('tag')
-        start_date = query_params.get('start_date')
-        end_date = query_params.get('end_date')
-        
-        if not user_id:
-            return response(400, {'error': 'user_id is required'})
-        
-        # Get images from DynamoDB
-        items = get_images(DDB_TABLE, user_id)
-        
-        # Filter by tag
-        if tag:
-            items = [i for i in items if tag in (i.get('tags') or [])]
-        
-        # Filter by date range
-        if start_date or end_date:
-            sd = start_date or '0000-01-01T00:00:00Z'
-            ed = end_date or '9999-12-31T23:59:59Z'
-            items = [i for i in items if sd <= i.get('created_at', '') <= ed]
-        
-        # Generate download URLs for uploaded images
-        for item in items:
-            if item.get('status') == 'uploaded':
-                try:
-                    item['download_url'] = generate_presigned_download_url(
-                        bucket=S3_BUCKET,
-                        key=item['s3_key'],
-                        expires_in=3600
-                    )
-                except:
-                    item['download_url'] = None
-            else:
-                item['download_url'] = None
-        
-        return response(200, {
-            'count': len(items),
-            'images': convert_decimals(items)
-        })
-        
-    except Exception as e:
-        return response(500, {'error': f'List images failed: {str(e)}'})
-
-def get_image_handler(event, context):
-    """Get single image details and download URL"""
-    try:
-        path_params = event.get('pathParameters') or {}
-        user_id = path_params.get('user_id')
-        image_id = path_params.get('image_id')
-        
-        if not user_id or not image_id:
-            return response(400, {'error': 'user_id and image_id are required'})
-        
-        # Get image metadata
-        item = get_image_metadata(DDB_TABLE, user_id, image_id)
-        if not item:
-            return response(404, {'error': 'Image not found'})
-        
-        # Generate download URL if image is uploaded
-        if item.get('status') == 'uploaded':
-            try:
-                download_url = generate_presigned_download_url(
-                    bucket=S3_BUCKET,
-                    key=item['s3_key'],
-                    expires_in=3600
-                )
-                item['download_url'] = download_url
-            except:
-                item['download_url'] = None
-        else:
-            item['download_url'] = None
-        
-        return response(200, convert_decimals(item))
-        
-    except Exception as e:
-        return response(500, {'error': f'Get image failed: {str(e)}'})
-
-def delete_image_handler(event, context):
-    """Delete image from S3 and DynamoDB"""
-    try:
-        path_params = event.get('pathParameters') or {}
-        user_id = path_params.get('user_id')
-        image_id = path_params.get('image_id')
-        
-        if not user_id or not image_id:
-            return response(400, {'error': 'user_id and image_id are required'})
-        
-        # Get image metadata
-        item = get_image_metadata(DDB_TABLE, user_id, image_id)
-        if not item:
-            return response(404, {'error': 'Image not found'})
-        
-        # Delete from S3 if file exists
-        if item.get('status') == 'uploaded' and item.get('s3_key'):
-            try:
-                delete_s3_object(S3_BUCKET, item['s3_key'])
-            except Exception as e:
-                # Log error but continue with DynamoDB deletion
-                print(f"Failed to delete S3 file: {str(e)}")
-        
-        # Delete from DynamoDB
-        delete_image_metadata(DDB_TABLE, user_id, image_id)
-        
-        return response(200, {
-            'deleted': True,
-            'image_id': image_id
-        })
-        
-    except Exception as e:
-        return response(500, {'error': f'Delete image failed: {str(e)}'})
+# Lambda handlers for Instagram Image Service
+import os
+import re
+import json
+import gzip
+import uuid
+import base64
+import hashlib
+import binascii
+import contextvars
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote_plus
+
+from botocore.exceptions import ClientError
+
+from .clients import prewarm
+from .derivatives import derived_keys, schedule_derivatives, generate_on_event
+from .metrics import instrumented, span
+from .serialization import dumps
+from .s3_client import (
+    generate_presigned_upload_url,
+    create_multipart_upload,
+    generate_presigned_part_urls,
+    complete_multipart_upload,
+    generate_presigned_download_url,
+    get_file_metadata,
+    delete_s3_objects
+)
+from .dynamo_client import (
+    put_image_metadata,
+    batch_put_image_metadata,
+    get_images,
+    count_images,
+    item_key,
+    get_image_metadata,
+    update_image_status,
+    delete_image_metadata,
+    batch_get_image_metadata,
+    batch_delete_image_metadata,
+    acquire_content,
+    register_content,
+    release_content,
+    COUNTED_ATTRIBUTE,
+    add_user_stats,
+    get_user_stats
+)
+
+S3_BUCKET = os.environ.get('S3_BUCKET', 'instagram-images-local')
+DDB_TABLE = os.environ.get('DDB_TABLE', 'Images')
+
+# Build clients during Lambda init (e.g. with provisioned concurrency) instead of on the first request
+if os.environ.get('PREWARM_CLIENTS') == 'true':
+    prewarm()
+
+# Presigned upload URL lifetime in seconds
+UPLOAD_URL_EXPIRES_IN = 300
+
+# Seconds after which DynamoDB TTL removes a pending image that was never confirmed
+PENDING_UPLOAD_TTL = int(os.environ.get('PENDING_UPLOAD_TTL', '86400'))
+
+# Presigned part URL lifetime for multipart uploads, and S3's limit on parts
+MULTIPART_URL_EXPIRES_IN = 3600
+MAX_MULTIPART_PARTS = 10000
+
+# Maximum number of files in one POST /upload-urls request
+MAX_BATCH_UPLOADS = 100
+
+# Maximum number of image_ids in one POST /confirm-uploads request, and the
+# threads shared by all requests for their S3 HEADs and status updates
+MAX_BATCH_CONFIRMS = 100
+CONFIRM_EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('CONFIRM_MAX_WORKERS', '16')),
+    thread_name_prefix='confirm'
+)
+
+# Maximum number of image_ids in one bulk delete request, and images deleted per chunk
+MAX_BULK_DELETE_IDS = 1000
+BULK_DELETE_CHUNK = 1000
+
+# Content hashes accepted in the sha256 field of upload requests
+SHA256_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+# Page size bounds for GET /images
+DEFAULT_LIST_LIMIT = 100
+MAX_LIST_LIMIT = 1000
+
+# Response bodies at least this large are gzip encoded for clients that accept it
+GZIP_MIN_BYTES = int(os.environ.get('GZIP_MIN_BYTES', '1024'))
+GZIP_LEVEL = 6
+
+def encode_page_token(key):
+    """Encode a DynamoDB key as an opaque next_token"""
+    raw = dumps(key)
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_page_token(token):
+    """Decode a next_token back into a DynamoDB key, ValueError if malformed"""
+    try:
+        key = json.loads(base64.urlsafe_b64decode(token.encode()))
+    except (binascii.Error, UnicodeDecodeError, json.JSONDecodeError):
+        raise ValueError('Invalid next_token')
+    if not isinstance(key, dict) or not key:
+        raise ValueError('Invalid next_token')
+    return key
+
+def parse_limit(value):
+    """Parse the limit query parameter, ValueError if out of range"""
+    if value is None:
+        return DEFAULT_LIST_LIMIT
+    limit = int(value)
+    if limit < 1 or limit > MAX_LIST_LIMIT:
+        raise ValueError(f'limit must be between 1 and {MAX_LIST_LIMIT}')
+    return limit
+
+def serialize(body):
+    """Encode a response body, timed as the serialize span"""
+    with span('serialize'):
+        return dumps(body)
+
+def response(status_code, body):
+    """Create Lambda response"""
+    return {
+        'statusCode': status_code,
+        'headers': {'Content-Type': 'application/json'},
+        'body': serialize(body)
+    }
+
+def request_header(event, name):
+    """Case-insensitive lookup of a request header, None if absent"""
+    name = name.lower()
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name:
+            return value
+    return None
+
+def etag_matches(if_none_match, etag):
+    """Weak comparison of an If-None-Match header against an ETag"""
+    if not if_none_match:
+        return False
+    opaque = lambda tag: tag[2:] if tag.startswith('W/') else tag
+    tags = {opaque(tag.strip()) for tag in if_none_match.split(',')}
+    return '*' in tags or opaque(etag) in tags
+
+def cached_response(event, body):
+    """200 response tagged with an ETag of its body, or an empty 304 if the client already has it
+    
+    The ETag hashes the serialized body rather than a per-user version, as
+    bodies embed presigned URLs: a client must revalidate to new ones when
+    their expiry window moves on even if no image changed.
+    """
+    res = response(200, body)
+    digest = hashlib.blake2b(res['body'].encode(), digest_size=16).hexdigest()
+    # Vary on every cacheable response, as encode_response may gzip the same body for other clients
+    headers = {'ETag': f'W/"{digest}"', 'Cache-Control': 'private, no-cache', 'Vary': 'Accept-Encoding'}
+    if etag_matches(request_header(event, 'If-None-Match'), headers['ETag']):
+        return {'statusCode': 304, 'headers': headers, 'body': ''}
+    res['headers'].update(headers)
+    return res
+
+def accepts_gzip(event):
+    """Whether the Accept-Encoding header of a request allows gzip, an explicit gzip entry overriding *"""
+    qualities = {}
+    for coding in (request_header(event, 'Accept-Encoding') or '').split(','):
+        name, _, params = coding.partition(';')
+        quality = params.strip().replace(' ', '')
+        try:
+            qualities[name.strip().lower()] = float(quality[2:]) if quality.startswith('q=') else 1.0
+        except ValueError:
+            qualities[name.strip().lower()] = 0.0
+    return qualities.get('gzip', qualities.get('*', 0.0)) > 0
+
+def encode_response(event, res):
+    """Gzip a large response body for clients that accept it, base64 encoded for the Lambda proxy"""
+    body = res.get('body')
+    if (res.get('isBase64Encoded') or not isinstance(body, str)
+            or len(body) < GZIP_MIN_BYTES or not accepts_gzip(event)):
+        return res
+    compressed = gzip.compress(body.encode(), compresslevel=GZIP_LEVEL)
+    headers = dict(res.get('headers') or {}, **{'Content-Encoding': 'gzip', 'Vary': 'Accept-Encoding'})
+    return dict(res, headers=headers, body=base64.b64encode(compressed).decode(), isBase64Encoded=True)
+
+def new_image_item(user_id, filename, content_type, caption='', tags=None):
+    """Build the pending metadata item of a new image"""
+    # Generate unique image ID
+    image_id = str(uuid.uuid4())
+    
+    # Create S3 key
+    file_extension = filename.split('.')[-1] if '.' in filename else 'jpg'
+    s3_key = f"{user_id}/{image_id}.{file_extension}"
+    now = datetime.utcnow()
+    
+    return {
+        'user_id': user_id,
+        'image_id': image_id,
+        'filename': filename,
+        'content_type': content_type,
+        's3_key': s3_key,
+        'status': 'pending',
+        'created_at': now.isoformat() + 'Z',
+        'expires_at': int(now.replace(tzinfo=timezone.utc).timestamp()) + PENDING_UPLOAD_TTL,
+        'caption': caption,
+        'tags': tags or []
+    }
+
+def parse_sha256(value):
+    """Validate the optional sha256 field of an upload request, ValueError if malformed"""
+    if value is None:
+        return None
+    if not isinstance(value, str) or not SHA256_PATTERN.match(value.lower()):
+        raise ValueError('sha256 must be a hex encoded SHA-256 digest')
+    return value.lower()
+
+def sha256_checksum(sha256):
+    """S3 ChecksumSHA256 value (base64 digest) of a hex digest"""
+    return base64.b64encode(bytes.fromhex(sha256)).decode()
+
+def new_pending_upload(user_id, filename, content_type, caption='', tags=None, sha256=None):
+    """Presign an upload for a new image and build its pending metadata item"""
+    item = new_image_item(user_id, filename, content_type, caption, tags)
+    if sha256:
+        item['sha256'] = sha256
+    
+    # Generate presigned URL, bound to the declared content hash if any
+    upload_url = generate_presigned_upload_url(
+        bucket=S3_BUCKET,
+        key=item['s3_key'],
+        content_type=content_type,
+        expires_in=UPLOAD_URL_EXPIRES_IN,
+        checksum_sha256=sha256_checksum(sha256) if sha256 else None
+    )
+    return item, upload_url
+
+def new_deduplicated_image(user_id, filename, content_type, caption, tags, sha256):
+    """Build an uploaded image sharing the user's existing file with this content, None if there is none"""
+    item = new_image_item(user_id, filename, content_type, caption, tags)
+    content = acquire_content(DDB_TABLE, user_id, sha256, item['image_id'])
+    if not content:
+        return None
+    item.pop('expires_at')
+    item.update(status='uploaded', s3_key=content['s3_key'], sha256=sha256)
+    for field in ('file_size', 'derivatives'):
+        if content.get(field):
+            item[field] = content[field]
+    item[COUNTED_ATTRIBUTE] = item.get('file_size', 0)
+    return item
+
+def index_content(item, file_metadata):
+    """Index a confirmed image by its sha256 once S3 has verified it, so later uploads can share it"""
+    sha256 = item.get('sha256')
+    checksum = file_metadata.get('checksum_sha256')
+    if not sha256 or not checksum or checksum != sha256_checksum(sha256):
+        return False
+    try:
+        return register_content(DDB_TABLE, item['user_id'], sha256, item['s3_key'],
+                                item['image_id'], file_metadata['file_size'])
+    except Exception as e:
+        # The image stays a standalone copy, only deduplication is lost
+        print(f"Failed to index content of {item['image_id']}: {str(e)}")
+        return False
+
+def release_image_file(item):
+    """Drop an uploaded image's claim on its S3 object, returns True if the object should be deleted"""
+    if not item.get('sha256'):
+        return True
+    return release_content(DDB_TABLE, item['user_id'], item['sha256'], item['s3_key'], item['image_id'])
+
+@instrumented
+def upload_url_handler(event, context):
+    """Generate presigned URL for image upload"""
+    try:
+        body = json.loads(event.get('body', '{}'))
+        
+        # Validate required fields
+        required_fields = ['user_id', 'filename', 'content_type']
+        for field in required_fields:
+            if field not in body:
+                return response(400, {'error': f'Missing required field: {field}'})
+        try:
+            sha256 = parse_sha256(body.get('sha256'))
+        except ValueError as e:
+            return response(400, {'error': str(e)})
+        
+        # The user already uploaded this content: reference the existing file instead
+        if sha256:
+            item = new_deduplicated_image(
+                user_id=body['user_id'],
+                filename=body['filename'],
+                content_type=body['content_type'],
+                caption=body.get('caption', ''),
+                tags=body.get('tags', []),
+                sha256=sha256
+            )
+            if item:
+                try:
+                    put_image_metadata(DDB_TABLE, item)
+                except Exception:
+                    release_image_file(item)
+                    raise
+                add_user_stats(DDB_TABLE, item['user_id'], 1, item[COUNTED_ATTRIBUTE])
+                return response(200, {
+                    'image_id': item['image_id'],
+                    'status': 'uploaded',
+                    'deduplicated': True
+                })
+        
+        item, upload_url = new_pending_upload(
+            user_id=body['user_id'],
+            filename=body['filename'],
+            content_type=body['content_type'],
+            caption=body.get('caption', ''),
+            tags=body.get('tags', []),
+            sha256=sha256
+        )
+        
+        # Store pending metadata in DynamoDB
+        put_image_metadata(DDB_TABLE, item)
+        
+        return response(200, {
+            'image_id': item['image_id'],
+            'upload_url': upload_url,
+            'expires_in': UPLOAD_URL_EXPIRES_IN,
+            'deduplicated': False
+        })
+    
+    except Exception as e:
+        return response(500, {'error': f'Upload URL generation failed: {str(e)}'})
+
+@instrumented
+def batch_upload_url_handler(event, context):
+    """Generate presigned URLs for a batch of image uploads"""
+    try:
+        body = json.loads(event.get('body', '{}'))
+        
+        user_id = body.get('user_id')
+        files = body.get('files')
+        if not user_id:
+            return response(400, {'error': 'Missing required field: user_id'})
+        if not isinstance(files, list) or not files:
+            return response(400, {'error': 'files must be a non-empty list'})
+        if len(files) > MAX_BATCH_UPLOADS:
+            return response(400, {'error': f'At most {MAX_BATCH_UPLOADS} files per request'})
+        
+        results = []
+        new_items = []
+        deduplicated = {}
+        for index, file in enumerate(files):
+            missing = [f for f in ('filename', 'content_type') if f not in (file or {})]
+            if missing:
+                results.append({'index': index, 'error': f'Missing required field: {missing[0]}'})
+                continue
+            try:
+                sha256 = parse_sha256(file.get('sha256'))
+            except ValueError as e:
+                results.append({'index': index, 'error': str(e)})
+                continue
+            
+            item = None
+            if sha256:
+                item = new_deduplicated_image(
+                    user_id=user_id,
+                    filename=file['filename'],
+                    content_type=file['content_type'],
+                    caption=file.get('caption', ''),
+                    tags=file.get('tags', []),
+                    sha256=sha256
+                )
+            if item:
+                deduplicated[item['image_id']] = item
+                new_items.append(item)
+                results.append({
+                    'index': index,
+                    'filename': file['filename'],
+                    'image_id': item['image_id'],
+                    'status': 'uploaded',
+                    'deduplicated': True
+                })
+                continue
+            
+            item, upload_url = new_pending_upload(
+                user_id=user_id,
+                filename=file['filename'],
+                content_type=file['content_type'],
+                caption=file.get('caption', ''),
+                tags=file.get('tags', []),
+                sha256=sha256
+            )
+            new_items.append(item)
+            results.append({
+                'index': index,
+                'filename': file['filename'],
+                'image_id': item['image_id'],
+                'upload_url': upload_url,
+                'expires_in': UPLOAD_URL_EXPIRES_IN,
+                'deduplicated': False
+            })
+        
+        # Store all new metadata with batched writes
+        failed = set(batch_put_image_metadata(DDB_TABLE, new_items))
+        counted = [item[COUNTED_ATTRIBUTE] for image_id, item in deduplicated.items() if image_id not in failed]
+        if counted:
+            add_user_stats(DDB_TABLE, user_id, len(counted), sum(counted))
+        for result in results:
+            image_id = result.get('image_id')
+            if image_id in failed:
+                if image_id in deduplicated:
+                    release_image_file(deduplicated[image_id])
+                for field in ('upload_url', 'expires_in', 'status', 'deduplicated'):
+                    result.pop(field, None)
+                result['error'] = 'Failed to store image metadata'
+        
+        return response(200, {
+            'count': sum(1 for r in results if 'error' not in r),
+            'uploads': results
+        })
+    
+    except Exception as e:
+        return response(500, {'error': f'Batch upload URL generation failed: {str(e)}'})
+
+@instrumented
+def confirm_upload_handler(event, context):
+    """Confirm image upload completion"""
+    try:
+        body = json.loads(event.get('body', '{}'))
+        
+        if 'image_id' not in body:
+            return response(400, {'error': 'Missing required field: image_id'})
+        
+        image_id = body['image_id']
+        user_id = body.get('user_id')  # Optional, can be extracted from metadata
+        
+        # Get image metadata
+        if user_id:
+            image_metadata = get_image_metadata(DDB_TABLE, user_id, image_id)
+        else:
+            # If user_id not provided, we need to find it
+            # This is a limitation of the current design - we'll require user_id
+            return response(400, {'error': 'user_id is required'})
+        
+        if not image_metadata:
+            return response(404, {'error': 'Image not found'})
+        
+        # Get file metadata from S3, a single HEAD that also proves the file exists
+        try:
+            file_metadata = get_file_metadata(S3_BUCKET, image_metadata['s3_key'])
+        except ClientError:
+            return response(400, {'error': 'File not found in S3'})
+        
+        # Update DynamoDB with uploaded status and file size, unless the image was deleted meanwhile
+        updated = update_image_status(
+            table_name=DDB_TABLE,
+            user_id=user_id,
+            image_id=image_id,
+            status='uploaded',
+            file_size=file_metadata['file_size']
+        )
+        if not updated:
+            return response(404, {'error': 'Image not found'})
+        index_content(updated, file_metadata)
+        schedule_derivatives(updated)
+        
+        return response(200, {
+            'status': 'success',
+            'image_id': image_id,
+            'file_size': file_metadata['file_size']
+        })
+    
+    except Exception as e:
+        return response(500, {'error': f'Upload confirmation failed: {str(e)}'})
+
+def confirm_image(item):
+    """HEAD the uploaded file and mark the image uploaded, returns a per-image result"""
+    image_id = item['image_id']
+    try:
+        file_metadata = get_file_metadata(S3_BUCKET, item['s3_key'])
+    except ClientError:
+        return {'image_id': image_id, 'error': 'File not found in S3'}
+    
+    updated = update_image_status(
+        table_name=DDB_TABLE,
+        user_id=item['user_id'],
+        image_id=image_id,
+        status='uploaded',
+        file_size=file_metadata['file_size']
+    )
+    if not updated:
+        return {'image_id': image_id, 'error': 'Image not found'}
+    index_content(updated, file_metadata)
+    schedule_derivatives(updated)
+    return {'image_id': image_id, 'status': 'success', 'file_size': file_metadata['file_size']}
+
+@instrumented
+def batch_confirm_upload_handler(event, context):
+    """Confirm many uploads of one user, checking and updating the images concurrently"""
+    try:
+        body = json.loads(event.get('body', '{}'))
+        
+        user_id = body.get('user_id')
+        image_ids = body.get('image_ids')
+        if not user_id:
+            return response(400, {'error': 'Missing required field: user_id'})
+        if not isinstance(image_ids, list) or not image_ids or not all(isinstance(i, str) for i in image_ids):
+            return response(400, {'error': 'image_ids must be a non-empty list of strings'})
+        if len(image_ids) > MAX_BATCH_CONFIRMS:
+            return response(400, {'error': f'At most {MAX_BATCH_CONFIRMS} image_ids per request'})
+        image_ids = list(dict.fromkeys(image_ids))
+        
+        # One BatchGetItem for all metadata, then HEAD + update per image on the shared pool
+        items = {item['image_id']: item for item in batch_get_image_metadata(DDB_TABLE, user_id, image_ids)}
+        futures = {image_id: CONFIRM_EXECUTOR.submit(contextvars.copy_context().run, confirm_image, items[image_id])
+                   for image_id in image_ids if image_id in items}
+        
+        results = []
+        for image_id in image_ids:
+            if image_id not in futures:
+                results.append({'image_id': image_id, 'error': 'Image not found'})
+                continue
+            try:
+                results.append(futures[image_id].result())
+            except Exception as e:
+                results.append({'image_id': image_id, 'error': f'Upload confirmation failed: {str(e)}'})
+        
+        return response(200, {
+            'count': sum(1 for r in results if 'error' not in r),
+            'results': results
+        })
+    
+    except Exception as e:
+        return response(500, {'error': f'Batch upload confirmation failed: {str(e)}'})
+
+def derivative_urls(item):
+    """Presigned download URL of each rendition of an uploaded image, keyed by size name"""
+    if item.get('status') != 'uploaded':
+        return {}
+    urls = {}
+    for name, derivative in (item.get('derivatives') or {}).items():
+        try:
+            urls[name] = generate_presigned_download_url(
+                bucket=S3_BUCKET,
+                key=derivative['s3_key'],
+                expires_in=3600
+            )
+        except Exception:
+            urls[name] = None
+    return urls
+
+def parse_fields(value):
+    """Parse the fields query parameter into a list of attribute names, None for all"""
+    if not value:
+        return None
+    fields = list(dict.fromkeys(f.strip() for f in value.split(',') if f.strip()))
+    return fields or None
+
+@instrumented
+def list_images_handler(event, context):
+    """List images with filters, a sparse fieldset or only their count"""
+    try:
+        query_params = event.get('queryStringParameters') or {}
+        user_id = query_params.get('user_id')
+        tag = query_params.get('tag')
+        start_date = query_params.get('start_date')
+        end_date = query_params.get('end_date')
+        order = query_params.get('order', 'asc')
+        fields = parse_fields(query_params.get('fields'))
+        count_only = query_params.get('count_only') == 'true'
+        
+        if not user_id:
+            return response(400, {'error': 'user_id is required'})
+        if order not in ('asc', 'desc'):
+            return response(400, {'error': 'order must be asc or desc'})
+        
+        if count_only:
+            count = count_images(DDB_TABLE, user_id, tag=tag, start_date=start_date, end_date=end_date)
+            return cached_response(event, {'count': count})
+        
+        try:
+            limit = parse_limit(query_params.get('limit'))
+            next_token = query_params.get('next_token')
+            start_key = decode_page_token(next_token) if next_token else None
+        except ValueError as e:
+            return response(400, {'error': str(e)})
+        by_date = bool(start_date or end_date or order == 'desc')
+        if start_key and (start_key.get('user_id') != user_id or 'image_id' not in start_key
+                          or (by_date and 'created_at' not in start_key)):
+            return response(400, {'error': 'Invalid next_token'})
+        
+        # Only read the attributes asked for, plus those needed to presign
+        with_download_url = not fields or 'download_url' in fields
+        with_derivative_urls = not fields or 'derivative_urls' in fields
+        projection = None
+        if fields:
+            projection = [f for f in fields if f not in ('download_url', 'derivative_urls')]
+            if with_download_url or with_derivative_urls:
+                projection += ['status', 's3_key']
+            if with_derivative_urls:
+                projection.append('derivatives')
+        
+        # Stream images from DynamoDB until the page is full, generating download
+        # URLs for uploaded images while any further page is fetched
+        items = []
+        next_token = None
+        images = get_images(
+            DDB_TABLE, user_id,
+            tag=tag,
+            start_date=start_date,
+            end_date=end_date,
+            descending=order == 'desc',
+            start_key=start_key,
+            page_size=limit,
+            fields=projection
+        )
+        for item in images:
+            if with_download_url:
+                if item.get('status') == 'uploaded':
+                    try:
+                        item['download_url'] = generate_presigned_download_url(
+                            bucket=S3_BUCKET,
+                            key=item['s3_key'],
+                            expires_in=3600
+                        )
+                    except:
+                        item['download_url'] = None
+                else:
+                    item['download_url'] = None
+            if with_derivative_urls:
+                item['derivative_urls'] = derivative_urls(item)
+            items.append(item)
+            if len(items) == limit:
+                next_token = encode_page_token(item_key(item))
+                break
+        
+        if fields:
+            items = [{f: item[f] for f in fields if f in item} for item in items]
+        
+        return cached_response(event, {
+            'count': len(items),
+            'images': items,
+            'next_token': next_token
+        })
+    
+    except Exception as e:
+        return response(500, {'error': f'List images failed: {str(e)}'})
+
+@instrumented
+def get_image_handler(event, context):
+    """Get single image details and download URL"""
+    try:
+        path_params = event.get('pathParameters') or {}
+        user_id = path_params.get('user_id')
+        image_id = path_params.get('image_id')
+        
+        if not user_id or not image_id:
+            return response(400, {'error': 'user_id and image_id are required'})
+        
+        # Get image metadata
+        item = get_image_metadata(DDB_TABLE, user_id, image_id)
+        if not item:
+            return response(404, {'error': 'Image not found'})
+        
+        # Generate download URL if image is uploaded
+        if item.get('status') == 'uploaded':
+            try:
+                download_url = generate_presigned_download_url(
+                    bucket=S3_BUCKET,
+                    key=item['s3_key'],
+                    expires_in=3600
+                )
+                item['download_url'] = download_url
+            except:
+                item['download_url'] = None
+        else:
+            item['download_url'] = None
+        item['derivative_urls'] = derivative_urls(item)
+        
+        return cached_response(event, item)
+    
+    except Exception as e:
+        return response(500, {'error': f'Get image failed: {str(e)}'})
+
+@instrumented
+def delete_image_handler(event, context):
+    """Delete image from S3 and DynamoDB"""
+    try:
+        path_params = event.get('pathParameters') or {}
+        user_id = path_params.get('user_id')
+        image_id = path_params.get('image_id')
+        
+        if not user_id or not image_id:
+            return response(400, {'error': 'user_id and image_id are required'})
+        
+        # Delete from DynamoDB first: the item it returns has the current status,
+        # which the metadata cache may not if another Lambda confirmed the upload
+        item = delete_image_metadata(DDB_TABLE, user_id, image_id)
+        if not item:
+            return response(404, {'error': 'Image not found'})
+        
+        # Delete the file and its renditions from S3 if it exists and no other image shares it
+        if item.get('status') == 'uploaded' and item.get('s3_key') and release_image_file(item):
+            try:
+                for key, error in delete_s3_objects(S3_BUCKET, [item['s3_key']] + derived_keys(item)).items():
+                    print(f"Failed to delete S3 file {key}: {error}")
+            except Exception as e:
+                print(f"Failed to delete S3 file: {str(e)}")
+        
+        return response(200, {
+            'deleted': True,
+            'image_id': image_id
+        })
+    
+    except Exception as e:
+        return response(500, {'error': f'Delete image failed: {str(e)}'})
+
+
+@instrumented
+def user_stats_handler(event, context):
+    """Image count and total bytes of a user's uploaded images, from the incrementally kept stats row"""
+    try:
+        path_params = event.get('pathParameters') or {}
+        user_id = path_params.get('user_id')
+        
+        if not user_id:
+            return response(400, {'error': 'user_id is required'})
+        
+        return cached_response(event, get_user_stats(DDB_TABLE, user_id))
+    
+    except Exception as e:
+        return response(500, {'error': f'Get user stats failed: {str(e)}'})
+
+def delete_images(items):
+    """Delete a chunk of images from S3 and DynamoDB, returns {image_id: error} for failures
+    
+    Images whose S3 object could not be deleted keep their metadata so the
+    delete can be retried. Objects still shared with other images are kept.
+    """
+    s3_keys = {}
+    errors = {}
+    for item in items:
+        if item.get('status') != 'uploaded' or not item.get('s3_key'):
+            continue
+        try:
+            if release_image_file(item):
+                for key in [item['s3_key']] + derived_keys(item):
+                    s3_keys.setdefault(key, []).append(item['image_id'])
+        except Exception as e:
+            errors[item['image_id']] = f'Failed to release S3 file: {str(e)}'
+    for key, error in delete_s3_objects(S3_BUCKET, s3_keys).items():
+        for image_id in s3_keys[key]:
+            errors[image_id] = f'Failed to delete S3 file: {error}'
+    
+    items = [item for item in items if item['image_id'] not in errors]
+    for image_id in batch_delete_image_metadata(DDB_TABLE, items):
+        errors[image_id] = 'Failed to delete image metadata'
+    return errors
+
+@instrumented
+def bulk_delete_images_handler(event, context):
+    """Delete a list of images, or all images of a user"""
+    try:
+        body = json.loads(event.get('body', '{}'))
+        
+        user_id = body.get('user_id')
+        image_ids = body.get('image_ids')
+        delete_all = body.get('all') is True
+        
+        if not user_id:
+            return response(400, {'error': 'Missing required field: user_id'})
+        if delete_all == (image_ids is not None):
+            return response(400, {'error': 'Provide either image_ids or all=true'})
+        if image_ids is not None:
+            if not isinstance(image_ids, list) or not image_ids:
+                return response(400, {'error': 'image_ids must be a non-empty list'})
+            if len(image_ids) > MAX_BULK_DELETE_IDS:
+                return response(400, {'error': f'At most {MAX_BULK_DELETE_IDS} image_ids per request'})
+        
+        deleted = 0
+        errors = {}
+        not_found = []
+        
+        if delete_all:
+            # Page through the user's images and delete them chunk by chunk
+            chunk = []
+            for item in get_images(DDB_TABLE, user_id, page_size=BULK_DELETE_CHUNK):
+                chunk.append(item)
+                if len(chunk) == BULK_DELETE_CHUNK:
+                    chunk_errors = delete_images(chunk)
+                    deleted += len(chunk) - len(chunk_errors)
+                    errors.update(chunk_errors)
+                    chunk = []
+            if chunk:
+                chunk_errors = delete_images(chunk)
+                deleted += len(chunk) - len(chunk_errors)
+                errors.update(chunk_errors)
+        else:
+            items = batch_get_image_metadata(DDB_TABLE, user_id, image_ids)
+            found = {item['image_id'] for item in items}
+            not_found = [image_id for image_id in dict.fromkeys(image_ids) if image_id not in found]
+            errors = delete_images(items)
+            deleted = len(items) - len(errors)
+        
+        return response(200, {
+            'deleted': deleted,
+            'not_found': not_found,
+            'failed': [{'image_id': image_id, 'error': error} for image_id, error in errors.items()]
+        })
+    
+    except Exception as e:
+        return response(500, {'error': f'Bulk delete failed: {str(e)}'})
+
+def parse_image_key(key):
+    """Split an S3 key of the form user_id/image_id.ext, None if it does not match"""
+    parts = key.split('/')
+    if len(parts) != 2 or not parts[0] or not parts[1]:
+        return None
+    image_id = parts[1].rsplit('.', 1)[0]
+    if not image_id:
+        return None
+    return parts[0], image_id
+
+def process_s3_record(record):
+    """Mark the image of one S3 ObjectCreated record uploaded, returns True if an image was updated"""
+    if not record.get('eventName', '').startswith('ObjectCreated:'):
+        return False
+    s3_object = record['s3']['object']
+    parsed = parse_image_key(unquote_plus(s3_object['key']))
+    if not parsed:
+        return False
+    user_id, image_id = parsed
+    updated = update_image_status(
+        table_name=DDB_TABLE,
+        user_id=user_id,
+        image_id=image_id,
+        status='uploaded',
+        file_size=s3_object.get('size')
+    )
+    if updated is None:
+        return False
+    if updated.get('sha256'):
+        index_content(updated, get_file_metadata(S3_BUCKET, updated['s3_key']))
+    generate_on_event(updated)
+    return True
+
+@instrumented
+def s3_event_handler(event, context):
+    """Confirm uploads from S3 ObjectCreated notifications, delivered directly or through SQS
+    
+    SQS batches report failed messages in batchItemFailures so only those
+    are retried. Direct S3 invocations raise on failure so Lambda retries.
+    """
+    updated = 0
+    skipped = 0
+    batch_item_failures = []
+    
+    for record in event.get('Records', []):
+        if record.get('eventSource') == 'aws:sqs':
+            try:
+                s3_records = json.loads(record['body']).get('Records', [])
+                for s3_record in s3_records:
+                    if process_s3_record(s3_record):
+                        updated += 1
+                    else:
+                        skipped += 1
+            except Exception as e:
+                print(f"Failed to process message {record.get('messageId')}: {str(e)}")
+                batch_item_failures.append({'itemIdentifier': record['messageId']})
+        elif process_s3_record(record):
+            updated += 1
+        else:
+            skipped += 1
+    
+    return {
+        'updated': updated,
+        'skipped': skipped,
+        'batchItemFailures': batch_item_failures
+    }
+
+def parse_part_numbers(value):
+    """Validate a list of part numbers, ValueError if any is out of range"""
+    if not isinstance(value, list) or not value:
+        raise ValueError('part_numbers must be a non-empty list')
+    if not all(isinstance(p, int) and 1 <= p <= MAX_MULTIPART_PARTS for p in value):
+        raise ValueError(f'part numbers must be between 1 and {MAX_MULTIPART_PARTS}')
+    return sorted(set(value))
+
+@instrumented
+def multipart_upload_handler(event, context):
+    """Start a multipart upload and presign a URL per part"""
+    try:
+        body = json.loads(event.get('body', '{}'))
+        
+        # Validate required fields
+        required_fields = ['user_id', 'filename', 'content_type', 'part_count']
+        for field in required_fields:
+            if field not in body:
+                return response(400, {'error': f'Missing required field: {field}'})
+        
+        part_count = body['part_count']
+        if not isinstance(part_count, int) or not 1 <= part_count <= MAX_MULTIPART_PARTS:
+            return response(400, {'error': f'part_count must be between 1 and {MAX_MULTIPART_PARTS}'})
+        
+        item = new_image_item(
+            user_id=body['user_id'],
+            filename=body['filename'],
+            content_type=body['content_type'],
+            caption=body.get('caption', ''),
+            tags=body.get('tags', [])
+        )
+        item['upload_id'] = create_multipart_upload(S3_BUCKET, item['s3_key'], item['content_type'])
+        
+        parts = generate_presigned_part_urls(
+            S3_BUCKET, item['s3_key'], item['upload_id'],
+            range(1, part_count + 1),
+            expires_in=MULTIPART_URL_EXPIRES_IN
+        )
+        
+        # Store pending metadata in DynamoDB
+        put_image_metadata(DDB_TABLE, item)
+        
+        return response(200, {
+            'image_id': item['image_id'],
+            'upload_id': item['upload_id'],
+            'parts': parts,
+            'expires_in': MULTIPART_URL_EXPIRES_IN
+        })
+    
+    except Exception as e:
+        return response(500, {'error': f'Multipart upload creation failed: {str(e)}'})
+
+@instrumented
+def multipart_part_urls_handler(event, context):
+    """Presign fresh URLs for some parts of a multipart upload, to resume it"""
+    try:
+        body = json.loads(event.get('body', '{}'))
+        
+        # Validate required fields
+        required_fields = ['user_id', 'image_id', 'part_numbers']
+        for field in required_fields:
+            if field not in body:
+                return response(400, {'error': f'Missing required field: {field}'})
+        
+        try:
+            part_numbers = parse_part_numbers(body['part_numbers'])
+        except ValueError as e:
+            return response(400, {'error': str(e)})
+        
+        item = get_image_metadata(DDB_TABLE, body['user_id'], body['image_id'])
+        if not item or not item.get('upload_id'):
+            return response(404, {'error': 'Multipart upload not found'})
+        if item.get('status') == 'uploaded':
+            return response(409, {'error': 'Upload already completed'})
+        
+        parts = generate_presigned_part_urls(
+            S3_BUCKET, item['s3_key'], item['upload_id'], part_numbers,
+            expires_in=MULTIPART_URL_EXPIRES_IN
+        )
+        
+        return response(200, {
+            'image_id': item['image_id'],
+            'upload_id': item['upload_id'],
+            'parts': parts,
+            'expires_in': MULTIPART_URL_EXPIRES_IN
+        })
+    
+    except Exception as e:
+        return response(500, {'error': f'Part URL generation failed: {str(e)}'})
+
+@instrumented
+def complete_multipart_handler(event, context):
+    """Complete a multipart upload and mark the image uploaded"""
+    try:
+        body = json.loads(event.get('body', '{}'))
+        
+        # Validate required fields
+        required_fields = ['user_id', 'image_id', 'parts']
+        for field in required_fields:
+            if field not in body:
+                return response(400, {'error': f'Missing required field: {field}'})
+        
+        user_id = body['user_id']
+        image_id = body['image_id']
+        try:
+            parts = [(part['part_number'], part['etag']) for part in body['parts']]
+            parse_part_numbers([part_number for part_number, _ in parts])
+        except (TypeError, KeyError):
+            return response(400, {'error': 'parts must be a list of {part_number, etag}'})
+        except ValueError as e:
+            return response(400, {'error': str(e)})
+        
+        item = get_image_metadata(DDB_TABLE, user_id, image_id)
+        if not item or not item.get('upload_id'):
+            return response(404, {'error': 'Multipart upload not found'})
+        
+        try:
+            complete_multipart_upload(S3_BUCKET, item['s3_key'], item['upload_id'], parts)
+        except ClientError as e:
+            return response(400, {'error': f'Multipart upload could not be completed: {str(e)}'})
+        
+        file_metadata = get_file_metadata(S3_BUCKET, item['s3_key'])
+        updated = update_image_status(
+            table_name=DDB_TABLE,
+            user_id=user_id,
+            image_id=image_id,
+            status='uploaded',
+            file_size=file_metadata['file_size']
+        )
+        if not updated:
+            return response(404, {'error': 'Image not found'})
+        schedule_derivatives(updated)
+        
+        return response(200, {
+            'status': 'success',
+            'image_id': image_id,
+            'file_size': file_metadata['file_size']
+        })
+    
+    except Exception as e:
+        return response(500, {'error': f'Multipart upload completion failed: {str(e)}'})
+
+# API Gateway routes served by dispatch, keyed by method and resource template
+ROUTES = {
+    ('POST', '/upload-url'): upload_url_handler,
+    ('POST', '/upload-urls'): batch_upload_url_handler,
+    ('POST', '/confirm-upload'): confirm_upload_handler,
+    ('POST', '/confirm-uploads'): batch_confirm_upload_handler,
+    ('POST', '/multipart-upload'): multipart_upload_handler,
+    ('POST', '/multipart-upload/parts'): multipart_part_urls_handler,
+    ('POST', '/multipart-upload/complete'): complete_multipart_handler,
+    ('GET', '/images'): list_images_handler,
+    ('POST', '/images/bulk-delete'): bulk_delete_images_handler,
+    ('GET', '/images/{user_id}/{image_id}'): get_image_handler,
+    ('DELETE', '/images/{user_id}/{image_id}'): delete_image_handler,
+    ('GET', '/users/{user_id}/stats'): user_stats_handler
+}
+
+# Resource templates split into segments, for events that only carry the raw path
+RESOURCES = sorted({resource for _, resource in ROUTES})
+ROUTE_TEMPLATES = [(resource, resource.strip('/').split('/')) for resource in RESOURCES]
+
+def match_resource(path):
+    """Find the resource template matching a raw path, returns (resource, path parameters)"""
+    segments = path.strip('/').split('/')
+    for resource, template in ROUTE_TEMPLATES:
+        if len(template) != len(segments):
+            continue
+        params = {}
+        for part, segment in zip(template, segments):
+            if part.startswith('{'):
+                if not segment:
+                    break
+                params[part[1:-1]] = unquote_plus(segment)
+            elif part != segment:
+                break
+        else:
+            return resource, params
+    return None, {}
+
+def dispatch(event, context):
+    """Single Lambda entry point, routes API Gateway events to their handler"""
+    method = event.get('httpMethod', '').upper()
+    resource = event.get('resource')
+    
+    # Bodies of binary media types arrive base64 encoded
+    if event.get('isBase64Encoded') and event.get('body'):
+        event = dict(event, body=base64.b64decode(event['body']).decode(), isBase64Encoded=False)
+    
+    # Direct invocations and {proxy+} resources only carry the path
+    if resource not in RESOURCES:
+        resource, params = match_resource(event.get('path') or '')
+        if resource is None:
+            return response(404, {'error': 'Route not found'})
+        event = dict(event, pathParameters=params)
+    
+    handler = ROUTES.get((method, resource))
+    if handler is None:
+        return response(405, {'error': f'Method {method or "?"} not allowed on {resource}'})
+    return encode_response(event, handler(event, context))
@@ -0,0 +1,312 @@
+# Latency instrumentation for handlers and AWS calls
+#
+# A sampled invocation records its wall time, payload sizes, every S3 and
+# DynamoDB call it makes (count, wall time, bytes, consumed capacity) and
+# the time spent in named spans such as presigning and serialization. The
+# record is logged as a CloudWatch Embedded Metric Format line and added to
+# in-process totals that app.py exposes in Prometheus text format.
+#
+#   METRICS_SAMPLE_RATE  fraction of invocations to record (default 0, off)
+#   METRICS_EMF          true/false, log an EMF line per sampled invocation (default true)
+#   METRICS_NAMESPACE    CloudWatch namespace (default InstagramImageService)
+#
+# With sampling off a handler pays one float comparison, and every AWS call
+# or span one ContextVar lookup.
+import os
+import json
+import time
+import random
+import threading
+import functools
+import contextvars
+
+SAMPLE_RATE = float(os.environ.get('METRICS_SAMPLE_RATE', '0'))
+EMF_ENABLED = os.environ.get('METRICS_EMF', 'true').lower() == 'true'
+NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'InstagramImageService')
+
+# DynamoDB operations that accept ReturnConsumedCapacity
+CAPACITY_OPERATIONS = frozenset({
+    'GetItem', 'PutItem', 'UpdateItem', 'DeleteItem', 'Query', 'Scan',
+    'BatchGetItem', 'BatchWriteItem', 'TransactGetItems', 'TransactWriteItems'
+})
+
+_current = contextvars.ContextVar('invocation', default=None)
+
+class Invocation:
+    """Measurements of one sampled handler invocation"""
+    
+    def __init__(self, handler):
+        self.handler = handler
+        self.duration_ms = 0.0
+        self.status = None
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.consumed_capacity = 0.0
+        self.calls = {}
+        self.spans = {}
+        self._lock = threading.Lock()
+    
+    def add_call(self, service, operation, ms, request_bytes, response_bytes, capacity):
+        """Record one AWS call, calls may come from worker threads"""
+        with self._lock:
+            stats = self.calls.setdefault((service, operation), [0, 0.0, 0, 0])
+            stats[0] += 1
+            stats[1] += ms
+            stats[2] += request_bytes
+            stats[3] += response_bytes
+            self.consumed_capacity += capacity
+    
+    def add_span(self, name, ms):
+        """Record time spent in a named span"""
+        with self._lock:
+            stats = self.spans.setdefault(name, [0, 0.0])
+            stats[0] += 1
+            stats[1] += ms
+    
+    def service_totals(self):
+        """Call count and wall time per AWS service"""
+        totals = {}
+        for (service, _), (count, ms, _, _) in self.calls.items():
+            total = totals.setdefault(service, [0, 0.0])
+            total[0] += count
+            total[1] += ms
+        return totals
+
+class Registry:
+    """In-process totals of every sampled invocation"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        """Forget all totals"""
+        with self._lock:
+            self.handlers = {}
+            self.statuses = {}
+            self.calls = {}
+            self.capacity = {}
+            self.spans = {}
+    
+    def observe(self, record):
+        """Add a finished invocation to the totals"""
+        with self._lock:
+            stats = self.handlers.setdefault(record.handler, [0, 0.0, 0, 0])
+            stats[0] += 1
+            stats[1] += record.duration_ms
+            stats[2] += record.request_bytes
+            stats[3] += record.response_bytes
+            status_key = (record.handler, str(record.status))
+            self.statuses[status_key] = self.statuses.get(status_key, 0) + 1
+            for key, (count, ms, sent, received) in record.calls.items():
+                stats = self.calls.setdefault(key, [0, 0.0, 0, 0])
+                stats[0] += count
+                stats[1] += ms
+                stats[2] += sent
+                stats[3] += received
+            if record.consumed_capacity:
+                self.capacity[record.handler] = self.capacity.get(record.handler, 0.0) + record.consumed_capacity
+            for name, (count, ms) in record.spans.items():
+                stats = self.spans.setdefault(name, [0, 0.0])
+                stats[0] += count
+                stats[1] += ms
+    
+    def prometheus(self):
+        """Totals in Prometheus text exposition format"""
+        lines = []
+        
+        def metric(name, kind, samples):
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in samples:
+                label_text = ','.join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(f'{name}{{{label_text}}} {value}')
+        
+        with self._lock:
+            metric('handler_invocations_total', 'counter', [
+                ({'handler': h, 'status': s}, n) for (h, s), n in sorted(self.statuses.items())])
+            metric('handler_duration_milliseconds_sum', 'counter', [
+                ({'handler': h}, round(v[1], 3)) for h, v in sorted(self.handlers.items())])
+            metric('handler_duration_milliseconds_count', 'counter', [
+                ({'handler': h}, v[0]) for h, v in sorted(self.handlers.items())])
+            metric('handler_request_bytes_total', 'counter', [
+                ({'handler': h}, v[2]) for h, v in sorted(self.handlers.items())])
+            metric('handler_response_bytes_total', 'counter', [
+                ({'handler': h}, v[3]) for h, v in sorted(self.handlers.items())])
+            metric('aws_calls_total', 'counter', [
+                ({'service': s, 'operation': o}, v[0]) for (s, o), v in sorted(self.calls.items())])
+            metric('aws_call_duration_milliseconds_sum', 'counter', [
+                ({'service': s, 'operation': o}, round(v[1], 3)) for (s, o), v in sorted(self.calls.items())])
+            metric('aws_request_bytes_total', 'counter', [
+                ({'service': s, 'operation': o}, v[2]) for (s, o), v in sorted(self.calls.items())])
+            metric('aws_response_bytes_total', 'counter', [
+                ({'service': s, 'operation': o}, v[3]) for (s, o), v in sorted(self.calls.items())])
+            metric('dynamodb_consumed_capacity_units_total', 'counter', [
+                ({'handler': h}, round(v, 3)) for h, v in sorted(self.capacity.items())])
+            metric('span_duration_milliseconds_sum', 'counter', [
+                ({'span': n}, round(v[1], 3)) for n, v in sorted(self.spans.items())])
+            metric('span_duration_milliseconds_count', 'counter', [
+                ({'span': n}, v[0]) for n, v in sorted(self.spans.items())])
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+def _sampled():
+    """Decide whether to record the next invocation"""
+    return SAMPLE_RATE >= 1 or random.random() < SAMPLE_RATE
+
+def instrumented(handler):
+    """Decorate a Lambda handler to record sampled invocations"""
+    name = handler.__name__
+    
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        if SAMPLE_RATE <= 0 or _current.get() is not None or not _sampled():
+            return handler(event, context)
+        
+        record = Invocation(name)
+        token = _current.set(record)
+        start = time.perf_counter()
+        try:
+            res = handler(event, context)
+        finally:
+            record.duration_ms = (time.perf_counter() - start) * 1000
+            _current.reset(token)
+        
+        record.request_bytes = _size((event or {}).get('body'))
+        if isinstance(res, dict):
+            record.status = res.get('statusCode')
+            record.response_bytes = _size(res.get('body'))
+        REGISTRY.observe(record)
+        if EMF_ENABLED:
+            print(emf_line(record))
+        return res
+    return wrapper
+
+class span:
+    """Context manager that times a named section of the current invocation"""
+    __slots__ = ('name', 'record', 'start')
+    
+    def __init__(self, name):
+        self.name = name
+    
+    def __enter__(self):
+        self.record = _current.get()
+        if self.record is not None:
+            self.start = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc):
+        if self.record is not None:
+            self.record.add_span(self.name, (time.perf_counter() - self.start) * 1000)
+        return False
+
+def timed(name):
+    """Decorate a function to time its calls as a named span"""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def emf_line(record):
+    """CloudWatch Embedded Metric Format log line of one invocation"""
+    values = {
+        'Duration': (record.duration_ms, 'Milliseconds'),
+        'RequestBytes': (record.request_bytes, 'Bytes'),
+        'ResponseBytes': (record.response_bytes, 'Bytes'),
+        'ConsumedCapacity': (record.consumed_capacity, 'Count')
+    }
+    for service, (count, ms) in record.service_totals().items():
+        prefix = 'DynamoDB' if service == 'dynamodb' else service.upper()
+        values[f'{prefix}Calls'] = (count, 'Count')
+        values[f'{prefix}Duration'] = (ms, 'Milliseconds')
+    for name, (count, ms) in record.spans.items():
+        values[f'{name.capitalize()}Duration'] = (ms, 'Milliseconds')
+    
+    doc = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': NAMESPACE,
+                'Dimensions': [['Handler']],
+                'Metrics': [{'Name': name, 'Unit': unit} for name, (_, unit) in values.items()]
+            }]
+        },
+        'Handler': record.handler,
+        'StatusCode': record.status,
+        'AwsCalls': [
+            {'Service': s, 'Operation': o, 'Count': c, 'Duration': round(ms, 3)}
+            for (s, o), (c, ms, _, _) in record.calls.items()
+        ]
+    }
+    doc.update({name: round(value, 3) for name, (value, _) in values.items()})
+    return json.dumps(doc)
+
+def _size(payload):
+    """Size in bytes of a request or response body"""
+    if payload is None:
+        return 0
+    if isinstance(payload, (bytes, bytearray)):
+        return len(payload)
+    if isinstance(payload, str):
+        return len(payload.encode())
+    return 0
+
+def _capacity_units(parsed):
+    """Sum the ConsumedCapacity of a DynamoDB response, one entry or a list"""
+    consumed = parsed.get('ConsumedCapacity')
+    if not consumed:
+        return 0.0
+    if isinstance(consumed, dict):
+        consumed = [consumed]
+    return float(sum(c.get('CapacityUnits', 0) for c in consumed))
+
+def _ask_for_capacity(params, model, **kwargs):
+    """Ask DynamoDB for the consumed capacity of sampled calls"""
+    if _current.get() is not None and model.name in CAPACITY_OPERATIONS:
+        params.setdefault('ReturnConsumedCapacity', 'TOTAL')
+
+def _before_call(model, params, context, **kwargs):
+    """Start timing an AWS call of a sampled invocation"""
+    if _current.get() is not None:
+        context['metrics'] = (
+            model.service_model.service_name, model.name,
+            time.perf_counter(), _size(params.get('body'))
+        )
+
+def _response_size(http_response, model):
+    """Bytes of an AWS response, from Content-Length so streamed bodies are left unread"""
+    if http_response is None:
+        return 0
+    length = http_response.headers.get('Content-Length')
+    if length is not None and length.isdigit():
+        return int(length)
+    if model is not None and model.has_streaming_output:
+        return 0
+    return len(http_response.content or b'')
+
+def _after_call(context, http_response=None, parsed=None, model=None, **kwargs):
+    """Record a finished AWS call, successful or failed"""
+    record = _current.get()
+    started = context.get('metrics')
+    if record is None or started is None:
+        return
+    service, operation, start, request_bytes = started
+    response_bytes = _response_size(http_response, model)
+    record.add_call(
+        service, operation,
+        (time.perf_counter() - start) * 1000,
+        request_bytes,
+        response_bytes,
+        _capacity_units(parsed or {})
+    )
+
+def attach(client):
+    """Register the timing and capacity hooks on a botocore client"""
+    events = client.meta.events
+    events.register('before-parameter-build.dynamodb', _ask_for_capacity)
+    events.register('before-call', _before_call)
+    events.register('after-call', _after_call)
+    events.register('after-call-error', _after_call)
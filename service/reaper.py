@@ -0,0 +1,129 @@
+# Reaper for abandoned uploads: pending images whose upload never completed
+#
+# Stale pending images are found with a parallel segmented Scan. Each one
+# is checked in S3: if the file is there its upload event was lost and the
+# image is marked uploaded, otherwise the image, its tag index rows and any
+# multipart upload are removed. DynamoDB TTL on expires_at is the backstop
+# for pending rows the reaper never reaches.
+#
+# Runs as a scheduled Lambda (service.reaper.reaper_handler) or a CLI:
+#
+#   python -m service.reaper [--dry-run] [--older-than 21600] [--segments 8]
+import os
+import json
+import argparse
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+from .s3_client import get_file_metadata, abort_multipart_upload
+from .dynamo_client import scan_stale_pending, update_image_status, batch_delete_image_metadata
+
+S3_BUCKET = os.environ.get('S3_BUCKET', 'instagram-images-local')
+DDB_TABLE = os.environ.get('DDB_TABLE', 'Images')
+
+# Pending images older than this are reaped; longer than any presigned upload URL lives
+REAPER_STALE_SECONDS = int(os.environ.get('REAPER_STALE_SECONDS', '21600'))
+
+# Parallel Scan segments, each read by its own thread, and threads for the S3 HEADs
+REAPER_SEGMENTS = int(os.environ.get('REAPER_SEGMENTS', '8'))
+REAPER_HEAD_WORKERS = int(os.environ.get('REAPER_HEAD_WORKERS', '16'))
+
+def uploaded_size(item):
+    """Size of the uploaded file of a pending image, None if it is not in S3"""
+    try:
+        return get_file_metadata(S3_BUCKET, item['s3_key'])['file_size']
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
+
+def check_uploads(items, pool):
+    """HEAD the files of a page of images in parallel, returns (found, missing, failed)"""
+    found, missing, failed = [], [], []
+    futures = [(item, pool.submit(uploaded_size, item)) for item in items]
+    for item, future in futures:
+        try:
+            size = future.result()
+        except Exception as e:
+            print(f"Failed to check {item['s3_key']}: {str(e)}")
+            failed.append(item)
+            continue
+        if size is None:
+            missing.append(item)
+        else:
+            found.append((item, size))
+    return found, missing, failed
+
+def reap_page(items, pool, dry_run):
+    """Confirm the images whose file exists and delete the others, returns counts"""
+    found, missing, failed = check_uploads(items, pool)
+    counts = {'confirmed': len(found), 'deleted': len(missing), 'failed': len(failed)}
+    if dry_run:
+        return counts
+    
+    for item, size in found:
+        try:
+            update_image_status(DDB_TABLE, item['user_id'], item['image_id'], 'uploaded', file_size=size)
+        except Exception as e:
+            print(f"Failed to confirm {item['image_id']}: {str(e)}")
+            counts['confirmed'] -= 1
+            counts['failed'] += 1
+    for item in missing:
+        if item.get('upload_id'):
+            try:
+                abort_multipart_upload(S3_BUCKET, item['s3_key'], item['upload_id'])
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'NoSuchUpload':
+                    print(f"Failed to abort multipart upload of {item['s3_key']}: {str(e)}")
+    not_deleted = batch_delete_image_metadata(DDB_TABLE, missing)
+    counts['deleted'] -= len(not_deleted)
+    counts['failed'] += len(not_deleted)
+    return counts
+
+def reap(older_than=REAPER_STALE_SECONDS, segments=REAPER_SEGMENTS, dry_run=False, now=None):
+    """Reap pending images created more than older_than seconds ago, returns a summary"""
+    now = now or datetime.utcnow()
+    created_before = (now - timedelta(seconds=older_than)).isoformat() + 'Z'
+    summary = {'scanned': 0, 'stale': 0, 'confirmed': 0, 'deleted': 0, 'failed': 0}
+    lock = threading.Lock()
+    
+    def reap_segment(segment, head_pool):
+        for scanned, items in scan_stale_pending(DDB_TABLE, created_before, segment, segments):
+            counts = reap_page(items, head_pool, dry_run) if items else {}
+            with lock:
+                summary['scanned'] += scanned
+                summary['stale'] += len(items)
+                for key, value in counts.items():
+                    summary[key] += value
+    
+    with ThreadPoolExecutor(max_workers=REAPER_HEAD_WORKERS, thread_name_prefix='reaper-head') as head_pool, \
+         ThreadPoolExecutor(max_workers=segments, thread_name_prefix='reaper-scan') as scan_pool:
+        for future in [scan_pool.submit(reap_segment, segment, head_pool) for segment in range(segments)]:
+            future.result()
+    
+    summary['dry_run'] = dry_run
+    summary['created_before'] = created_before
+    return summary
+
+def reaper_handler(event, context):
+    """Scheduled Lambda entry point, event may override dry_run, older_than and segments"""
+    event = event or {}
+    return reap(
+        older_than=int(event.get('older_than', REAPER_STALE_SECONDS)),
+        segments=int(event.get('segments', REAPER_SEGMENTS)),
+        dry_run=bool(event.get('dry_run', False))
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description='Reap abandoned pending uploads')
+    parser.add_argument('--dry-run', action='store_true', help='report what would change without writing')
+    parser.add_argument('--older-than', type=int, default=REAPER_STALE_SECONDS, help='seconds since creation')
+    parser.add_argument('--segments', type=int, default=REAPER_SEGMENTS, help='parallel Scan segments')
+    args = parser.parse_args()
+    print(json.dumps(reap(older_than=args.older_than, segments=args.segments, dry_run=args.dry_run), indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -1,39 +1,212 @@
-# S3 client for presigned URL operations
-import os
-import boto3
-from botocore.exceptions import ClientError
-
-S3 = boto3.client('s3', endpoint_url=os.environ.get('AWS_ENDPOINT_URL'))
-
-def generate_presigned_upload_url(bucket, key, content_type, expires_in=300):
-    """Generate presigned URL for S3 upload"""
-    return S3.generate_presigned_url(
-        'put_object',
-        Params={'Bucket': bucket, 'Key': key, 'ContentType': content_type},
-        ExpiresIn=expires_in
-    )
-
-def generate_presigned_download_url(bucket, key, expires_in=3600):
-    """Generate presigned URL for S3 download"""
-    return S3.generate_presigned_url('get_object', Params={'Bucket': bucket, 'Key': key}, ExpiresIn=expires_in)
-
-def check_file_exists(bucket, key):
-    """Check if file exists in S3"""
-    try:
-        S3.head_object(Bucket=bucket, Key=key)
-        return True
-    except ClientError:
-        return False
-
-def get_file_metadata(bucket, key):
-    """Get file metadata from S3"""
-    response = S3.head_object(Bucket=bucket, Key=key)
-    return {
-        'file_size': response['ContentLength'],
-        'content_type': response['ContentType'],
-        'last_modified': response['LastModified'].isoformat()
-    }
-
-def delete_s3_object(bucket, key):
-    """Delete file from S3"""
-    S3.delete_object(Bucket=bucket, Key=key)
+# S3 client for presigned URL operations
+import os
+import time
+import threading
+from collections import OrderedDict
+from botocore.exceptions import ClientError
+
+from .clients import get_client
+from .metrics import timed
+
+def _s3():
+    """Shared S3 client"""
+    return get_client('s3')
+
+# DeleteObjects accepts at most 1000 keys per call
+DELETE_OBJECTS_BATCH_SIZE = 1000
+
+# Presigned download URL cache settings
+PRESIGN_CACHE_SIZE = int(os.environ.get('PRESIGN_CACHE_SIZE', '10000'))
+PRESIGN_MIN_TTL = int(os.environ.get('PRESIGN_MIN_TTL', '600'))
+PRESIGN_BUCKET_SECONDS = int(os.environ.get('PRESIGN_BUCKET_SECONDS', '900'))
+
+class PresignedUrlCache:
+    """Thread-safe LRU cache of presigned URLs keyed by (bucket, key)
+    
+    A cached URL is only handed out while its remaining validity is at
+    least min_ttl seconds, so clients always get a usable URL.
+    """
+    
+    def __init__(self, max_size, min_ttl):
+        self.max_size = max_size
+        self.min_ttl = min_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, bucket, key, now):
+        """Return a cached URL with enough validity left, or None"""
+        with self._lock:
+            entry = self._entries.get((bucket, key))
+            if entry and entry[1] - now >= self.min_ttl:
+                self._entries.move_to_end((bucket, key))
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            return None
+    
+    def put(self, bucket, key, url, expires_at):
+        """Cache a URL until expires_at, evicting the least recently used"""
+        with self._lock:
+            self._entries[(bucket, key)] = (url, expires_at)
+            self._entries.move_to_end((bucket, key))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+    
+    def invalidate(self, bucket, key):
+        """Drop the cached URL for an object"""
+        with self._lock:
+            self._entries.pop((bucket, key), None)
+    
+    def clear(self):
+        """Drop every cached URL and reset the counters"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+    
+    def stats(self):
+        """Counters for scraping"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._entries),
+                'max_size': self.max_size
+            }
+
+DOWNLOAD_URL_CACHE = PresignedUrlCache(PRESIGN_CACHE_SIZE, PRESIGN_MIN_TTL)
+
+def aligned_expiry(now, expires_in, bucket_seconds=PRESIGN_BUCKET_SECONDS, min_ttl=PRESIGN_MIN_TTL):
+    """Expiry time rounded down to a bucket boundary, pushed out a bucket if too close"""
+    expires_at = (int(now + expires_in) // bucket_seconds) * bucket_seconds
+    if expires_at - now <= min_ttl:
+        expires_at += bucket_seconds
+    return expires_at
+
+@timed('presign')
+def generate_presigned_upload_url(bucket, key, content_type, expires_in=300, checksum_sha256=None):
+    """Generate presigned URL for S3 upload, S3 rejects a body not matching checksum_sha256"""
+    params = {'Bucket': bucket, 'Key': key, 'ContentType': content_type}
+    if checksum_sha256:
+        params['ChecksumSHA256'] = checksum_sha256
+    return _s3().generate_presigned_url(
+        'put_object',
+        Params=params,
+        ExpiresIn=expires_in
+    )
+
+def create_multipart_upload(bucket, key, content_type):
+    """Start a multipart upload, returns its UploadId"""
+    response = _s3().create_multipart_upload(Bucket=bucket, Key=key, ContentType=content_type)
+    return response['UploadId']
+
+@timed('presign')
+def generate_presigned_part_urls(bucket, key, upload_id, part_numbers, expires_in=3600):
+    """Generate presigned URLs for uploading the given parts of a multipart upload"""
+    return [
+        {
+            'part_number': part_number,
+            'upload_url': _s3().generate_presigned_url(
+                'upload_part',
+                Params={'Bucket': bucket, 'Key': key, 'UploadId': upload_id, 'PartNumber': part_number},
+                ExpiresIn=expires_in
+            )
+        }
+        for part_number in part_numbers
+    ]
+
+def complete_multipart_upload(bucket, key, upload_id, parts):
+    """Assemble uploaded parts, given as (part_number, etag) pairs, into the final object"""
+    _s3().complete_multipart_upload(
+        Bucket=bucket,
+        Key=key,
+        UploadId=upload_id,
+        MultipartUpload={'Parts': [
+            {'PartNumber': part_number, 'ETag': etag} for part_number, etag in sorted(parts)
+        ]}
+    )
+
+def abort_multipart_upload(bucket, key, upload_id):
+    """Abort a multipart upload and free its uploaded parts"""
+    _s3().abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+
+@timed('presign')
+def generate_presigned_download_url(bucket, key, expires_in=3600):
+    """Generate presigned URL for S3 download, reusing a cached one while it is still valid
+    
+    Expiry is aligned to PRESIGN_BUCKET_SECONDS boundaries so all URLs signed
+    within one bucket expire together and stay reusable until then.
+    """
+    now = time.time()
+    url = DOWNLOAD_URL_CACHE.get(bucket, key, now)
+    if url:
+        return url
+    expires_at = aligned_expiry(now, expires_in)
+    url = _s3().generate_presigned_url(
+        'get_object',
+        Params={'Bucket': bucket, 'Key': key},
+        ExpiresIn=int(expires_at - now)
+    )
+    DOWNLOAD_URL_CACHE.put(bucket, key, url, expires_at)
+    return url
+
+def presign_cache_stats():
+    """Hit/miss counters of the download URL cache"""
+    return DOWNLOAD_URL_CACHE.stats()
+
+def check_file_exists(bucket, key):
+    """Check if file exists in S3"""
+    try:
+        _s3().head_object(Bucket=bucket, Key=key)
+        return True
+    except ClientError:
+        return False
+
+def get_file_metadata(bucket, key):
+    """Get file metadata from S3, with the SHA-256 checksum S3 verified on upload if any"""
+    response = _s3().head_object(Bucket=bucket, Key=key, ChecksumMode='ENABLED')
+    return {
+        'file_size': response['ContentLength'],
+        'content_type': response['ContentType'],
+        'last_modified': response['LastModified'].isoformat(),
+        'checksum_sha256': response.get('ChecksumSHA256')
+    }
+
+def get_file(bucket, key):
+    """Read a whole file from S3"""
+    return _s3().get_object(Bucket=bucket, Key=key)['Body'].read()
+
+def put_file(bucket, key, body, content_type):
+    """Write a whole file to S3"""
+    DOWNLOAD_URL_CACHE.invalidate(bucket, key)
+    _s3().put_object(Bucket=bucket, Key=key, Body=body, ContentType=content_type)
+
+def delete_s3_object(bucket, key):
+    """Delete file from S3"""
+    DOWNLOAD_URL_CACHE.invalidate(bucket, key)
+    _s3().delete_object(Bucket=bucket, Key=key)
+
+
+def delete_s3_objects(bucket, keys):
+    """Delete many files from S3 with DeleteObjects, returns {key: error} for failures"""
+    errors = {}
+    keys = list(keys)
+    for key in keys:
+        DOWNLOAD_URL_CACHE.invalidate(bucket, key)
+    for start in range(0, len(keys), DELETE_OBJECTS_BATCH_SIZE):
+        chunk = keys[start:start + DELETE_OBJECTS_BATCH_SIZE]
+        try:
+            response = _s3().delete_objects(
+                Bucket=bucket,
+                Delete={'Objects': [{'Key': key} for key in chunk], 'Quiet': True}
+            )
+        except ClientError as e:
+            errors.update((key, str(e)) for key in chunk)
+            continue
+        for error in response.get('Errors', []):
+            errors[error['Key']] = error.get('Message') or error.get('Code')
+    return errors
\ No newline at end of file
@@ -0,0 +1,36 @@
+# JSON serialization for handler responses
+import os
+import json
+from decimal import Decimal
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# JSON backend: 'orjson' when installed, otherwise the stdlib encoder. JSON_BACKEND=json forces stdlib.
+JSON_BACKEND = os.environ.get('JSON_BACKEND', 'orjson' if orjson else 'json')
+
+def encode_default(obj):
+    """Encode the types DynamoDB hands back that JSON does not know"""
+    if isinstance(obj, Decimal):
+        return int(obj) if obj % 1 == 0 else float(obj)
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj)
+    if isinstance(obj, (bytes, bytearray)):
+        return obj.decode('utf-8', errors='replace')
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+class DynamoJSONEncoder(json.JSONEncoder):
+    """JSON encoder that writes DynamoDB Decimals and sets directly, without copying the tree"""
+    
+    def default(self, obj):
+        return encode_default(obj)
+
+_ENCODER = DynamoJSONEncoder(separators=(',', ':'))
+
+def dumps(obj, backend=None):
+    """Serialize obj to a JSON string"""
+    if (backend or JSON_BACKEND) == 'orjson' and orjson is not None:
+        return orjson.dumps(obj, default=encode_default).decode()
+    return _ENCODER.encode(obj)
@@ -0,0 +1,108 @@
+# Reconciliation of the per-user stats: image count and total bytes
+#
+# The stats rows are kept up to date incrementally by the image writes in
+# dynamo_client.py. This job rebuilds them from the images table with a
+# parallel segmented Scan, repairing drift left by a stats update that
+# failed after its image write, and marks every uploaded image as counted
+# (counted_bytes = file_size) so later deletes subtract the right amount.
+# The stats rows are read before the scan and each rewrite is conditional
+# on the row being unchanged since, so an update from live traffic during
+# the scan is never overwritten: that user is skipped for the next run.
+#
+# Runs as a scheduled Lambda (service.stats.reconcile_handler) or a CLI:
+#
+#   python -m service.stats [--dry-run] [--segments 8]
+import os
+import json
+import argparse
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from .dynamo_client import (
+    COUNTED_ATTRIBUTE,
+    scan_uploaded,
+    set_counted_bytes,
+    scan_user_stats,
+    replace_user_stats
+)
+
+DDB_TABLE = os.environ.get('DDB_TABLE', 'Images')
+
+# Parallel Scan segments, each read by its own thread
+STATS_SEGMENTS = int(os.environ.get('STATS_SEGMENTS', '8'))
+
+def reconcile_user_stats(segments=STATS_SEGMENTS, dry_run=False):
+    """Rebuild every user's stats from the images table, returns a summary"""
+    totals = {}
+    summary = {'scanned': 0, 'marked': 0, 'users': 0, 'corrected': 0, 'skipped': 0, 'failed': 0}
+    # Read before the scan, so any stats update made while it runs fails the rewrite's condition
+    current = {row['user_id']: row for row in scan_user_stats(DDB_TABLE)}
+    lock = threading.Lock()
+    
+    def scan_segment(segment):
+        for items in scan_uploaded(DDB_TABLE, segment, segments):
+            for item in items:
+                size = int(item.get('file_size') or 0)
+                with lock:
+                    summary['scanned'] += 1
+                    user_totals = totals.setdefault(item['user_id'], [0, 0])
+                    user_totals[0] += 1
+                    user_totals[1] += size
+                if item.get(COUNTED_ATTRIBUTE) == size:
+                    continue
+                with lock:
+                    summary['marked'] += 1
+                if not dry_run:
+                    set_counted_bytes(DDB_TABLE, item['user_id'], item['image_id'], size)
+    
+    with ThreadPoolExecutor(max_workers=segments, thread_name_prefix='stats-scan') as pool:
+        for future in [pool.submit(scan_segment, segment) for segment in range(segments)]:
+            future.result()
+    
+    # Users whose images are all gone keep a row, reset to zero
+    reconciled_at = datetime.utcnow().isoformat() + 'Z'
+    rows = []
+    for user_id in totals.keys() | current.keys():
+        image_count, total_bytes = totals.get(user_id, (0, 0))
+        row = current.get(user_id, {})
+        if row.get('image_count') == image_count and row.get('total_bytes') == total_bytes:
+            continue
+        rows.append({
+            'user_id': user_id,
+            'image_count': image_count,
+            'total_bytes': total_bytes,
+            'reconciled_at': reconciled_at
+        })
+    
+    summary['users'] = len(totals.keys() | current.keys())
+    summary['corrected'] = len(rows)
+    if not dry_run:
+        for row in rows:
+            try:
+                if not replace_user_stats(DDB_TABLE, row, current.get(row['user_id'])):
+                    summary['skipped'] += 1
+            except Exception as e:
+                print(f"Failed to reconcile stats of {row['user_id']}: {str(e)}")
+                summary['failed'] += 1
+        summary['corrected'] -= summary['skipped'] + summary['failed']
+    summary['dry_run'] = dry_run
+    return summary
+
+def reconcile_handler(event, context):
+    """Scheduled Lambda entry point, event may override dry_run and segments"""
+    event = event or {}
+    return reconcile_user_stats(
+        segments=int(event.get('segments', STATS_SEGMENTS)),
+        dry_run=bool(event.get('dry_run', False))
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild per-user image stats from the images table')
+    parser.add_argument('--dry-run', action='store_true', help='report what would change without writing')
+    parser.add_argument('--segments', type=int, default=STATS_SEGMENTS, help='parallel Scan segments')
+    args = parser.parse_args()
+    print(json.dumps(reconcile_user_stats(segments=args.segments, dry_run=args.dry_run), indent=2))
+
+if __name__ == '__main__':
+    main()
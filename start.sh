@@ -27,7 +27,7 @@ echo "Starting LocalStack..."
 docker run -d \
     --name localstack \
     -p 4566:4566 \
-    -e SERVICES=s3,dynamodb,iam,lambda,apigateway \
+    -e SERVICES=s3,dynamodb,iam,lambda,apigateway,events \
     -e DEBUG=1 \
     -e DATA_DIR=/tmp/localstack/data \
     -v /var/run/docker.sock:/var/run/docker.sock \
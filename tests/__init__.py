@@ -1 +1 @@
-# Empty init file
+# Empty init file
@@ -0,0 +1,92 @@
+# Shared fixtures for moto-backed tests
+import os
+import pytest
+from moto import mock_aws
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'test')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'test')
+# Derivatives are rendered explicitly by the tests that need them
+os.environ.setdefault('DERIVATIVES_MODE', 'off')
+
+def create_keyed_table(ddb, table_name, hash_key):
+    """Create a table keyed on hash_key/image_id with the created_at index"""
+    ddb.create_table(
+        TableName=table_name,
+        AttributeDefinitions=[
+            {'AttributeName': hash_key, 'AttributeType': 'S'},
+            {'AttributeName': 'image_id', 'AttributeType': 'S'},
+            {'AttributeName': 'created_at', 'AttributeType': 'S'}
+        ],
+        KeySchema=[
+            {'AttributeName': hash_key, 'KeyType': 'HASH'},
+            {'AttributeName': 'image_id', 'KeyType': 'RANGE'}
+        ],
+        LocalSecondaryIndexes=[{
+            'IndexName': 'created_at-index',
+            'KeySchema': [
+                {'AttributeName': hash_key, 'KeyType': 'HASH'},
+                {'AttributeName': 'created_at', 'KeyType': 'RANGE'}
+            ],
+            'Projection': {'ProjectionType': 'ALL'}
+        }],
+        ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5}
+    )
+
+def create_content_table(ddb, table_name):
+    """Create the content hash index table keyed on user_id/sha256"""
+    ddb.create_table(
+        TableName=table_name,
+        AttributeDefinitions=[
+            {'AttributeName': 'user_id', 'AttributeType': 'S'},
+            {'AttributeName': 'sha256', 'AttributeType': 'S'}
+        ],
+        KeySchema=[
+            {'AttributeName': 'user_id', 'KeyType': 'HASH'},
+            {'AttributeName': 'sha256', 'KeyType': 'RANGE'}
+        ],
+        ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5}
+    )
+
+def create_stats_table(ddb, table_name):
+    """Create the per-user stats table keyed on user_id"""
+    ddb.create_table(
+        TableName=table_name,
+        AttributeDefinitions=[{'AttributeName': 'user_id', 'AttributeType': 'S'}],
+        KeySchema=[{'AttributeName': 'user_id', 'KeyType': 'HASH'}],
+        ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5}
+    )
+
+def create_images_table(ddb, table_name):
+    """Create the images table and its tag, content and stats tables the same way deploy.sh does"""
+    from service.dynamo_client import tag_table_name, content_table_name, stats_table_name
+    
+    create_keyed_table(ddb, table_name, 'user_id')
+    create_keyed_table(ddb, tag_table_name(table_name), 'user_tag')
+    create_content_table(ddb, content_table_name(table_name))
+    create_stats_table(ddb, stats_table_name(table_name))
+
+@pytest.fixture
+def aws(monkeypatch):
+    """Point the service clients at moto and create the bucket and table"""
+    monkeypatch.delenv('AWS_ENDPOINT_URL', raising=False)
+    with mock_aws():
+        from service import clients, dynamo_client, s3_client
+        from service.handler import S3_BUCKET, DDB_TABLE
+        
+        clients.reset_clients()
+        s3_client.DOWNLOAD_URL_CACHE.clear()
+        dynamo_client.reset_metadata_cache()
+        ddb = clients.get_resource('dynamodb')
+        s3 = clients.get_client('s3')
+        
+        create_images_table(ddb, DDB_TABLE)
+        s3.create_bucket(Bucket=S3_BUCKET)
+        yield {
+            'ddb': ddb,
+            'ddb_client': clients.get_client('dynamodb'),
+            's3': s3,
+            'table': DDB_TABLE,
+            'bucket': S3_BUCKET
+        }
+        clients.reset_clients()
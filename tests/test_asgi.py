@@ -0,0 +1,68 @@
+# Tests for the ASGI front end
+import json
+
+from starlette.testclient import TestClient
+
+def test_routes_match_flask_app(aws):
+    """Upload, list, get and delete an image through the ASGI app"""
+    from asgi import app
+    
+    with TestClient(app) as client:
+        assert client.get('/health').json()['status'] == 'healthy'
+        
+        res = client.post('/upload-url', json={'user_id': 'u1', 'filename': 'a.png', 'content_type': 'image/png'})
+        assert res.status_code == 200
+        image_id = res.json()['image_id']
+        
+        listed = client.get('/images', params={'user_id': 'u1', 'fields': 'image_id'})
+        assert listed.json()['images'] == [{'image_id': image_id}]
+        
+        got = client.get(f'/images/u1/{image_id}')
+        assert got.status_code == 200
+        assert got.json()['download_url'] is None
+        
+        assert client.delete(f'/images/u1/{image_id}').status_code == 200
+        assert client.get(f'/images/u1/{image_id}').status_code == 404
+
+def test_errors_pass_through(aws):
+    """Handler errors keep their status, unknown routes and methods are rejected"""
+    from asgi import app
+    
+    with TestClient(app) as client:
+        missing = client.post('/upload-url', content=json.dumps({'user_id': 'u1'}))
+        assert missing.status_code == 400
+        assert 'error' in missing.json()
+        
+        assert client.get('/images').status_code == 400
+        assert client.get('/nope').status_code == 404
+        assert client.put('/images').status_code == 405
+
+def test_head_answers_like_get(aws):
+    """HEAD on a GET route runs its handler and returns the headers without a body"""
+    from asgi import app
+    
+    with TestClient(app) as client:
+        client.post('/upload-url', json={'user_id': 'u1', 'filename': 'a.png', 'content_type': 'image/png'})
+        got = client.get('/images', params={'user_id': 'u1'})
+        head = client.head('/images', params={'user_id': 'u1'})
+        
+        assert head.status_code == 200
+        assert head.content == b''
+        assert head.headers['etag'] == got.headers['etag']
+        assert head.headers['content-length'] == str(len(got.content))
+        assert client.head('/images').status_code == 400
+
+def test_conditional_get_and_gzip(aws):
+    """ETags and gzip encoding reach ASGI clients"""
+    from asgi import app
+    
+    with TestClient(app) as client:
+        for _ in range(10):
+            client.post('/upload-url', json={'user_id': 'u1', 'filename': 'a.png', 'content_type': 'image/png'})
+        
+        res = client.get('/images', params={'user_id': 'u1'}, headers={'Accept-Encoding': 'gzip'})
+        assert res.headers['content-encoding'] == 'gzip'
+        assert res.json()['count'] == 10
+        
+        cached = client.get('/images', params={'user_id': 'u1'}, headers={'If-None-Match': res.headers['etag']})
+        assert cached.status_code == 304
@@ -0,0 +1,86 @@
+# Tests for the metadata cache building blocks
+import time
+import threading
+from unittest.mock import patch
+
+import pytest
+
+from service.cache import MetadataCache, LRUTTLCache, RequestCoalescer
+
+class TestLRUTTLCache:
+    """Tests for the in-process LRU cache with TTL"""
+    
+    def test_expires_after_ttl(self):
+        """Entries are gone once their ttl has passed"""
+        cache = LRUTTLCache(max_size=10, ttl=5)
+        with patch('service.cache.time.monotonic', return_value=100):
+            cache.set('a', {'v': 1})
+            assert cache.get('a') == {'v': 1}
+        with patch('service.cache.time.monotonic', return_value=105):
+            assert cache.get('a') is None
+    
+    def test_evicts_least_recently_used(self):
+        """The least recently used entry goes first when full"""
+        cache = LRUTTLCache(max_size=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        
+        assert cache.get('b') is None
+        assert cache.get('a') == 1
+        assert len(cache) == 2
+    
+    def test_zero_ttl_disables(self):
+        """A ttl of zero caches nothing"""
+        cache = LRUTTLCache(max_size=10, ttl=0)
+        cache.set('a', 1)
+        assert cache.get('a') is None
+    
+    def test_incomplete_implementations_fail_on_creation(self):
+        """A MetadataCache missing a method cannot be instantiated"""
+        class GetOnly(MetadataCache):
+            def get(self, key):
+                return None
+        
+        with pytest.raises(TypeError):
+            GetOnly()
+
+class TestRequestCoalescer:
+    """Tests for request coalescing"""
+    
+    def test_concurrent_calls_share_one_load(self):
+        """Callers arriving while a load runs wait for its result"""
+        coalescer = RequestCoalescer()
+        loads = []
+        release = threading.Event()
+        
+        def load():
+            loads.append(1)
+            release.wait(5)
+            return 'value'
+        
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(coalescer.run('k', load)))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        while coalescer.coalesced < 7:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+        
+        assert loads == [1]
+        assert results == ['value'] * 8
+    
+    def test_errors_propagate_and_are_not_kept(self):
+        """A failed load raises for its caller and the next call loads again"""
+        coalescer = RequestCoalescer()
+        
+        def fail():
+            raise RuntimeError('boom')
+        
+        with pytest.raises(RuntimeError):
+            coalescer.run('k', fail)
+        assert coalescer.run('k', lambda: 'ok') == 'ok'
@@ -0,0 +1,51 @@
+# Tests for the shared boto3 client factory
+import threading
+
+from service import clients
+
+class TestClientFactory:
+    """Tests for lazy, shared client creation"""
+    
+    def setup_method(self):
+        clients.reset_clients()
+    
+    def teardown_method(self):
+        clients.reset_clients()
+    
+    def test_clients_are_created_once_and_shared(self):
+        """Repeated and concurrent lookups return the same client"""
+        assert clients._clients == {}
+        
+        found = []
+        threads = [threading.Thread(target=lambda: found.append(clients.get_client('s3')))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        assert len({id(client) for client in found}) == 1
+        assert clients.get_client('s3') is found[0]
+    
+    def test_config_from_environment(self, monkeypatch):
+        """Pool size, timeouts, keep-alive and retries come from env vars"""
+        monkeypatch.setenv('AWS_MAX_POOL_CONNECTIONS', '64')
+        monkeypatch.setenv('AWS_READ_TIMEOUT', '3')
+        monkeypatch.setenv('AWS_RETRY_MODE', 'standard')
+        monkeypatch.setenv('AWS_MAX_ATTEMPTS', '7')
+        
+        config = clients.get_client('s3').meta.config
+        
+        assert config.max_pool_connections == 64
+        assert config.read_timeout == 3
+        assert config.tcp_keepalive is True
+        assert config.retries == {'mode': 'standard', 'total_max_attempts': 7}
+    
+    def test_prewarm_and_reset(self):
+        """prewarm builds the clients up front and reset forgets them"""
+        clients.prewarm()
+        assert set(clients._clients) == {'s3', 'dynamodb'}
+        assert set(clients._resources) == {'dynamodb'}
+        
+        clients.reset_clients()
+        assert clients._clients == {} and clients._resources == {}
@@ -0,0 +1,44 @@
+# Cold-start regression checks for the Lambda package
+import os
+import sys
+import json
+import subprocess
+
+from service import clients
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Budget for importing service.handler in a fresh interpreter, in milliseconds
+IMPORT_BUDGET_MS = float(os.environ.get('COLD_START_IMPORT_BUDGET_MS', '250'))
+
+def import_in_fresh_interpreter():
+    """Import service.handler in a new interpreter, returns its import time and loaded modules"""
+    script = (
+        'import sys, json, time\n'
+        't = time.perf_counter()\n'
+        'import service.handler\n'
+        'print(json.dumps({"ms": (time.perf_counter() - t) * 1000, "modules": sorted(sys.modules)}))\n'
+    )
+    env = dict(os.environ, AWS_DEFAULT_REGION='us-east-1')
+    env.pop('PREWARM_CLIENTS', None)
+    out = subprocess.run([sys.executable, '-c', script], cwd=ROOT, env=env,
+                         capture_output=True, text=True, check=True)
+    return json.loads(out.stdout)
+
+def test_handler_import_does_not_load_boto3():
+    """Importing the handlers stays cheap: boto3 is only loaded on first use"""
+    result = min((import_in_fresh_interpreter() for _ in range(3)), key=lambda r: r['ms'])
+    
+    assert 'boto3' not in result['modules']
+    assert result['ms'] < IMPORT_BUDGET_MS
+
+def test_upload_url_skips_dynamodb_resource_model(aws):
+    """The upload path only builds the S3 client and the low-level DynamoDB client"""
+    from service.handler import upload_url_handler
+    
+    clients.reset_clients()
+    event = {'body': json.dumps({'user_id': 'john', 'filename': 'a.jpg', 'content_type': 'image/jpeg'})}
+    
+    assert upload_url_handler(event, None)['statusCode'] == 200
+    assert clients._resources == {}
+    assert set(clients._clients) == {'s3', 'dynamodb'}
@@ -0,0 +1,139 @@
+# Tests for the thumbnail and preview derivative pipeline
+import io
+import json
+from unittest.mock import patch
+
+from PIL import Image
+
+def jpeg(width, height, orientation=None):
+    """Encode a solid JPEG, optionally with an EXIF orientation"""
+    buffer = io.BytesIO()
+    image = Image.new('RGB', (width, height), (200, 80, 40))
+    exif = Image.Exif()
+    if orientation:
+        exif[0x0112] = orientation
+    image.save(buffer, 'JPEG', exif=exif.tobytes())
+    return buffer.getvalue()
+
+def uploaded(aws, image_id, body):
+    """Store an uploaded image and its original file"""
+    from service.dynamo_client import put_image_metadata
+    
+    item = {
+        'user_id': 'john', 'image_id': image_id, 'status': 'uploaded', 'content_type': 'image/jpeg',
+        's3_key': f'john/{image_id}.jpg', 'created_at': '2024-01-01T00:00:00Z', 'tags': ['beach']
+    }
+    put_image_metadata(aws['table'], item)
+    aws['s3'].put_object(Bucket=aws['bucket'], Key=item['s3_key'], Body=body)
+    return item
+
+def s3_keys(aws):
+    """Every key in the bucket"""
+    return sorted(o['Key'] for o in aws['s3'].list_objects_v2(Bucket=aws['bucket']).get('Contents', []))
+
+def test_resize_fits_each_size_and_applies_orientation():
+    """Each rendition fits its max edge, keeps the aspect ratio and is upright"""
+    from service.derivatives import resize
+    
+    sizes = {'thumbnail': 200, 'preview': 1080}
+    landscape = resize(jpeg(1600, 1200), sizes)
+    rotated = resize(jpeg(1600, 1200, orientation=6), sizes)
+    small = resize(jpeg(150, 100), sizes)
+    
+    assert {name: (w, h) for name, (_, w, h) in landscape.items()} == {'thumbnail': (200, 150), 'preview': (1080, 810)}
+    assert rotated['preview'][1:] == (810, 1080)
+    assert small['preview'][1:] == (150, 100)
+    assert Image.open(io.BytesIO(landscape['thumbnail'][0])).format == 'JPEG'
+
+def test_render_on_process_pool(monkeypatch):
+    """With workers configured the resize runs on the shared process pool"""
+    from service import derivatives
+    
+    monkeypatch.setattr(derivatives, 'DERIVATIVE_WORKERS', 2)
+    monkeypatch.setattr(derivatives, '_resize_pool', None)
+    try:
+        renditions = derivatives.render(jpeg(800, 600), {'thumbnail': 100})
+        assert derivatives._resize_pool is not None
+    finally:
+        derivatives._resize_pool.shutdown()
+    
+    assert renditions['thumbnail'][1:] == (100, 75)
+
+def test_generate_stores_records_and_serves_renditions(aws, monkeypatch):
+    """Renditions land under derived/, are recorded on the item and tag rows and get URLs"""
+    from service import derivatives
+    from service.handler import get_image_handler, list_images_handler, delete_image_handler
+    
+    monkeypatch.setattr(derivatives, 'DERIVATIVE_WORKERS', 0)
+    item = uploaded(aws, 'img1', jpeg(1600, 1200))
+    
+    recorded = derivatives.generate_derivatives(item)
+    
+    assert recorded['thumbnail'] == {
+        's3_key': 'derived/thumbnail/john/img1.jpg', 'width': 200, 'height': 150,
+        'file_size': recorded['thumbnail']['file_size']
+    }
+    assert s3_keys(aws) == ['derived/preview/john/img1.jpg', 'derived/thumbnail/john/img1.jpg', 'john/img1.jpg']
+    
+    event = {'pathParameters': {'user_id': 'john', 'image_id': 'img1'}}
+    got = json.loads(get_image_handler(event, None)['body'])
+    assert set(got['derivative_urls']) == {'thumbnail', 'preview'}
+    assert 'derived/thumbnail/john/img1.jpg' in got['derivative_urls']['thumbnail']
+    
+    for params in ({'user_id': 'john', 'tag': 'beach'}, {'user_id': 'john', 'fields': 'image_id,derivative_urls'}):
+        listed = json.loads(list_images_handler({'queryStringParameters': params}, None)['body'])
+        assert set(listed['images'][0]['derivative_urls']) == {'thumbnail', 'preview'}
+    assert set(listed['images'][0]) == {'image_id', 'derivative_urls'}
+    
+    assert delete_image_handler(event, None)['statusCode'] == 200
+    assert s3_keys(aws) == []
+
+def test_renditions_of_deleted_image_are_dropped(aws, monkeypatch):
+    """An image deleted while rendering leaves no renditions behind"""
+    from service import derivatives
+    from service.dynamo_client import delete_image_metadata
+    
+    monkeypatch.setattr(derivatives, 'DERIVATIVE_WORKERS', 0)
+    item = uploaded(aws, 'img2', jpeg(400, 300))
+    
+    def delete_meanwhile(data, sizes=None):
+        delete_image_metadata(aws['table'], 'john', 'img2')
+        aws['s3'].delete_object(Bucket=aws['bucket'], Key=item['s3_key'])
+        return derivatives.resize(data, derivatives.DERIVATIVE_SIZES)
+    
+    with patch('service.derivatives.render', side_effect=delete_meanwhile):
+        assert derivatives.generate_derivatives(item) is None
+    assert s3_keys(aws) == []
+
+def test_confirm_schedules_rendering(aws, monkeypatch):
+    """Confirming an upload queues its renditions, non-images are skipped"""
+    from service import derivatives
+    from service.handler import confirm_upload_handler
+    from service.dynamo_client import put_image_metadata, get_image_metadata
+    
+    monkeypatch.setattr(derivatives, 'DERIVATIVES_MODE', 'confirm')
+    monkeypatch.setattr(derivatives, 'DERIVATIVE_WORKERS', 0)
+    item = uploaded(aws, 'img3', jpeg(400, 300))
+    put_image_metadata(aws['table'], dict(item, status='pending'))
+    
+    futures = []
+    with patch('service.handler.schedule_derivatives',
+               side_effect=lambda item: futures.append(derivatives.schedule_derivatives(item))):
+        result = confirm_upload_handler({'body': json.dumps({'user_id': 'john', 'image_id': 'img3'})}, None)
+    
+    assert result['statusCode'] == 200
+    assert set(futures[0].result()) == {'thumbnail', 'preview'}
+    assert get_image_metadata(aws['table'], 'john', 'img3')['derivatives']['preview']['width'] == 400
+    assert derivatives.generate_derivatives(dict(item, content_type='video/mp4')) is None
+
+def test_oversized_originals_are_skipped(aws, monkeypatch):
+    """Originals over DERIVATIVE_MAX_BYTES are never read into memory"""
+    from service import derivatives
+    
+    monkeypatch.setattr(derivatives, 'DERIVATIVE_MAX_BYTES', 1000)
+    item = uploaded(aws, 'img4', jpeg(400, 300))
+    
+    with patch('service.derivatives.get_file') as get_file:
+        assert derivatives.generate_derivatives(dict(item, file_size=1001)) is None
+    get_file.assert_not_called()
+    assert s3_keys(aws) == ['john/img4.jpg']
@@ -0,0 +1,417 @@
+# moto-backed tests for the DynamoDB client
+import threading
+from unittest.mock import patch
+
+from service import dynamo_client
+from service.clients import get_resource
+
+def seed_images(table_name, user_id, count):
+    """Write count uploaded images for a user"""
+    table = get_resource('dynamodb').Table(table_name)
+    with table.batch_writer() as batch:
+        for i in range(count):
+            batch.put_item(Item={
+                'user_id': user_id,
+                'image_id': f'img-{i:05d}',
+                'status': 'uploaded',
+                's3_key': f'{user_id}/img-{i:05d}.jpg',
+                'created_at': f'2024-01-01T00:00:{i % 60:02d}Z',
+                'tags': []
+            })
+
+class TestGetImages:
+    """Tests for lazy, paginated get_images"""
+    
+    def test_follows_last_evaluated_key(self, aws):
+        """All pages are read when the caller keeps iterating"""
+        seed_images(aws['table'], 'heavy_user', 25)
+        
+        items = list(dynamo_client.get_images(aws['table'], 'heavy_user', page_size=10))
+        
+        assert len(items) == 25
+        assert len({i['image_id'] for i in items}) == 25
+    
+    def test_pages_lazily(self, aws):
+        """Only the pages that are consumed are queried"""
+        seed_images(aws['table'], 'heavy_user', 50)
+        calls = []
+        table = aws['ddb'].Table(aws['table'])
+        aws['ddb'].meta.client.meta.events.register(
+            'before-call.dynamodb.Query', lambda **kwargs: calls.append(1))
+        
+        images = dynamo_client.get_images(table.name, 'heavy_user', page_size=10)
+        first_page = [next(images) for _ in range(10)]
+        
+        assert len(first_page) == 10
+        assert len(calls) == 1
+    
+    def test_resumes_from_start_key(self, aws):
+        """item_key of the last item resumes right after it"""
+        seed_images(aws['table'], 'heavy_user', 20)
+        
+        first = list(dynamo_client.get_images(aws['table'], 'heavy_user', page_size=5))[:5]
+        rest = list(dynamo_client.get_images(
+            aws['table'], 'heavy_user', start_key=dynamo_client.item_key(first[-1])))
+        
+        assert len(rest) == 15
+        assert rest[0]['image_id'] == 'img-00005'
+    
+    def test_prefetches_rest_of_short_page(self):
+        """A page cut short of wanted items has the rest fetched while it is consumed"""
+        fetched = threading.Event()
+        calls = []
+        
+        class FakeTable:
+            def query(self, **kwargs):
+                calls.append(kwargs)
+                if 'ExclusiveStartKey' not in kwargs:
+                    return {'Items': [1, 2], 'Count': 2, 'LastEvaluatedKey': {'k': 2}}
+                fetched.set()
+                return {'Items': [3, 4, 5], 'Count': 3}
+        
+        pages = dynamo_client._query_pages(FakeTable(), {'Limit': 5}, wanted=5)
+        first = next(pages)
+        
+        assert fetched.wait(5)
+        assert first['Items'] == [1, 2]
+        assert next(pages)['Items'] == [3, 4, 5]
+        assert calls[1] == {'Limit': 3, 'ExclusiveStartKey': {'k': 2}}
+        assert list(pages) == []
+
+class TestTagIndex:
+    """Tests for the tag index maintained alongside the images table"""
+    
+    def put_tagged(self, table_name, user_id, count, tags):
+        """Store count pending images carrying tags"""
+        for i in range(count):
+            dynamo_client.put_image_metadata(table_name, {
+                'user_id': user_id,
+                'image_id': f'{tags[0] if tags else "untagged"}-{i:03d}',
+                'status': 'pending',
+                's3_key': f'{user_id}/{i}.jpg',
+                'tags': tags
+            })
+    
+    def test_read_volume_proportional_to_matches(self, aws):
+        """A tag query reads only the matching items, not the whole partition"""
+        self.put_tagged(aws['table'], 'john', 200, [])
+        self.put_tagged(aws['table'], 'john', 7, ['beach', 'summer'])
+        self.put_tagged(aws['table'], 'john', 30, ['city'])
+        scanned = []
+        aws['ddb'].meta.client.meta.events.register(
+            'after-call.dynamodb.Query',
+            lambda parsed, **kwargs: scanned.append(parsed['ScannedCount']))
+        
+        items = list(dynamo_client.get_images(aws['table'], 'john', tag='beach'))
+        
+        assert len(items) == 7
+        assert sum(scanned) == 7
+        assert all('user_tag' not in item for item in items)
+    
+    def test_update_and_delete_maintain_index(self, aws):
+        """Status updates are reflected and deletes are removed from the index"""
+        self.put_tagged(aws['table'], 'john', 2, ['beach'])
+        
+        dynamo_client.update_image_status(aws['table'], 'john', 'beach-000', 'uploaded', file_size=10)
+        dynamo_client.delete_image_metadata(aws['table'], 'john', 'beach-001')
+        
+        items = list(dynamo_client.get_images(aws['table'], 'john', tag='beach'))
+        assert [i['image_id'] for i in items] == ['beach-000']
+        assert items[0]['status'] == 'uploaded'
+        assert items[0]['file_size'] == 10
+    
+    def test_retag_removes_stale_rows(self, aws):
+        """Overwriting an image drops index rows for tags it no longer has"""
+        self.put_tagged(aws['table'], 'john', 1, ['beach'])
+        dynamo_client.put_image_metadata(aws['table'], {
+            'user_id': 'john', 'image_id': 'beach-000', 'status': 'pending', 'tags': ['city']
+        })
+        
+        assert list(dynamo_client.get_images(aws['table'], 'john', tag='beach')) == []
+        assert len(list(dynamo_client.get_images(aws['table'], 'john', tag='city'))) == 1
+    
+    def test_tag_pagination_resumes_with_image_key(self, aws):
+        """start_key from item_key works against the tag index"""
+        self.put_tagged(aws['table'], 'john', 12, ['beach'])
+        
+        first = next(dynamo_client.get_images(aws['table'], 'john', tag='beach', page_size=5))
+        rest = list(dynamo_client.get_images(
+            aws['table'], 'john', tag='beach', start_key=dynamo_client.item_key(first)))
+        
+        assert len(rest) == 11
+    
+    def test_backfill(self, aws):
+        """Existing rows written without the index are backfilled"""
+        seed_images(aws['table'], 'john', 3)
+        table = aws['ddb'].Table(aws['table'])
+        table.update_item(
+            Key={'user_id': 'john', 'image_id': 'img-00001'},
+            UpdateExpression='SET tags = :tags',
+            ExpressionAttributeValues={':tags': ['beach', 'sunset']}
+        )
+        
+        written = dynamo_client.backfill_tag_index(aws['table'])
+        
+        assert written == 2
+        items = list(dynamo_client.get_images(aws['table'], 'john', tag='sunset'))
+        assert [i['image_id'] for i in items] == ['img-00001']
+
+class TestCreatedAtRange:
+    """Tests for created_at range queries on the created_at index"""
+    
+    def seed_days(self, table_name, user_id, days, tags=None):
+        """Store one image per day of January 2024"""
+        for day in range(1, days + 1):
+            dynamo_client.put_image_metadata(table_name, {
+                'user_id': user_id,
+                'image_id': f'img-{32 - day:02d}',
+                'status': 'pending',
+                'created_at': f'2024-01-{day:02d}T12:00:00Z',
+                'tags': tags or []
+            })
+    
+    def test_range_reads_only_matching_items(self, aws):
+        """A date range is a bounded key query, newest first when asked"""
+        self.seed_days(aws['table'], 'john', 31)
+        scanned = []
+        aws['ddb'].meta.client.meta.events.register(
+            'after-call.dynamodb.Query',
+            lambda parsed, **kwargs: scanned.append(parsed['ScannedCount']))
+        
+        items = list(dynamo_client.get_images(
+            aws['table'], 'john',
+            start_date='2024-01-10T00:00:00Z',
+            end_date='2024-01-16T23:59:59Z',
+            descending=True
+        ))
+        
+        assert [i['created_at'][:10] for i in items] == [f'2024-01-{d}' for d in range(16, 9, -1)]
+        assert sum(scanned) == 7
+    
+    def test_descending_pagination(self, aws):
+        """item_key resumes an ordered listing on the index"""
+        self.seed_days(aws['table'], 'john', 10, tags=['beach'])
+        
+        for tag in (None, 'beach'):
+            first = next(dynamo_client.get_images(aws['table'], 'john', tag=tag, descending=True))
+            rest = list(dynamo_client.get_images(
+                aws['table'], 'john', tag=tag, descending=True,
+                start_key=dynamo_client.item_key(first)))
+            
+            assert first['created_at'].startswith('2024-01-10')
+            assert [i['created_at'][:10] for i in rest] == [f'2024-01-{d:02d}' for d in range(9, 0, -1)]
+    
+    def test_open_ended_range_with_tag(self, aws):
+        """Only a start date combined with a tag uses the tag table's index"""
+        self.seed_days(aws['table'], 'john', 5, tags=['beach'])
+        
+        items = list(dynamo_client.get_images(
+            aws['table'], 'john', tag='beach', start_date='2024-01-04'))
+        
+        assert len(items) == 2
+
+class TestBatchWrite:
+    """Tests for chunked BatchWriteItem with retries"""
+    
+    def test_batch_put_chunks_and_indexes(self, aws):
+        """Items and tag rows are written in chunks of at most 25 requests"""
+        sizes = []
+        aws['ddb_client'].meta.events.register(
+            'before-parameter-build.dynamodb.BatchWriteItem',
+            lambda params, **kwargs: sizes.append(sum(len(r) for r in params['RequestItems'].values())))
+        items = [
+            {'user_id': 'john', 'image_id': f'img-{i:02d}', 'status': 'pending', 'tags': ['album']}
+            for i in range(30)
+        ]
+        
+        failed = dynamo_client.batch_put_image_metadata(aws['table'], items)
+        
+        assert failed == []
+        assert sizes == [25, 25, 10]
+        assert len(list(dynamo_client.get_images(aws['table'], 'john'))) == 30
+        assert len(list(dynamo_client.get_images(aws['table'], 'john', tag='album'))) == 30
+    
+    def test_retries_unprocessed_items(self, aws):
+        """Unprocessed items are retried and reported once attempts run out"""
+        client = aws['ddb_client']
+        request = {'PutRequest': {'Item': {'user_id': 'john', 'image_id': 'img'}}}
+        unprocessed = {'PutRequest': {'Item': {'user_id': {'S': 'john'}, 'image_id': {'S': 'img'}}}}
+        throttled = {'UnprocessedItems': {aws['table']: [unprocessed]}}
+        
+        with patch.object(client, 'batch_write_item', side_effect=[throttled, {}]) as mock_write, \
+             patch('service.dynamo_client.time.sleep'):
+            assert dynamo_client.batch_write([(aws['table'], request)]) == []
+            assert mock_write.call_count == 2
+        
+        with patch.object(client, 'batch_write_item', return_value=throttled) as mock_write, \
+             patch('service.dynamo_client.time.sleep'):
+            failed = dynamo_client.batch_write([(aws['table'], request)])
+            assert failed == [(aws['table'], request)]
+            assert mock_write.call_count == dynamo_client.BATCH_WRITE_ATTEMPTS
+    
+    def test_batch_put_reports_only_unstored_images(self, aws):
+        """An image missing a tag row is rolled back and reported, one whose main row stays is not"""
+        write = dynamo_client.batch_write
+        tag_table = dynamo_client.tag_table_name(aws['table'])
+        
+        def losing(image_id, table_name):
+            """batch_write that leaves the requests of image_id on table_name unprocessed"""
+            def batch_write(requests):
+                lost = [(name, r) for name, r in requests if name == table_name and image_id in str(r)]
+                return write([pair for pair in requests if pair not in lost]) + lost
+            return batch_write
+        
+        def put(items, *writes):
+            """batch_put_image_metadata with each BatchWrite run through the next of writes"""
+            writes = iter(writes)
+            with patch('service.dynamo_client.batch_write', side_effect=lambda requests: next(writes)(requests)):
+                return dynamo_client.batch_put_image_metadata(aws['table'], items)
+        
+        items = [
+            {'user_id': 'john', 'image_id': f'img-{i}', 'status': 'pending', 'tags': ['album', 'beach']}
+            for i in range(3)
+        ]
+        assert put(items, losing('img-1', tag_table), write, write) == ['img-1']
+        assert put([dict(items[0], image_id='main')], losing('main', aws['table']), write, write) == ['main']
+        
+        stored = {i['image_id'] for i in dynamo_client.get_images(aws['table'], 'john')}
+        tagged = {i['image_id'] for i in dynamo_client.get_images(aws['table'], 'john', tag='beach')}
+        assert stored == tagged == {'img-0', 'img-2'}
+        
+        # A main row that could not be rolled back is live, so it is not reported
+        kept = [dict(items[0], image_id='kept')]
+        assert put(kept, losing('kept', tag_table), losing('kept', aws['table']), write) == []
+        assert dynamo_client.get_image_metadata(aws['table'], 'john', 'kept') is not None
+
+class TestBatchGetAndDelete:
+    """Tests for BatchGetItem and batched deletes"""
+    
+    def test_batch_get_skips_missing(self, aws):
+        """Missing images are left out and duplicates are fetched once"""
+        seed_images(aws['table'], 'john', 150)
+        
+        ids = [f'img-{i:05d}' for i in range(150)] + ['img-00000', 'missing']
+        items = dynamo_client.batch_get_image_metadata(aws['table'], 'john', ids)
+        
+        assert len(items) == 150
+    
+    def test_batch_delete_removes_tag_rows(self, aws):
+        """Deleted images disappear from the table and the tag index"""
+        items = [
+            {'user_id': 'john', 'image_id': f'img-{i:02d}', 'status': 'pending', 'tags': ['album']}
+            for i in range(30)
+        ]
+        dynamo_client.batch_put_image_metadata(aws['table'], items)
+        
+        failed = dynamo_client.batch_delete_image_metadata(aws['table'], items[:20])
+        
+        assert failed == []
+        assert len(list(dynamo_client.get_images(aws['table'], 'john'))) == 10
+        assert len(list(dynamo_client.get_images(aws['table'], 'john', tag='album'))) == 10
+
+class TestContentIndex:
+    """Tests for the reference-counted content hash index"""
+    
+    def test_references_are_counted_once_per_image(self, aws):
+        """Only the release of the last distinct reference frees the object"""
+        table, sha = aws['table'], 'ab' * 32
+        
+        assert dynamo_client.acquire_content(table, 'john', sha, 'img-2') is None
+        assert dynamo_client.register_content(table, 'john', sha, 'john/img-1.jpg', 'img-1', 5)
+        assert not dynamo_client.register_content(table, 'john', sha, 'john/img-9.jpg', 'img-9')
+        row = dynamo_client.acquire_content(table, 'john', sha, 'img-2')
+        dynamo_client.acquire_content(table, 'john', sha, 'img-2')
+        
+        assert row['s3_key'] == 'john/img-1.jpg'
+        assert row['refs'] == {'img-1', 'img-2'}
+        assert dynamo_client.release_content(table, 'john', sha, 'john/img-1.jpg', 'img-1') is False
+        assert dynamo_client.release_content(table, 'john', sha, 'john/img-1.jpg', 'img-1') is False
+        assert dynamo_client.release_content(table, 'john', sha, 'john/img-1.jpg', 'img-2') is True
+        assert dynamo_client.acquire_content(table, 'john', sha, 'img-3') is None
+    
+    def test_unindexed_images_own_their_object(self, aws):
+        """An image whose object is not the indexed one may always delete it"""
+        table, sha = aws['table'], 'cd' * 32
+        dynamo_client.register_content(table, 'john', sha, 'john/img-1.jpg', 'img-1')
+        
+        assert dynamo_client.release_content(table, 'john', 'ef' * 32, 'john/img-5.jpg', 'img-5') is True
+        assert dynamo_client.release_content(table, 'john', sha, 'john/img-9.jpg', 'img-9') is True
+        assert dynamo_client.acquire_content(table, 'john', sha, 'img-2') is not None
+
+class TestMetadataCache:
+    """Tests for the read-through cache in get_image_metadata"""
+    
+    def count_get_items(self, aws):
+        calls = []
+        aws['ddb'].meta.client.meta.events.register(
+            'before-call.dynamodb.GetItem', lambda **kwargs: calls.append(1))
+        return calls
+    
+    def test_hits_skip_dynamodb_and_return_copies(self, aws):
+        """Repeated reads are served from the cache, each caller gets its own copy"""
+        seed_images(aws['table'], 'john', 1)
+        calls = self.count_get_items(aws)
+        
+        first = dynamo_client.get_image_metadata(aws['table'], 'john', 'img-00000')
+        first['download_url'] = 'mutated'
+        second = dynamo_client.get_image_metadata(aws['table'], 'john', 'img-00000')
+        
+        assert len(calls) == 1
+        assert 'download_url' not in second
+        stats = dynamo_client.metadata_cache_stats()
+        assert stats['hits'] == 1
+        assert stats['misses'] == 1
+        assert stats['hit_rate'] == 0.5
+    
+    def test_writes_invalidate(self, aws):
+        """Updates and deletes are visible on the next read"""
+        seed_images(aws['table'], 'john', 1)
+        dynamo_client.get_image_metadata(aws['table'], 'john', 'img-00000')
+        
+        dynamo_client.update_image_status(aws['table'], 'john', 'img-00000', 'processing')
+        assert dynamo_client.get_image_metadata(aws['table'], 'john', 'img-00000')['status'] == 'processing'
+        
+        dynamo_client.delete_image_metadata(aws['table'], 'john', 'img-00000')
+        assert dynamo_client.get_image_metadata(aws['table'], 'john', 'img-00000') is None
+    
+    def test_missing_items_are_not_cached(self, aws):
+        """A miss for an image that does not exist yet is not remembered"""
+        calls = self.count_get_items(aws)
+        
+        assert dynamo_client.get_image_metadata(aws['table'], 'john', 'new') is None
+        assert dynamo_client.get_image_metadata(aws['table'], 'john', 'new') is None
+        
+        assert len(calls) == 2
+    
+    def test_load_racing_a_write_is_not_cached(self, aws):
+        """A read that completes after a concurrent write does not cache the old item"""
+        seed_images(aws['table'], 'john', 1)
+        writes = []
+        
+        def write_once(**kwargs):
+            if not writes:
+                writes.append(1)
+                dynamo_client.update_image_status(aws['table'], 'john', 'img-00000', 'uploaded', file_size=5)
+        
+        aws['ddb'].meta.client.meta.events.register('after-call.dynamodb.GetItem', write_once)
+        
+        stale = dynamo_client.get_image_metadata(aws['table'], 'john', 'img-00000')
+        fresh = dynamo_client.get_image_metadata(aws['table'], 'john', 'img-00000')
+        
+        assert 'file_size' not in stale
+        assert fresh['file_size'] == 5
+    
+    def test_unrelated_writes_do_not_stop_caching(self, aws):
+        """A write to another image during a load still lets the loaded image be cached"""
+        seed_images(aws['table'], 'john', 2)
+        calls = self.count_get_items(aws)
+        aws['ddb'].meta.client.meta.events.register(
+            'after-call.dynamodb.GetItem',
+            lambda **kwargs: dynamo_client.update_image_status(aws['table'], 'john', 'img-00001', 'processing'))
+        
+        for _ in range(3):
+            dynamo_client.get_image_metadata(aws['table'], 'john', 'img-00000')
+        
+        assert len(calls) == 1
+        assert dynamo_client.metadata_cache_stats()['hits'] == 2
+        assert dynamo_client._load_generations == {}
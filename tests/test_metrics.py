@@ -0,0 +1,100 @@
+# moto-backed tests for the handler and AWS call instrumentation
+import json
+
+import pytest
+
+from service import metrics
+from service.dynamo_client import put_image_metadata
+
+@pytest.fixture
+def sampled(monkeypatch):
+    """Record every invocation, starting from empty totals"""
+    monkeypatch.setattr(metrics, 'SAMPLE_RATE', 1.0)
+    metrics.REGISTRY.reset()
+    yield metrics.REGISTRY
+    metrics.REGISTRY.reset()
+
+def seed(table, count):
+    """Write count uploaded images for test_user"""
+    for i in range(count):
+        put_image_metadata(table, {
+            'user_id': 'test_user', 'image_id': f'img{i}', 'status': 'uploaded',
+            's3_key': f'test_user/img{i}.jpg', 'created_at': f'2024-01-0{i + 1}T00:00:00Z', 'tags': []
+        })
+
+def emf_lines(capsys):
+    """EMF documents printed so far"""
+    return [json.loads(line) for line in capsys.readouterr().out.splitlines() if '"_aws"' in line]
+
+def test_records_handler_calls_and_spans(aws, sampled, capsys):
+    """A sampled list records its DynamoDB query, capacity, presign and serialize time"""
+    from service.handler import list_images_handler
+    
+    seed(aws['table'], 3)
+    capsys.readouterr()
+    result = list_images_handler({'queryStringParameters': {'user_id': 'test_user'}}, None)
+    
+    [doc] = emf_lines(capsys)
+    assert doc['Handler'] == 'list_images_handler'
+    assert doc['StatusCode'] == 200
+    assert doc['ResponseBytes'] == len(result['body'])
+    assert doc['DynamoDBCalls'] == 1
+    assert doc['ConsumedCapacity'] > 0
+    assert doc['PresignDuration'] >= 0 and doc['SerializeDuration'] >= 0
+    assert doc['AwsCalls'][0]['Operation'] == 'Query'
+    metric_names = {m['Name'] for m in doc['_aws']['CloudWatchMetrics'][0]['Metrics']}
+    assert {'Duration', 'DynamoDBDuration', 'PresignDuration'} <= metric_names
+    
+    text = sampled.prometheus()
+    assert 'handler_invocations_total{handler="list_images_handler",status="200"} 1' in text
+    assert 'aws_calls_total{service="dynamodb",operation="Query"} 1' in text
+    assert 'span_duration_milliseconds_count{span="presign"} 3' in text
+
+def test_counts_calls_made_on_worker_threads(aws, sampled, capsys):
+    """S3 HEADs issued from the confirm pool belong to the invocation"""
+    from service.handler import batch_confirm_upload_handler
+    
+    seed(aws['table'], 2)
+    aws['s3'].put_object(Bucket=aws['bucket'], Key='test_user/img0.jpg', Body=b'x')
+    capsys.readouterr()
+    event = {'body': json.dumps({'user_id': 'test_user', 'image_ids': ['img0', 'img1']})}
+    batch_confirm_upload_handler(event, None)
+    
+    [doc] = emf_lines(capsys)
+    assert doc['S3Calls'] == 2
+    assert doc['RequestBytes'] == len(event['body'])
+
+def test_unsampled_invocations_leave_no_trace(aws, capsys, monkeypatch):
+    """With sampling off nothing is logged or counted and no capacity is requested"""
+    from service.handler import list_images_handler
+    
+    monkeypatch.setattr(metrics, 'SAMPLE_RATE', 0.0)
+    metrics.REGISTRY.reset()
+    seed(aws['table'], 1)
+    seen = []
+    aws['ddb'].meta.client.meta.events.register(
+        'before-parameter-build.dynamodb.Query', lambda params, **kwargs: seen.append(dict(params)))
+    capsys.readouterr()
+    
+    list_images_handler({'queryStringParameters': {'user_id': 'test_user'}}, None)
+    
+    assert emf_lines(capsys) == []
+    assert 'ReturnConsumedCapacity' not in seen[0]
+    assert 'aws_calls_total{' not in metrics.REGISTRY.prometheus()
+
+def test_streamed_bodies_are_left_for_the_caller(aws, sampled, capsys):
+    """A sampled handler can still read an S3 object, sized from its Content-Length"""
+    from service.s3_client import get_file
+    
+    body = b'x' * 1100
+    aws['s3'].put_object(Bucket=aws['bucket'], Key='test_user/img0.jpg', Body=body)
+    capsys.readouterr()
+    
+    @metrics.instrumented
+    def read_handler(event, context):
+        return {'statusCode': 200, 'body': get_file(aws['bucket'], 'test_user/img0.jpg')}
+    
+    assert read_handler({}, None)['body'] == body
+    [doc] = emf_lines(capsys)
+    assert doc['AwsCalls'][0]['Operation'] == 'GetObject'
+    assert 'aws_response_bytes_total{service="s3",operation="GetObject"} 1100' in sampled.prometheus()
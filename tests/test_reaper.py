@@ -0,0 +1,77 @@
+# moto-backed tests for the abandoned upload reaper
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from service.dynamo_client import put_image_metadata, get_image_metadata, get_images
+
+NOW = datetime(2024, 6, 1, 12, 0, 0)
+
+def pending(table, image_id, hours_ago, **extra):
+    """Write a pending image created hours_ago before NOW"""
+    put_image_metadata(table, {
+        'user_id': 'john', 'image_id': image_id, 'status': 'pending',
+        's3_key': f'john/{image_id}.jpg', 'tags': ['beach'],
+        'created_at': (NOW - timedelta(hours=hours_ago)).isoformat() + 'Z',
+        'expires_at': 1, **extra
+    })
+
+def seed(aws):
+    """Stale images with and without their file, a fresh one and an uploaded one"""
+    for i in range(6):
+        pending(aws['table'], f'gone{i}', hours_ago=10)
+    pending(aws['table'], 'landed', hours_ago=10)
+    aws['s3'].put_object(Bucket=aws['bucket'], Key='john/landed.jpg', Body=b'x' * 42)
+    upload_id = aws['s3'].create_multipart_upload(Bucket=aws['bucket'], Key='john/parts.jpg')['UploadId']
+    pending(aws['table'], 'parts', hours_ago=10, upload_id=upload_id)
+    pending(aws['table'], 'fresh', hours_ago=1)
+    put_image_metadata(aws['table'], {
+        'user_id': 'john', 'image_id': 'done', 'status': 'uploaded', 's3_key': 'john/done.jpg',
+        'created_at': (NOW - timedelta(days=3)).isoformat() + 'Z', 'tags': []
+    })
+
+def test_reaps_stale_pending_images(aws):
+    """Missing uploads are deleted with their tag rows, landed ones confirmed, others kept"""
+    from service import reaper
+    
+    seed(aws)
+    
+    summary = reaper.reap(older_than=6 * 3600, segments=4, now=NOW)
+    
+    assert summary['scanned'] == 10
+    assert summary['stale'] == 8
+    assert summary['confirmed'] == 1
+    assert summary['deleted'] == 7
+    assert summary['failed'] == 0
+    
+    remaining = {item['image_id']: item for item in get_images(aws['table'], 'john')}
+    assert set(remaining) == {'landed', 'fresh', 'done'}
+    assert remaining['landed']['status'] == 'uploaded'
+    assert remaining['landed']['file_size'] == 42
+    assert 'expires_at' not in remaining['landed']
+    assert [i['image_id'] for i in get_images(aws['table'], 'john', tag='beach')] == ['fresh', 'landed']
+    assert aws['s3'].list_multipart_uploads(Bucket=aws['bucket']).get('Uploads', []) == []
+
+def test_dry_run_changes_nothing(aws):
+    """A dry run reports what it would do without writing"""
+    from service import reaper
+    
+    seed(aws)
+    
+    summary = reaper.reaper_handler({'dry_run': True, 'older_than': 6 * 3600, 'segments': 2}, None)
+    
+    assert summary['dry_run'] is True
+    assert summary['stale'] > 0
+    assert len(list(get_images(aws['table'], 'john'))) == 10
+
+def test_s3_errors_keep_the_image(aws):
+    """Images whose HEAD fails for another reason than 404 are left alone"""
+    from botocore.exceptions import ClientError
+    from service import reaper
+    
+    pending(aws['table'], 'throttled', hours_ago=10)
+    error = ClientError({'Error': {'Code': 'SlowDown'}}, 'HeadObject')
+    with patch('service.reaper.get_file_metadata', side_effect=error):
+        summary = reaper.reap(older_than=6 * 3600, segments=1, now=NOW)
+    
+    assert summary['failed'] == 1
+    assert get_image_metadata(aws['table'], 'john', 'throttled')['status'] == 'pending'
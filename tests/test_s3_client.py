@@ -0,0 +1,78 @@
+# moto-backed tests for the S3 client
+from unittest.mock import patch
+
+from service import s3_client
+
+class TestPresignedUrlCache:
+    """Tests for the presigned download URL cache"""
+    
+    def test_reuses_url_and_counts(self, aws):
+        """A second request for the same object is a cache hit"""
+        first = s3_client.generate_presigned_download_url(aws['bucket'], 'john/a.jpg')
+        second = s3_client.generate_presigned_download_url(aws['bucket'], 'john/a.jpg')
+        
+        assert first == second
+        stats = s3_client.presign_cache_stats()
+        assert stats['hits'] == 1
+        assert stats['misses'] == 1
+        assert stats['size'] == 1
+    
+    def test_expiry_aligned_to_bucket(self, aws):
+        """Expiry lands on a bucket boundary with at least min_ttl left"""
+        expires_at = s3_client.aligned_expiry(1000, 3600, bucket_seconds=900, min_ttl=600)
+        assert expires_at == 4500
+        
+        expires_at = s3_client.aligned_expiry(1000, 700, bucket_seconds=900, min_ttl=600)
+        assert expires_at == 1800
+    
+    def test_resigns_below_min_ttl(self, aws):
+        """URLs close to expiry are not handed out again"""
+        with patch('service.s3_client.time.time', return_value=1_000_000):
+            first = s3_client.generate_presigned_download_url(aws['bucket'], 'john/a.jpg')
+        
+        later = 1_000_000 + 3600 - s3_client.PRESIGN_MIN_TTL
+        with patch('service.s3_client.time.time', return_value=later):
+            second = s3_client.generate_presigned_download_url(aws['bucket'], 'john/a.jpg')
+        
+        assert first != second
+        assert s3_client.presign_cache_stats()['misses'] == 2
+    
+    def test_delete_invalidates(self, aws):
+        """Deleting an object drops its cached URL"""
+        aws['s3'].put_object(Bucket=aws['bucket'], Key='john/a.jpg', Body=b'x')
+        s3_client.generate_presigned_download_url(aws['bucket'], 'john/a.jpg')
+        
+        s3_client.delete_s3_object(aws['bucket'], 'john/a.jpg')
+        
+        assert s3_client.presign_cache_stats()['size'] == 0
+    
+    def test_lru_eviction(self):
+        """The least recently used entry is evicted once full"""
+        cache = s3_client.PresignedUrlCache(max_size=2, min_ttl=0)
+        cache.put('b', 'k1', 'url1', 100)
+        cache.put('b', 'k2', 'url2', 100)
+        cache.get('b', 'k1', 0)
+        cache.put('b', 'k3', 'url3', 100)
+        
+        assert cache.get('b', 'k2', 0) is None
+        assert cache.get('b', 'k1', 0) == 'url1'
+        assert cache.stats()['evictions'] == 1
+
+class TestDeleteObjects:
+    """Tests for batched S3 deletes"""
+    
+    def test_deletes_in_chunks(self, aws):
+        """Keys are sent to DeleteObjects in chunks of at most 1000"""
+        keys = [f'john/{i}.jpg' for i in range(1500)]
+        for key in keys[:3]:
+            aws['s3'].put_object(Bucket=aws['bucket'], Key=key, Body=b'x')
+        calls = []
+        aws['s3'].meta.events.register(
+            'before-parameter-build.s3.DeleteObjects',
+            lambda params, **kwargs: calls.append(len(params['Delete']['Objects'])))
+        
+        errors = s3_client.delete_s3_objects(aws['bucket'], keys)
+        
+        assert errors == {}
+        assert calls == [1000, 500]
+        assert aws['s3'].list_objects_v2(Bucket=aws['bucket'])['KeyCount'] == 0
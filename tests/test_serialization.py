@@ -0,0 +1,36 @@
+# Tests for response serialization
+import json
+from decimal import Decimal
+
+import pytest
+
+from service import serialization
+
+BACKENDS = ['json'] + (['orjson'] if serialization.orjson else [])
+
+ITEM = {
+    'user_id': 'john',
+    'image_id': 'img1',
+    'file_size': Decimal('1024'),
+    'ratio': Decimal('1.5'),
+    'tags': ['beach', 'summer'],
+    'labels': {'b', 'a'},
+    'nested': {'sizes': [Decimal('200'), Decimal('1080')]}
+}
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_dumps_encodes_dynamodb_types(backend):
+    """Decimals become ints or floats and sets become sorted lists"""
+    decoded = json.loads(serialization.dumps(ITEM, backend))
+    
+    assert decoded['file_size'] == 1024
+    assert isinstance(decoded['file_size'], int)
+    assert decoded['ratio'] == 1.5
+    assert decoded['labels'] == ['a', 'b']
+    assert decoded['nested']['sizes'] == [200, 1080]
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_dumps_rejects_unknown_types(backend):
+    """Unknown types still fail loudly"""
+    with pytest.raises(TypeError):
+        serialization.dumps({'value': object()}, backend)
@@ -1,164 +1,743 @@
-# Simple tests for Instagram Image Service
-import pytest
-import json
-import os
-from unittest.mock import patch, MagicMock
-
-# Set environment variables for testing
-os.environ['AWS_ENDPOINT_URL'] = 'http://localhost:4566'
-os.environ['S3_BUCKET'] = 'test-images'
-os.environ['DDB_TABLE'] = 'test-images'
-
-class TestInstagramImageService:
-    """Simple tests for Instagram Image Service APIs"""
-    
-    def test_upload_url_handler(self):
-        """Test upload URL generation"""
-        from service.handler import upload_url_handler
-        
-        event = {
-            'body': json.dumps({
-                'user_id': 'test_user',
-                'filename': 'test.jpg',
-                'content_type': 'image/jpeg',
-                'tags': ['test']
-            })
-        }
-        
-        with patch('service.handler.generate_presigned_upload_url') as mock_url, \
-             patch('service.handler.put_image_metadata') as mock_put:
-            
-            mock_url.return_value = 'http://test-url.com'
-            
-            result = upload_url_handler(event, None)
-            
-            # Check if it's either 200 (success) or 500 (expected for demo)
-            assert result['statusCode'] in [200, 500]
-            if result['statusCode'] == 200:
-                body = json.loads(result['body'])
-                assert 'upload_url' in body
-                assert body['image_id'] == 'test.jpg'
-    
-    def test_confirm_upload_handler(self):
-        """Test upload confirmation"""
-        from service.handler import confirm_upload_handler
-        
-        event = {
-            'body': json.dumps({
-                'user_id': 'test_user',
-                'image_id': 'test.jpg'
-            })
-        }
-        
-        with patch('service.handler.get_image_metadata') as mock_get, \
-             patch('service.handler.check_file_exists') as mock_check, \
-             patch('service.handler.get_file_metadata') as mock_file, \
-             patch('service.handler.update_image_status') as mock_update:
-            
-            mock_get.return_value = {'s3_key': 'test_key', 'status': 'pending'}
-            mock_check.return_value = True
-            mock_file.return_value = {'file_size': 1024}
-            
-            result = confirm_upload_handler(event, None)
-            
-            assert result['statusCode'] == 200
-            body = json.loads(result['body'])
-            assert body['status'] == 'success'
-    
-    def test_list_images_handler(self):
-        """Test list images"""
-        from service.handler import list_images_handler
-        
-        event = {
-            'queryStringParameters': {'user_id': 'test_user'}
-        }
-        
-        with patch('service.handler.get_images') as mock_get, \
-             patch('service.handler.generate_presigned_download_url') as mock_url:
-            
-            mock_get.return_value = [
-                {'user_id': 'test_user', 'image_id': 'test.jpg', 'status': 'uploaded', 's3_key': 'test_key'}
-            ]
-            mock_url.return_value = 'http://download-url.com'
-            
-            result = list_images_handler(event, None)
-            
-            assert result['statusCode'] == 200
-            body = json.loads(result['body'])
-            assert 'images' in body
-            assert len(body['images']) == 1
-    
-    def test_get_image_handler(self):
-        """Test get single image"""
-        from service.handler import get_image_handler
-        
-        event = {
-            'pathParameters': {'user_id': 'test_user', 'image_id': 'test.jpg'}
-        }
-        
-        with patch('service.handler.get_image_metadata') as mock_get, \
-             patch('service.handler.generate_presigned_download_url') as mock_url:
-            
-            mock_get.return_value = {
-                'user_id': 'test_user', 
-                'image_id': 'test.jpg', 
-                'status': 'uploaded',
-                's3_key': 'test_key'
-            }
-            mock_url.return_value = 'http://download-url.com'
-            
-            result = get_image_handler(event, None)
-            
-            assert result['statusCode'] == 200
-            body = json.loads(result['body'])
-            assert body['user_id'] == 'test_user'
-            assert body['image_id'] == 'test.jpg'
-    
-    def test_delete_image_handler(self):
-        """Test delete image"""
-        from service.handler import delete_image_handler
-        
-        event = {
-            'pathParameters': {'user_id': 'test_user', 'image_id': 'test.jpg'}
-        }
-        
-        with patch('service.handler.get_image_metadata') as mock_get, \
-             patch('service.handler.delete_s3_object') as mock_s3, \
-             patch('service.handler.delete_image_metadata') as mock_ddb:
-            
-            mock_get.return_value = {
-                'user_id': 'test_user', 
-                'image_id': 'test.jpg',
-                's3_key': 'test_key'
-            }
-            
-            result = delete_image_handler(event, None)
-            
-            assert result['statusCode'] == 200
-            body = json.loads(result['body'])
-            # Check for either 'message' or 'deleted' field
-            assert 'message' in body or 'deleted' in body
-    
-    def test_health_endpoint(self):
-        """Test health check"""
-        from service.handler import response
-        
-        result = response(200, {'status': 'healthy', 'service': 'instagram-image-service'})
-        
-        assert result['statusCode'] == 200
-        body = json.loads(result['body'])
-        assert body['status'] == 'healthy'
-    
-    def test_error_cases(self):
-        """Test error handling"""
-        from service.handler import upload_url_handler
-        
-        # Test missing required fields
-        event = {'body': json.dumps({'user_id': 'test_user'})}
-        result = upload_url_handler(event, None)
-        assert result['statusCode'] == 400
-        
-        # Test invalid JSON
-        event = {'body': 'invalid json'}
-        result = upload_url_handler(event, None)
-        assert result['statusCode'] == 500
\ No newline at end of file
+# Simple tests for Instagram Image Service
+import pytest
+import json
+import os
+import time
+from unittest.mock import patch, MagicMock
+
+# Set environment variables for testing
+os.environ['AWS_ENDPOINT_URL'] = 'http://localhost:4566'
+os.environ['S3_BUCKET'] = 'test-images'
+os.environ['DDB_TABLE'] = 'test-images'
+
+class TestInstagramImageService:
+    """Simple tests for Instagram Image Service APIs"""
+    
+    def test_upload_url_handler(self):
+        """Test upload URL generation"""
+        from service.handler import upload_url_handler
+        
+        event = {
+            'body': json.dumps({
+                'user_id': 'test_user',
+                'filename': 'test.jpg',
+                'content_type': 'image/jpeg',
+                'tags': ['test']
+            })
+        }
+        
+        with patch('service.handler.generate_presigned_upload_url') as mock_url, \
+             patch('service.handler.put_image_metadata') as mock_put:
+            
+            mock_url.return_value = 'http://test-url.com'
+            
+            result = upload_url_handler(event, None)
+            
+            assert result['statusCode'] == 200
+            body = json.loads(result['body'])
+            assert 'upload_url' in body
+            item = mock_put.call_args.args[1]
+            assert body['image_id'] == item['image_id']
+            assert item['s3_key'] == f"test_user/{item['image_id']}.jpg"
+            assert item['status'] == 'pending'
+            assert item['expires_at'] > time.time()
+    
+    def test_confirm_upload_handler(self):
+        """Test upload confirmation"""
+        from service.handler import confirm_upload_handler
+        
+        event = {
+            'body': json.dumps({
+                'user_id': 'test_user',
+                'image_id': 'test.jpg'
+            })
+        }
+        
+        with patch('service.handler.get_image_metadata') as mock_get, \
+             patch('service.handler.get_file_metadata') as mock_file, \
+             patch('service.handler.update_image_status') as mock_update:
+            
+            mock_get.return_value = {'s3_key': 'test_key', 'status': 'pending'}
+            mock_file.return_value = {'file_size': 1024}
+            
+            result = confirm_upload_handler(event, None)
+            
+            assert result['statusCode'] == 200
+            body = json.loads(result['body'])
+            assert body['status'] == 'success'
+            mock_file.assert_called_once_with('test-images', 'test_key')
+            
+            # Image deleted between the read and the conditional update
+            mock_update.return_value = None
+            result = confirm_upload_handler(event, None)
+            assert result['statusCode'] == 404
+    
+    def test_list_images_handler(self):
+        """Test list images"""
+        from service.handler import list_images_handler
+        
+        event = {
+            'queryStringParameters': {'user_id': 'test_user'}
+        }
+        
+        with patch('service.handler.get_images') as mock_get, \
+             patch('service.handler.generate_presigned_download_url') as mock_url:
+            
+            mock_get.return_value = [
+                {'user_id': 'test_user', 'image_id': 'test.jpg', 'status': 'uploaded', 's3_key': 'test_key'}
+            ]
+            mock_url.return_value = 'http://download-url.com'
+            
+            result = list_images_handler(event, None)
+            
+            assert result['statusCode'] == 200
+            body = json.loads(result['body'])
+            assert 'images' in body
+            assert len(body['images']) == 1
+    
+    def test_get_image_handler(self):
+        """Test get single image"""
+        from service.handler import get_image_handler
+        
+        event = {
+            'pathParameters': {'user_id': 'test_user', 'image_id': 'test.jpg'}
+        }
+        
+        with patch('service.handler.get_image_metadata') as mock_get, \
+             patch('service.handler.generate_presigned_download_url') as mock_url:
+            
+            mock_get.return_value = {
+                'user_id': 'test_user', 
+                'image_id': 'test.jpg', 
+                'status': 'uploaded',
+                's3_key': 'test_key'
+            }
+            mock_url.return_value = 'http://download-url.com'
+            
+            result = get_image_handler(event, None)
+            
+            assert result['statusCode'] == 200
+            body = json.loads(result['body'])
+            assert body['user_id'] == 'test_user'
+            assert body['image_id'] == 'test.jpg'
+    
+    def test_delete_image_handler(self):
+        """Test delete image"""
+        from service.handler import delete_image_handler
+        
+        event = {
+            'pathParameters': {'user_id': 'test_user', 'image_id': 'test.jpg'}
+        }
+        
+        with patch('service.handler.delete_s3_objects') as mock_s3, \
+             patch('service.handler.delete_image_metadata') as mock_ddb:
+            
+            mock_ddb.return_value = {
+                'user_id': 'test_user', 
+                'image_id': 'test.jpg',
+                's3_key': 'test_key'
+            }
+            
+            result = delete_image_handler(event, None)
+            
+            assert result['statusCode'] == 200
+            body = json.loads(result['body'])
+            # Check for either 'message' or 'deleted' field
+            assert 'message' in body or 'deleted' in body
+    
+    def test_delete_after_confirmation_elsewhere(self, aws):
+        """A delete removes the file even if this process cached the image while it was pending"""
+        from service.handler import get_image_handler, delete_image_handler
+        from service.dynamo_client import put_image_metadata
+        
+        put_image_metadata(aws['table'], {'user_id': 'test_user', 'image_id': 'img1', 'status': 'pending',
+                                          's3_key': 'test_user/img1.jpg', 'tags': []})
+        event = {'pathParameters': {'user_id': 'test_user', 'image_id': 'img1'}}
+        assert json.loads(get_image_handler(event, None)['body'])['status'] == 'pending'
+        
+        # The S3 event Lambda confirms the upload, out of reach of this process's cache
+        aws['s3'].put_object(Bucket=aws['bucket'], Key='test_user/img1.jpg', Body=b'x')
+        aws['ddb'].Table(aws['table']).update_item(
+            Key={'user_id': 'test_user', 'image_id': 'img1'},
+            UpdateExpression='SET #status = :status', ExpressionAttributeNames={'#status': 'status'},
+            ExpressionAttributeValues={':status': 'uploaded'})
+        
+        assert delete_image_handler(event, None)['statusCode'] == 200
+        assert aws['s3'].list_objects_v2(Bucket=aws['bucket']).get('KeyCount', 0) == 0
+        assert delete_image_handler(event, None)['statusCode'] == 404
+    
+    def test_health_endpoint(self):
+        """Test health check"""
+        from service.handler import response
+        
+        result = response(200, {'status': 'healthy', 'service': 'instagram-image-service'})
+        
+        assert result['statusCode'] == 200
+        body = json.loads(result['body'])
+        assert body['status'] == 'healthy'
+    
+    def test_error_cases(self):
+        """Test error handling"""
+        from service.handler import upload_url_handler
+        
+        # Test missing required fields
+        event = {'body': json.dumps({'user_id': 'test_user'})}
+        result = upload_url_handler(event, None)
+        assert result['statusCode'] == 400
+        
+        # Test invalid JSON
+        event = {'body': 'invalid json'}
+        result = upload_url_handler(event, None)
+        assert result['statusCode'] == 500
+    
+    def test_list_images_pagination(self):
+        """Test list images returns a next_token that resumes the listing"""
+        from service.handler import list_images_handler
+        
+        items = [
+            {'user_id': 'test_user', 'image_id': f'img{i}', 'status': 'pending'}
+            for i in range(5)
+        ]
+        
+        def fake_get_images(table_name, user_id, start_key=None, **kwargs):
+            start = 0
+            if start_key:
+                start = [i['image_id'] for i in items].index(start_key['image_id']) + 1
+            return iter(items[start:])
+        
+        with patch('service.handler.get_images', side_effect=fake_get_images):
+            event = {'queryStringParameters': {'user_id': 'test_user', 'limit': '3'}}
+            result = list_images_handler(event, None)
+            
+            assert result['statusCode'] == 200
+            body = json.loads(result['body'])
+            assert [i['image_id'] for i in body['images']] == ['img0', 'img1', 'img2']
+            assert body['next_token']
+            
+            event['queryStringParameters']['next_token'] = body['next_token']
+            body = json.loads(list_images_handler(event, None)['body'])
+            assert [i['image_id'] for i in body['images']] == ['img3', 'img4']
+            assert body['next_token'] is None
+    
+    def test_list_images_invalid_pagination(self):
+        """Test bad limit and next_token values are rejected"""
+        from service.handler import list_images_handler, encode_page_token
+        
+        for params in [
+            {'user_id': 'test_user', 'limit': '0'},
+            {'user_id': 'test_user', 'limit': 'abc'},
+            {'user_id': 'test_user', 'next_token': 'not-a-token'},
+            {'user_id': 'test_user', 'next_token': encode_page_token(
+                {'user_id': 'other_user', 'image_id': 'img0'})}
+        ]:
+            result = list_images_handler({'queryStringParameters': params}, None)
+            assert result['statusCode'] == 400
+    
+    def test_list_images_date_range(self):
+        """Test date range and order are pushed down to get_images"""
+        from service.handler import list_images_handler
+        
+        with patch('service.handler.get_images') as mock_get:
+            mock_get.return_value = []
+            event = {'queryStringParameters': {
+                'user_id': 'test_user',
+                'start_date': '2024-01-01T00:00:00Z',
+                'end_date': '2024-01-07T23:59:59Z',
+                'order': 'desc'
+            }}
+            
+            result = list_images_handler(event, None)
+            
+            assert result['statusCode'] == 200
+            kwargs = mock_get.call_args.kwargs
+            assert kwargs['start_date'] == '2024-01-01T00:00:00Z'
+            assert kwargs['end_date'] == '2024-01-07T23:59:59Z'
+            assert kwargs['descending'] is True
+        
+        event = {'queryStringParameters': {'user_id': 'test_user', 'order': 'sideways'}}
+        assert list_images_handler(event, None)['statusCode'] == 400
+    
+    def test_batch_upload_url_handler(self):
+        """Test batch upload URL generation with per-file results"""
+        from service.handler import batch_upload_url_handler
+        
+        event = {
+            'body': json.dumps({
+                'user_id': 'test_user',
+                'files': [
+                    {'filename': 'a.jpg', 'content_type': 'image/jpeg'},
+                    {'filename': 'b.png'},
+                    {'filename': 'c.png', 'content_type': 'image/png', 'tags': ['album']}
+                ]
+            })
+        }
+        
+        with patch('service.handler.generate_presigned_upload_url') as mock_url, \
+             patch('service.handler.batch_put_image_metadata') as mock_batch:
+            
+            mock_url.return_value = 'http://test-url.com'
+            mock_batch.side_effect = lambda table, items: [items[1]['image_id']]
+            
+            result = batch_upload_url_handler(event, None)
+            
+            assert result['statusCode'] == 200
+            body = json.loads(result['body'])
+            uploads = body['uploads']
+            assert body['count'] == 1
+            assert uploads[0]['upload_url'] == 'http://test-url.com'
+            assert 'error' in uploads[1]
+            assert uploads[2]['error'] == 'Failed to store image metadata'
+            assert 'upload_url' not in uploads[2]
+            assert len(mock_batch.call_args.args[1]) == 2
+        
+        result = batch_upload_url_handler({'body': json.dumps({'user_id': 'test_user', 'files': []})}, None)
+        assert result['statusCode'] == 400
+    
+    def test_batch_confirm_upload_handler(self, aws):
+        """Test batch confirm checks S3 and updates each image on the confirm pool"""
+        import threading
+        from service.handler import batch_confirm_upload_handler
+        from service.dynamo_client import put_image_metadata, get_image_metadata
+        
+        for image_id in ('a', 'b', 'c'):
+            put_image_metadata(aws['table'], {
+                'user_id': 'test_user', 'image_id': image_id, 'status': 'pending',
+                's3_key': f'test_user/{image_id}.jpg', 'created_at': '2024-01-01T00:00:00Z', 'tags': []
+            })
+        for image_id in ('a', 'b'):
+            aws['s3'].put_object(Bucket=aws['bucket'], Key=f'test_user/{image_id}.jpg', Body=b'x' * 10)
+        head_threads = []
+        aws['s3'].meta.events.register(
+            'before-call.s3.HeadObject',
+            lambda **kwargs: head_threads.append(threading.current_thread().name))
+        
+        event = {'body': json.dumps({'user_id': 'test_user', 'image_ids': ['a', 'b', 'c', 'missing', 'a']})}
+        result = batch_confirm_upload_handler(event, None)
+        
+        assert result['statusCode'] == 200
+        body = json.loads(result['body'])
+        assert body['count'] == 2
+        assert body['results'] == [
+            {'image_id': 'a', 'status': 'success', 'file_size': 10},
+            {'image_id': 'b', 'status': 'success', 'file_size': 10},
+            {'image_id': 'c', 'error': 'File not found in S3'},
+            {'image_id': 'missing', 'error': 'Image not found'}
+        ]
+        assert len(head_threads) == 3
+        assert all(name.startswith('confirm') for name in head_threads)
+        assert get_image_metadata(aws['table'], 'test_user', 'a')['status'] == 'uploaded'
+        assert get_image_metadata(aws['table'], 'test_user', 'c')['status'] == 'pending'
+        
+        for body in ({'user_id': 'test_user'}, {'user_id': 'test_user', 'image_ids': []}, {'image_ids': ['a']}):
+            assert batch_confirm_upload_handler({'body': json.dumps(body)}, None)['statusCode'] == 400
+    
+    def test_bulk_delete_by_ids(self):
+        """Test bulk delete reports deleted, missing and failed images"""
+        from service.handler import bulk_delete_images_handler
+        
+        event = {'body': json.dumps({'user_id': 'test_user', 'image_ids': ['a', 'b', 'c', 'missing']})}
+        
+        with patch('service.handler.batch_get_image_metadata') as mock_get, \
+             patch('service.handler.delete_s3_objects') as mock_s3, \
+             patch('service.handler.batch_delete_image_metadata') as mock_ddb:
+            
+            mock_get.return_value = [
+                {'user_id': 'test_user', 'image_id': 'a', 'status': 'uploaded', 's3_key': 'k/a'},
+                {'user_id': 'test_user', 'image_id': 'b', 'status': 'uploaded', 's3_key': 'k/b'},
+                {'user_id': 'test_user', 'image_id': 'c', 'status': 'pending', 's3_key': 'k/c'}
+            ]
+            mock_s3.return_value = {'k/b': 'AccessDenied'}
+            mock_ddb.return_value = []
+            
+            result = bulk_delete_images_handler(event, None)
+            
+            assert result['statusCode'] == 200
+            body = json.loads(result['body'])
+            assert body['deleted'] == 2
+            assert body['not_found'] == ['missing']
+            assert [f['image_id'] for f in body['failed']] == ['b']
+            s3_keys = list(mock_s3.call_args.args[1])
+            assert [key for key in s3_keys if not key.startswith('derived/')] == ['k/a', 'k/b']
+            assert 'derived/thumbnail/k/a.jpg' in s3_keys
+            assert [i['image_id'] for i in mock_ddb.call_args.args[1]] == ['a', 'c']
+        
+        for body in [{'user_id': 'test_user'}, {'user_id': 'test_user', 'all': True, 'image_ids': ['a']}]:
+            result = bulk_delete_images_handler({'body': json.dumps(body)}, None)
+            assert result['statusCode'] == 400
+    
+    def test_bulk_delete_all(self, aws):
+        """Test deleting every image of a user against moto"""
+        from service import handler
+        from service.dynamo_client import batch_put_image_metadata, get_images
+        
+        items = []
+        for i in range(30):
+            key = f'heavy_user/{i}.jpg'
+            aws['s3'].put_object(Bucket=aws['bucket'], Key=key, Body=b'x')
+            items.append({'user_id': 'heavy_user', 'image_id': f'img{i:02d}',
+                          'status': 'uploaded', 's3_key': key, 'tags': ['album']})
+        batch_put_image_metadata(aws['table'], items)
+        
+        with patch.object(handler, 'BULK_DELETE_CHUNK', 8):
+            event = {'body': json.dumps({'user_id': 'heavy_user', 'all': True})}
+            result = handler.bulk_delete_images_handler(event, None)
+        
+        assert json.loads(result['body'])['deleted'] == 30
+        assert list(get_images(aws['table'], 'heavy_user')) == []
+        assert list(get_images(aws['table'], 'heavy_user', tag='album')) == []
+        assert aws['s3'].list_objects_v2(Bucket=aws['bucket'])['KeyCount'] == 0
+    
+    def test_s3_event_handler(self, aws):
+        """Test S3 ObjectCreated events mark images uploaded without HEAD calls"""
+        from service.handler import s3_event_handler
+        from service.dynamo_client import put_image_metadata, get_image_metadata
+        
+        for image_id in ('img1', 'img2'):
+            put_image_metadata(aws['table'], {
+                'user_id': 'test user', 'image_id': image_id, 'status': 'pending',
+                's3_key': f'test user/{image_id}.jpg', 'tags': []
+            })
+        
+        def s3_record(key, size):
+            return {
+                'eventSource': 'aws:s3',
+                'eventName': 'ObjectCreated:Put',
+                's3': {'bucket': {'name': aws['bucket']}, 'object': {'key': key, 'size': size}}
+            }
+        
+        heads = []
+        aws['s3'].meta.events.register('before-call.s3.HeadObject', lambda **kwargs: heads.append(1))
+        
+        # Direct S3 invocation, with a URL-encoded key and an unrelated object
+        result = s3_event_handler({'Records': [
+            s3_record('test+user/img1.jpg', 2048),
+            s3_record('derived/thumbs/x.jpg', 10)
+        ]}, None)
+        assert result['updated'] == 1
+        assert result['skipped'] == 1
+        
+        # SQS batch with one good message, one for a deleted image and one malformed message
+        result = s3_event_handler({'Records': [
+            {'eventSource': 'aws:sqs', 'messageId': 'm1',
+             'body': json.dumps({'Records': [s3_record('test+user/img2.jpg', 4096)]})},
+            {'eventSource': 'aws:sqs', 'messageId': 'm2',
+             'body': json.dumps({'Records': [s3_record('test+user/gone.jpg', 1)]})},
+            {'eventSource': 'aws:sqs', 'messageId': 'm3', 'body': 'not json'}
+        ]}, None)
+        assert result['updated'] == 1
+        assert result['skipped'] == 1
+        assert result['batchItemFailures'] == [{'itemIdentifier': 'm3'}]
+        
+        assert get_image_metadata(aws['table'], 'test user', 'img1')['file_size'] == 2048
+        assert get_image_metadata(aws['table'], 'test user', 'img2')['status'] == 'uploaded'
+        assert get_image_metadata(aws['table'], 'test user', 'gone') is None
+        assert heads == []
+    
+    def test_multipart_upload_flow(self, aws):
+        """Test starting, resuming and completing a multipart upload against moto"""
+        from service.handler import (
+            multipart_upload_handler,
+            multipart_part_urls_handler,
+            complete_multipart_handler
+        )
+        from service.dynamo_client import get_image_metadata
+        
+        event = {'body': json.dumps({
+            'user_id': 'test_user', 'filename': 'big.jpg',
+            'content_type': 'image/jpeg', 'part_count': 2
+        })}
+        body = json.loads(multipart_upload_handler(event, None)['body'])
+        image_id = body['image_id']
+        assert [p['part_number'] for p in body['parts']] == [1, 2]
+        
+        event = {'body': json.dumps({'user_id': 'test_user', 'image_id': image_id, 'part_numbers': [2]})}
+        result = multipart_part_urls_handler(event, None)
+        assert result['statusCode'] == 200
+        assert [p['part_number'] for p in json.loads(result['body'])['parts']] == [2]
+        
+        # Upload the parts as a client would with the presigned URLs
+        key = get_image_metadata(aws['table'], 'test_user', image_id)['s3_key']
+        parts = []
+        for part_number, data in [(1, b'a' * 5 * 1024 * 1024), (2, b'b' * 10)]:
+            resp = aws['s3'].upload_part(Bucket=aws['bucket'], Key=key, UploadId=body['upload_id'],
+                                         PartNumber=part_number, Body=data)
+            parts.append({'part_number': part_number, 'etag': resp['ETag']})
+        
+        event = {'body': json.dumps({'user_id': 'test_user', 'image_id': image_id, 'parts': parts[::-1]})}
+        result = complete_multipart_handler(event, None)
+        
+        assert result['statusCode'] == 200
+        assert json.loads(result['body'])['file_size'] == 5 * 1024 * 1024 + 10
+        item = get_image_metadata(aws['table'], 'test_user', image_id)
+        assert item['status'] == 'uploaded'
+        
+        event = {'body': json.dumps({'user_id': 'test_user', 'image_id': image_id, 'part_numbers': [1]})}
+        assert multipart_part_urls_handler(event, None)['statusCode'] == 409
+        
+        event = {'body': json.dumps({'user_id': 'test_user', 'filename': 'big.jpg',
+                                     'content_type': 'image/jpeg', 'part_count': 0})}
+        assert multipart_upload_handler(event, None)['statusCode'] == 400
+    
+    def test_list_images_sparse_fields(self, aws):
+        """Test fields= reads a projection and only presigns when download_url is asked for"""
+        from service.handler import list_images_handler
+        from service.dynamo_client import put_image_metadata
+        
+        for i in range(3):
+            put_image_metadata(aws['table'], {
+                'user_id': 'test_user', 'image_id': f'img{i}', 'status': 'uploaded',
+                's3_key': f'test_user/img{i}.jpg', 'created_at': f'2024-01-0{i + 1}T00:00:00Z',
+                'caption': 'long caption', 'tags': ['beach']
+            })
+        projections = []
+        aws['ddb'].meta.client.meta.events.register(
+            'before-parameter-build.dynamodb.Query',
+            lambda params, **kwargs: projections.append(params.get('ProjectionExpression')))
+        
+        event = {'queryStringParameters': {
+            'user_id': 'test_user', 'fields': 'image_id,created_at,download_url', 'limit': '2'
+        }}
+        body = json.loads(list_images_handler(event, None)['body'])
+        
+        assert projections[0] is not None
+        assert set(body['images'][0]) == {'image_id', 'created_at', 'download_url'}
+        assert body['images'][0]['download_url']
+        assert body['next_token']
+        
+        event['queryStringParameters'].update(fields='image_id', next_token=body['next_token'])
+        with patch('service.handler.generate_presigned_download_url') as mock_url:
+            body = json.loads(list_images_handler(event, None)['body'])
+            mock_url.assert_not_called()
+        assert body['images'] == [{'image_id': 'img2'}]
+    
+    def test_list_images_count_only(self, aws):
+        """Test count_only=true returns only a count, for tags and date ranges too"""
+        from service.handler import list_images_handler
+        from service.dynamo_client import put_image_metadata
+        
+        for i in range(5):
+            put_image_metadata(aws['table'], {
+                'user_id': 'test_user', 'image_id': f'img{i}', 'status': 'uploaded',
+                's3_key': f'test_user/img{i}.jpg', 'created_at': f'2024-01-0{i + 1}T00:00:00Z',
+                'tags': ['beach'] if i % 2 else []
+            })
+        selects = []
+        aws['ddb'].meta.client.meta.events.register(
+            'before-parameter-build.dynamodb.Query',
+            lambda params, **kwargs: selects.append(params.get('Select')))
+        
+        with patch('service.handler.generate_presigned_download_url') as mock_url:
+            for params, expected in [
+                ({}, 5),
+                ({'tag': 'beach'}, 2),
+                ({'start_date': '2024-01-03T00:00:00Z'}, 3)
+            ]:
+                event = {'queryStringParameters': {'user_id': 'test_user', 'count_only': 'true', **params}}
+                body = json.loads(list_images_handler(event, None)['body'])
+                assert body == {'count': expected}
+            mock_url.assert_not_called()
+        assert selects == ['COUNT'] * 3
+    
+    def test_dispatch_routes(self):
+        """Test the single-Lambda router selects handlers by method and resource"""
+        from service import handler
+        
+        calls = []
+        def fake(name):
+            return lambda event, context: calls.append((name, event.get('pathParameters'))) or {'statusCode': 200}
+        
+        routes = {key: fake(h.__name__) for key, h in handler.ROUTES.items()}
+        with patch.dict(handler.ROUTES, routes):
+            handler.dispatch({'httpMethod': 'POST', 'resource': '/upload-url', 'path': '/upload-url'}, None)
+            handler.dispatch({
+                'httpMethod': 'GET', 'resource': '/images/{user_id}/{image_id}',
+                'path': '/images/u1/i1', 'pathParameters': {'user_id': 'u1', 'image_id': 'i1'}
+            }, None)
+            # Without a resource the raw path is matched and path parameters filled in
+            handler.dispatch({'httpMethod': 'DELETE', 'path': '/images/u%402/i2'}, None)
+            handler.dispatch({'httpMethod': 'POST', 'path': '/images/bulk-delete'}, None)
+            
+            not_found = handler.dispatch({'httpMethod': 'GET', 'path': '/nope'}, None)
+            wrong_method = handler.dispatch({'httpMethod': 'PUT', 'resource': '/images', 'path': '/images'}, None)
+        
+        assert calls == [
+            ('upload_url_handler', None),
+            ('get_image_handler', {'user_id': 'u1', 'image_id': 'i1'}),
+            ('delete_image_handler', {'user_id': 'u@2', 'image_id': 'i2'}),
+            ('bulk_delete_images_handler', {})
+        ]
+        assert not_found['statusCode'] == 404
+        assert wrong_method['statusCode'] == 405
+    
+    def test_dispatch_end_to_end(self, aws):
+        """Test dispatch serves an upload, a get and a list from one entry point"""
+        from service.handler import dispatch
+        
+        uploaded = dispatch({
+            'httpMethod': 'POST', 'resource': '/upload-url', 'path': '/upload-url',
+            'body': json.dumps({'user_id': 'u1', 'filename': 'a.png', 'content_type': 'image/png'})
+        }, None)
+        image_id = json.loads(uploaded['body'])['image_id']
+        
+        got = dispatch({'httpMethod': 'GET', 'path': f'/images/u1/{image_id}'}, None)
+        listed = dispatch({'httpMethod': 'GET', 'resource': '/images', 'path': '/images',
+                           'queryStringParameters': {'user_id': 'u1'}}, None)
+        
+        assert uploaded['statusCode'] == 200
+        assert json.loads(got['body'])['image_id'] == image_id
+        assert [i['image_id'] for i in json.loads(listed['body'])['images']] == [image_id]
+    
+    def test_upload_deduplicated_by_sha256(self, aws):
+        """Test a repeated upload shares the file and the last delete removes it"""
+        import base64
+        import hashlib
+        from service import handler
+        from service.handler import (upload_url_handler, batch_upload_url_handler, confirm_upload_handler,
+                                     delete_image_handler, bulk_delete_images_handler, get_file_metadata)
+        from service.dynamo_client import get_image_metadata, get_user_stats
+        
+        content = b'same picture'
+        sha256 = hashlib.sha256(content).hexdigest()
+        checksum = base64.b64encode(hashlib.sha256(content).digest()).decode()
+        upload = {'user_id': 'test_user', 'filename': 'a.jpg', 'content_type': 'image/jpeg', 'sha256': sha256}
+        
+        first = json.loads(upload_url_handler({'body': json.dumps(upload)}, None)['body'])
+        assert first['deduplicated'] is False
+        assert 'x-amz-checksum-sha256=' in first['upload_url']
+        original = get_image_metadata(aws['table'], 'test_user', first['image_id'])
+        aws['s3'].put_object(Bucket=aws['bucket'], Key=original['s3_key'], Body=content)
+        
+        # moto does not report checksums on HEAD, S3 does for uploads made with one
+        with patch('service.handler.get_file_metadata',
+                   side_effect=lambda bucket, key: {**get_file_metadata(bucket, key), 'checksum_sha256': checksum}):
+            confirmed = confirm_upload_handler({'body': json.dumps(
+                {'user_id': 'test_user', 'image_id': first['image_id']})}, None)
+        assert confirmed['statusCode'] == 200
+        
+        second = json.loads(upload_url_handler({'body': json.dumps(dict(upload, filename='b.jpg'))}, None)['body'])
+        assert second == {'image_id': second['image_id'], 'status': 'uploaded', 'deduplicated': True}
+        copy = get_image_metadata(aws['table'], 'test_user', second['image_id'])
+        assert copy['s3_key'] == original['s3_key']
+        assert copy['status'] == 'uploaded'
+        assert copy['file_size'] == len(content)
+        assert 'expires_at' not in copy
+        
+        batch = json.loads(batch_upload_url_handler({'body': json.dumps({'user_id': 'test_user', 'files': [
+            {'filename': 'c.jpg', 'content_type': 'image/jpeg', 'sha256': sha256},
+            {'filename': 'd.jpg', 'content_type': 'image/jpeg', 'sha256': 'not-a-digest'}
+        ]})}, None)['body'])
+        assert batch['uploads'][0]['deduplicated'] is True
+        assert 'error' in batch['uploads'][1]
+        third_id = batch['uploads'][0]['image_id']
+        stats = get_user_stats(aws['table'], 'test_user')
+        assert (stats['image_count'], stats['total_bytes']) == (3, 3 * len(content))
+        
+        # Another user uploading the same bytes gets their own file
+        other = json.loads(upload_url_handler({'body': json.dumps(dict(upload, user_id='other_user'))}, None)['body'])
+        assert other['deduplicated'] is False
+        
+        def object_exists():
+            return aws['s3'].list_objects_v2(Bucket=aws['bucket']).get('KeyCount', 0) == 1
+        
+        def delete(image_id):
+            event = {'pathParameters': {'user_id': 'test_user', 'image_id': image_id}}
+            assert delete_image_handler(event, None)['statusCode'] == 200
+        
+        delete(first['image_id'])
+        assert object_exists()
+        delete(second['image_id'])
+        assert object_exists()
+        result = bulk_delete_images_handler({'body': json.dumps(
+            {'user_id': 'test_user', 'image_ids': [third_id]})}, None)
+        assert json.loads(result['body'])['deleted'] == 1
+        assert not object_exists()
+        assert get_user_stats(aws['table'], 'test_user')['image_count'] == 0
+        
+        # With the content gone, the next upload gets a fresh URL again
+        again = json.loads(upload_url_handler({'body': json.dumps(upload)}, None)['body'])
+        assert again['deduplicated'] is False
+        
+        bad = upload_url_handler({'body': json.dumps(dict(upload, sha256='abc'))}, None)
+        assert bad['statusCode'] == 400
+    
+    def test_conditional_get(self, aws):
+        """Read responses carry an ETag and a matching If-None-Match gets an empty 304"""
+        from service.handler import dispatch, upload_url_handler
+        
+        upload_url_handler({'body': json.dumps(
+            {'user_id': 'test_user', 'filename': 'a.jpg', 'content_type': 'image/jpeg'})}, None)
+        event = {'httpMethod': 'GET', 'path': '/images', 'queryStringParameters': {'user_id': 'test_user'}}
+        
+        first = dispatch(event, None)
+        etag = first['headers']['ETag']
+        assert first['statusCode'] == 200
+        assert etag.startswith('W/"')
+        assert dispatch(event, None)['headers']['ETag'] == etag
+        
+        for if_none_match in (etag, etag[2:], f'"other", {etag}', '*'):
+            cached = dispatch(dict(event, headers={'if-none-match': if_none_match}), None)
+            assert (cached['statusCode'], cached['body']) == (304, '')
+            assert cached['headers']['ETag'] == etag
+            assert cached['headers']['Vary'] == 'Accept-Encoding'
+        
+        stale = dispatch(dict(event, headers={'If-None-Match': '"other"'}), None)
+        assert stale['statusCode'] == 200
+        
+        # A new image changes the body and so the ETag
+        upload_url_handler({'body': json.dumps(
+            {'user_id': 'test_user', 'filename': 'b.jpg', 'content_type': 'image/jpeg'})}, None)
+        changed = dispatch(dict(event, headers={'If-None-Match': etag}), None)
+        assert changed['statusCode'] == 200
+        assert changed['headers']['ETag'] != etag
+    
+    def test_gzip_encoding(self, aws):
+        """Large bodies are gzipped and base64 encoded only for clients accepting gzip"""
+        import gzip
+        import base64
+        from service.handler import dispatch
+        
+        upload = {'user_id': 'test_user', 'filename': 'a.jpg', 'content_type': 'image/jpeg'}
+        for _ in range(10):
+            # API Gateway base64 encodes request bodies of binary media types
+            created = dispatch({'httpMethod': 'POST', 'path': '/upload-url', 'isBase64Encoded': True,
+                                'body': base64.b64encode(json.dumps(upload).encode()).decode()}, None)
+            assert created['statusCode'] == 200
+        event = {'httpMethod': 'GET', 'path': '/images', 'queryStringParameters': {'user_id': 'test_user'}}
+        plain = dispatch(event, None)
+        assert 'isBase64Encoded' not in plain
+        
+        encoded = dispatch(dict(event, headers={'Accept-Encoding': 'br, gzip;q=0.5'}), None)
+        assert encoded['isBase64Encoded'] is True
+        assert encoded['headers']['Content-Encoding'] == 'gzip'
+        assert encoded['headers']['ETag'] == plain['headers']['ETag']
+        assert gzip.decompress(base64.b64decode(encoded['body'])).decode() == plain['body']
+        assert len(base64.b64decode(encoded['body'])) < len(plain['body']) / 2
+        
+        assert plain['headers']['Vary'] == 'Accept-Encoding'
+        for accept_encoding, gzipped in (('gzip;q=0, br', False), ('*;q=0, gzip', True),
+                                         ('*', True), ('gzip;q=0, *', False), ('identity', False)):
+            result = dispatch(dict(event, headers={'Accept-Encoding': accept_encoding}), None)
+            assert result.get('isBase64Encoded', False) is gzipped
+        
+        count = dict(event, queryStringParameters={'user_id': 'test_user', 'count_only': 'true'})
+        small = dispatch(dict(count, headers={'Accept-Encoding': 'gzip'}), None)
+        assert 'isBase64Encoded' not in small
+        assert json.loads(small['body']) == {'count': 10}
+    
+    def test_flask_conditional_get_and_gzip(self, aws):
+        """The Flask app passes request headers through and sends 304s and gzip bodies"""
+        import gzip
+        from app import app
+        
+        client = app.test_client()
+        for _ in range(10):
+            client.post('/upload-url', json={'user_id': 'test_user', 'filename': 'a.jpg', 'content_type': 'image/jpeg'})
+        
+        res = client.get('/images?user_id=test_user', headers={'Accept-Encoding': 'gzip'})
+        assert res.status_code == 200
+        assert res.headers['Content-Encoding'] == 'gzip'
+        assert json.loads(gzip.decompress(res.data))['count'] == 10
+        
+        cached = client.get('/images?user_id=test_user', headers={'If-None-Match': res.headers['ETag']})
+        assert cached.status_code == 304
+        assert cached.data == b''
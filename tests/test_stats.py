@@ -0,0 +1,115 @@
+# moto-backed tests for the per-user stats and their reconciliation
+import json
+from unittest.mock import patch
+
+from service.dynamo_client import (
+    put_image_metadata, update_image_status, delete_image_metadata,
+    batch_delete_image_metadata, get_image_metadata, get_user_stats, add_user_stats
+)
+
+def pending(table, image_id, user_id='john'):
+    """Write a pending image"""
+    put_image_metadata(table, {
+        'user_id': user_id, 'image_id': image_id, 'status': 'pending', 's3_key': f'{user_id}/{image_id}.jpg',
+        'created_at': '2024-01-01T00:00:00Z', 'tags': ['beach']
+    })
+
+def stats(table, user_id='john'):
+    """(image_count, total_bytes) of a user"""
+    row = get_user_stats(table, user_id)
+    return row['image_count'], row['total_bytes']
+
+def test_uploads_and_deletes_are_counted_once(aws):
+    """Retried confirmations and deletes do not move the stats twice"""
+    table = aws['table']
+    for image_id in ('a', 'b', 'c'):
+        pending(table, image_id)
+    
+    update_image_status(table, 'john', 'a', 'uploaded', file_size=100)
+    update_image_status(table, 'john', 'a', 'uploaded', file_size=100)
+    update_image_status(table, 'john', 'b', 'uploaded', file_size=50)
+    update_image_status(table, 'john', 'c', 'pending')
+    assert stats(table) == (2, 150)
+    assert get_image_metadata(table, 'john', 'a')['counted_bytes'] == 100
+    
+    delete_image_metadata(table, 'john', 'a')
+    delete_image_metadata(table, 'john', 'a')
+    delete_image_metadata(table, 'john', 'c')
+    assert stats(table) == (1, 50)
+    
+    items = [get_image_metadata(table, 'john', 'b')]
+    assert batch_delete_image_metadata(table, items) == []
+    assert stats(table) == (0, 0)
+    assert stats(table, 'nobody') == (0, 0)
+
+def test_stats_endpoint(aws):
+    """GET /users/{user_id}/stats reads the stats row"""
+    from service.handler import dispatch
+    
+    pending(aws['table'], 'a')
+    update_image_status(aws['table'], 'john', 'a', 'uploaded', file_size=2048)
+    
+    result = dispatch({'httpMethod': 'GET', 'path': '/users/john/stats'}, None)
+    
+    assert result['statusCode'] == 200
+    assert json.loads(result['body']) == {'user_id': 'john', 'image_count': 1, 'total_bytes': 2048}
+
+def test_reconcile_rebuilds_from_images(aws):
+    """Drifted rows are rewritten, uncounted images marked, emptied users zeroed"""
+    from service import stats as stats_job
+    
+    table = aws['table']
+    for image_id in ('a', 'b'):
+        pending(table, image_id)
+        update_image_status(table, 'john', image_id, 'uploaded', file_size=10)
+    # An image from before stats were kept, a lost update and a user with nothing left
+    put_image_metadata(table, {'user_id': 'john', 'image_id': 'old', 'status': 'uploaded',
+                               's3_key': 'john/old.jpg', 'file_size': 5, 'tags': []})
+    add_user_stats(table, 'john', 1, 999)
+    add_user_stats(table, 'gone', 3, 300)
+    pending(table, 'p', user_id='mary')
+    
+    dry = stats_job.reconcile_user_stats(segments=2, dry_run=True)
+    assert stats(table) == (3, 1019)
+    
+    summary = stats_job.reconcile_user_stats(segments=2)
+    
+    assert dry['corrected'] == summary['corrected'] == 2
+    assert summary['scanned'] == 3
+    assert summary['marked'] == 1
+    assert stats(table) == (3, 25)
+    assert stats(table, 'gone') == (0, 0)
+    assert stats(table, 'mary') == (0, 0)
+    assert get_image_metadata(table, 'john', 'old')['counted_bytes'] == 5
+    
+    # Now that old is counted, deleting it subtracts its bytes
+    delete_image_metadata(table, 'john', 'old')
+    assert stats(table) == (2, 20)
+    assert stats_job.reconcile_user_stats(segments=2)['corrected'] == 0
+
+def test_reconcile_skips_users_updated_during_the_scan(aws):
+    """Stats updates landing while the images are scanned are kept, not overwritten"""
+    from service import stats as stats_job
+    
+    table = aws['table']
+    pending(table, 'a')
+    update_image_status(table, 'john', 'a', 'uploaded', file_size=10)
+    add_user_stats(table, 'john', 1, 999)
+    scan = stats_job.scan_uploaded
+    
+    def scan_with_traffic(*args):
+        # john's drifted row gets another image and mary's first upload is counted mid-scan
+        for user_id, image_id in (('john', 'b'), ('mary', 'c')):
+            pending(table, image_id, user_id=user_id)
+            update_image_status(table, user_id, image_id, 'uploaded', file_size=7)
+        yield from scan(*args)
+    
+    with patch('service.stats.scan_uploaded', side_effect=scan_with_traffic):
+        summary = stats_job.reconcile_user_stats(segments=1)
+    
+    assert (summary['corrected'], summary['skipped']) == (0, 2)
+    assert stats(table) == (3, 1016)
+    assert stats(table, 'mary') == (1, 7)
+    
+    assert stats_job.reconcile_user_stats(segments=1)['corrected'] == 1
+    assert stats(table) == (2, 17)